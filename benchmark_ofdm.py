@@ -25,11 +25,12 @@ from gnuradio import eng_notation
 from gnuradio.eng_option import eng_option
 from optparse import OptionParser
 
-import random, time, struct, sys, math, os
+import random, time, struct, sys, math, os, copy
 
 # from current dir
 from transmit_path import transmit_path
 from receive_path import receive_path
+import fec
 
 
 class my_top_block(gr.top_block):
@@ -86,6 +87,50 @@ class my_top_block(gr.top_block):
             #self.connect(self.mux, gr.file_sink(gr.sizeof_gr_complex, "mux.dat"))
             #self.connect(self.channel, gr.file_sink(gr.sizeof_gr_complex, "channel.dat"))
             
+# /////////////////////////////////////////////////////////////////////////////
+#                                 SNR sweep
+# /////////////////////////////////////////////////////////////////////////////
+
+def run_sweep(options):
+    """
+    Send --packets packets through the simulated channel at each SNR of
+    --snrs and print the packet error rate and goodput for the --fec code.
+    """
+    pkt_size = int(options.size)
+    print
+    print "  snr  fec      sent  rcvd  right     per  fec saved  bytes/sym  cpu/pkt (ms)"
+    for snr in [float(x) for x in options.snrs.split(',')]:
+        o = copy.copy(options)
+        o.snr = snr
+        counts = {'rcvd': 0, 'right': 0}
+
+        def rx_callback(ok, payload):
+            counts['rcvd'] += 1
+            if ok and len(payload) >= 2:
+                (pktno,) = struct.unpack('!H', payload[0:2])
+                if payload[2:] == (pkt_size - 2) * chr(pktno & 0xff):
+                    counts['right'] += 1
+
+        tb = my_top_block(rx_callback, o)
+        tb.start()
+        cpu = time.clock()
+        for pktno in range(options.packets):
+            tb.txpath.send_pkt(struct.pack('!H', pktno) + (pkt_size - 2) * chr(pktno & 0xff))
+        tb.txpath.send_pkt(eof=True)
+        tb.wait()
+        cpu = time.clock() - cpu
+
+        #air time of one packet, coding included
+        coded = pkt_size
+        if options.fec != "none":
+            coded = len(fec.encode(pkt_size * "\0", options.fec))
+        symbols = options.packets * tb.txpath.frame_symbols(coded)
+        per = 1.0 - float(counts['right']) / options.packets
+        print "%5.1f  %-6s %6d %5d %6d  %6.4f  %9d  %9.3f  %12.2f" % \
+              (snr, options.fec, options.packets, counts['rcvd'], counts['right'], per,
+               tb.rxpath.fec_frames, float(counts['right'] * pkt_size) / symbols,
+               1000.0 * cpu / options.packets)
+
 # /////////////////////////////////////////////////////////////////////////////
 #                                   main
 # /////////////////////////////////////////////////////////////////////////////
@@ -138,6 +183,11 @@ def main():
                       help="Turns AWGN, freq offset channel off")
     parser.add_option("","--multipath-on", action="store_true", default=False,
                       help="enable multipath")
+    parser.add_option("", "--snrs", type="string", default=None,
+                      help="comma separated SNRs (dB) to sweep, printing the packet error "
+                      "rate at each instead of every packet [default=%default]")
+    parser.add_option("", "--packets", type="int", default=500,
+                      help="packets sent at each SNR of a sweep [default=%default]")
 
     transmit_path.add_options(parser, expert_grp)
     receive_path.add_options(parser, expert_grp)
@@ -145,6 +195,10 @@ def main():
     blks2.ofdm_demod.add_options(parser, expert_grp)
     
     (options, args) = parser.parse_args ()
+
+    if options.snrs is not None:
+        run_sweep(options)
+        return
        
     # build the graph
     tb = my_top_block(rx_callback, options)
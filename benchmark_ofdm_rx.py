@@ -58,7 +58,8 @@ class my_top_block(gr.top_block):
             self._print_verbage()
         
         # Set up receive path
-        self.rxpath = receive_path(callback, options)
+        self.rxpath = receive_path(callback, options, with_metadata=True,
+                                   samp_rate=self._rate)
         #self.file = gr.file_sink(gr.sizeof_gr_complex, "usrp_source.dat")
 
         self.connect(self.u, self.rxpath)
@@ -155,13 +156,14 @@ def main():
     n_rcvd = 0
     n_right = 0
 
-    def rx_callback(ok, payload):
+    def rx_callback(ok, payload, metadata):
         global n_rcvd, n_right
         n_rcvd += 1
         (pktno,) = struct.unpack('!H', payload[0:2])
         if ok:
             n_right += 1
-        print "ok: %r \t pktno: %d \t n_rcvd: %d \t n_right: %d" % (ok, pktno, n_rcvd, n_right)
+        print "ok: %r \t pktno: %d \t n_rcvd: %d \t n_right: %d \t snr: %.1f \t cfo: %.3f" % \
+              (ok, pktno, n_rcvd, n_right, metadata.snr, metadata.cfo)
 
         if 0:
             printlst = list()
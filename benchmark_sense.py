@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright 2005,2007 Free Software Foundation, Inc.
+#
+# This file is part of GNU Radio
+#
+# GNU Radio is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# GNU Radio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GNU Radio; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+#
+
+#
+# Measures detection probability against dwell time for the energy and pilot
+# detectors in sense_path, without a USRP. The primary is modelled as an ATSC
+# like signal: wideband power plus a pilot tone pilot-below dB under the total.
+# The noise has unit power and SNR is the total primary power over the noise.
+#
+
+from gnuradio import gr
+from gnuradio.eng_option import eng_option
+from optparse import OptionParser
+
+import math, sys, threading, time
+
+# from current dir
+from sense_path import sense_path
+
+
+class my_top_block(gr.top_block):
+    def __init__(self, options, snr_db, nsamples, noise_power=1.0,
+                 occupancy=None, slot_frames=1, iq_file=None, write_iq=None):
+        """
+        @param snr_db: primary power over the noise, None for noise only
+        @param occupancy: list of 0/1 primary states, one per slot, repeated
+        @param slot_frames: length of an occupancy slot in sense frames
+        @param iq_file: read the IQ from this file instead of synthesizing it
+        @param write_iq: also save the IQ to this file
+        """
+        gr.top_block.__init__(self)
+
+        rate = options.channel_rate
+
+        head = gr.head(gr.sizeof_gr_complex, nsamples)
+        self.sense = sense_path(self.tune, options)
+
+        if iq_file is not None:
+            src = gr.file_source(gr.sizeof_gr_complex, iq_file, False)
+        elif snr_db is None:
+            src = gr.noise_source_c(gr.GR_GAUSSIAN, math.sqrt(noise_power), options.seed)
+        else:
+            noise = gr.noise_source_c(gr.GR_GAUSSIAN, math.sqrt(noise_power), options.seed)
+            primary_power = noise_power * 10.0**(snr_db/10.0)
+            pilot_power = primary_power * 10.0**(-options.pilot_below/10.0)
+            data_power = primary_power - pilot_power
+            pilot = gr.sig_source_c(rate, gr.GR_COS_WAVE, options.pilot_offset,
+                                    math.sqrt(pilot_power))
+            data = gr.noise_source_c(gr.GR_GAUSSIAN, math.sqrt(data_power), options.seed + 1)
+            primary = gr.add_cc()
+            self.connect(pilot, (primary, 0))
+            self.connect(data, (primary, 1))
+            if occupancy is not None:
+                # switch the primary on and off: hold each slot's state for
+                # slot_frames frames of frame_len samples. Two interpolating
+                # all-ones filters do the hold with one tap per output each.
+                frame_len = self.sense.fft_size * self.sense.welch_depth
+                gate_src = gr.vector_source_f([float(x) for x in occupancy], True)
+                slot_hold = gr.interp_fir_filter_fff(slot_frames, [1.0] * slot_frames)
+                frame_hold = gr.interp_fir_filter_fff(frame_len, [1.0] * frame_len)
+                gate = gr.float_to_complex()
+                gated = gr.multiply_cc()
+                self.connect(gate_src, slot_hold, frame_hold, gate, (gated, 1))
+                self.connect(primary, (gated, 0))
+                primary = gated
+            src = gr.add_cc()
+            self.connect(noise, (src, 0))
+            self.connect(primary, (src, 1))
+
+        self.connect(src, head, self.sense)
+        if write_iq is not None:
+            self.connect(head, gr.file_sink(gr.sizeof_gr_complex, write_iq))
+
+    def tune(self, target_freq):
+        # there's no front end to tune
+        self.sense.planner.tuned(target_freq)
+        return True
+
+
+def collect_frames(options, snr_db):
+    """
+    Run the sense path over nsamples of synthetic IQ and return the per-frame
+    (mean, peak, pilot, floor) values in dB.
+    """
+    nsamples = int(options.run_time * options.channel_rate)
+    tb = my_top_block(options, snr_db, nsamples)
+    done = threading.Event()
+
+    def run():
+        tb.run()
+        done.set()
+
+    t = threading.Thread(target=run)
+    t.start()
+    frames = []
+    while True:
+        #nobody reads the dwell reports here, don't let them block the graph
+        tb.sense.msgq.flush()
+        msg = tb.sense.frame_msgq.delete_head_nowait()
+        if msg:
+            frames.extend(tb.sense.parse_frames(msg))
+        elif done.isSet() and tb.sense.frame_msgq.count() == 0:
+            break
+        else:
+            time.sleep(.001)
+    t.join()
+    return frames, tb.sense
+
+def detect(frames, dwell, energy_thresh, pilot_thresh):
+    """
+    Split the frames into consecutive dwells and return the fraction of
+    dwells in which the energy and the pilot detector fire.
+    """
+    n = len(frames) / dwell
+    if n == 0:
+        return None, None
+    energy_hits = 0
+    pilot_hits = 0
+    for i in range(n):
+        chunk = frames[i*dwell:(i+1)*dwell]
+        mean_db = sum([f[0] for f in chunk]) / dwell
+        pilot_snr = sum([f[2] - f[3] for f in chunk]) / dwell
+        if mean_db > energy_thresh:
+            energy_hits += 1
+        if pilot_snr > pilot_thresh:
+            pilot_hits += 1
+    return float(energy_hits)/n, float(pilot_hits)/n
+
+def main():
+    parser = OptionParser(option_class=eng_option, conflict_handler="resolve")
+    expert_grp = parser.add_option_group("Expert")
+    parser.add_option("", "--snrs", type="string", default="-20,-15,-12,-9,-6,-3,0",
+                      help="comma separated primary SNRs (dB) to test [default=%default]")
+    parser.add_option("", "--dwells", type="string", default=".0005,.001,.002,.005,.01,.02,.04",
+                      help="comma separated dwell times (s) to test [default=%default]")
+    parser.add_option("", "--run-time", type="eng_float", default=2,
+                      help="seconds of samples per SNR [default=%default]")
+    parser.add_option("", "--pilot-below", type="eng_float", default=11.3,
+                      help="pilot power below the total primary power in dB [default=%default]")
+    parser.add_option("", "--energy-margin", type="eng_float", default=1,
+                      help="energy threshold over the measured noise level in dB [default=%default]")
+    parser.add_option("", "--seed", type="int", default=42,
+                      help="noise seed [default=%default]")
+    expert_grp.add_option("", "--channel_rate", type="eng_float", default=6.25e6,
+                      help="sense sample rate, must contain the pilot [default=%default]")
+    sense_path.add_options(parser, expert_grp)
+
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    if options.pilot_channels == "":
+        options.pilot_channels = "0"
+
+    snrs = [float(x) for x in options.snrs.split(',')]
+    dwells = [float(x) for x in options.dwells.split(',')]
+
+    noise_frames, sense = collect_frames(options, None)
+    if sense.report_len < 4:
+        sys.stderr.write("pilot detector is off, check --channel_rate and --pilot-offset\n")
+        sys.exit(1)
+    frame_time = float(sense.fft_size * sense.welch_depth) / options.channel_rate
+    noise_db = sum([f[0] for f in noise_frames]) / len(noise_frames)
+    energy_thresh = noise_db + options.energy_margin
+
+    print "noise level:      %.2f dB" % (noise_db,)
+    print "energy threshold: %.2f dB" % (energy_thresh,)
+    print "pilot threshold:  %.2f dB over floor" % (options.pilot_thresh,)
+    print "frame time:       %g s" % (frame_time,)
+    print
+    print "%8s %10s %10s %10s" % ("SNR", "dwell", "Pd energy", "Pd pilot")
+    for dwell_time in dwells:
+        dwell = max(1, int(round(dwell_time / frame_time)))
+        pfa_e, pfa_p = detect(noise_frames, dwell, energy_thresh, options.pilot_thresh)
+        if pfa_e is not None:
+            print "%8s %10g %10.3f %10.3f" % ("noise", dwell * frame_time, pfa_e, pfa_p)
+    for snr in snrs:
+        frames, sense = collect_frames(options, snr)
+        for dwell_time in dwells:
+            dwell = max(1, int(round(dwell_time / frame_time)))
+            pd_e, pd_p = detect(frames, dwell, energy_thresh, options.pilot_thresh)
+            if pd_e is not None:
+                print "%8g %10g %10.3f %10.3f" % (snr, dwell * frame_time, pd_e, pd_p)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# /////////////////////////////////////////////////////////////////////////////
+#                       Spectrum Sense Benchmark Suite
+#
+# FuNLab
+# University of Washington
+#
+# Runs sense_path on synthetic IQ (or a file of it) in which a primary is
+# switched on and off on a known schedule, and feeds every report through the
+# same classification the qpCSMA/CA sense service uses. No USRP and no
+# simulated_primary are needed.
+#
+# For every combination of --fft-sizes, --dwells, --snrs and --thresholds one
+# JSON object is written per line with the detection probability, the false
+# alarm rate, the decision latency after the primary switches on and off, and
+# the host CPU time per sense. Lines from different runs can be concatenated
+# and compared.
+#
+# Report windows that straddle an occupancy change only count towards the
+# latency. CPU time is for the whole process, so it includes synthesizing the
+# IQ; use --iq-file (written once with --write-iq) to leave that out.
+# /////////////////////////////////////////////////////////////////////////////
+
+from gnuradio import gr
+from gnuradio.eng_option import eng_option
+from optparse import OptionParser
+
+import copy, random, sys, threading, time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# from current dir
+from benchmark_sense import my_top_block
+from sense_path import sense_path, channel_report
+from sense_service import sense_service
+from sequential_sense import sprt_detector
+from spectrum_history import spectrum_history_writer
+from occupancy_model import occupancy_model
+from qpcsmaca_mac import cs_mac
+
+
+class sense_holder(object):
+    """
+    Stands in for the PHY top block when only the sense path is needed.
+    """
+    def __init__(self, sense):
+        self.sense = sense
+
+def make_occupancy(options):
+    """
+    Return the primary's on/off state for each slot.
+    """
+    if options.occupancy != "":
+        return [int(x) for x in options.occupancy.split(',')]
+    #two state Markov chain with the requested duty cycle and mean dwell
+    rng = random.Random(options.seed)
+    p_off = 1.0 / max(1.0, options.mean_slots)
+    p_on = p_off * options.duty / max(1e-6, 1.0 - options.duty)
+    state = 0
+    occupancy = []
+    for i in range(options.slots):
+        occupancy.append(state)
+        if state and rng.random() < p_off:
+            state = 0
+        elif not state and rng.random() < p_on:
+            state = 1
+    return occupancy
+
+def run_sense(options, snr_db, occupancy):
+    """
+    Run one sense_path configuration over the synthetic IQ.
+
+    @return: (reports, cpu seconds, sense_path, frames per slot)
+    """
+    frame_len = options.sense_fft_size * max(1, options.welch_depth)
+    slot_frames = max(1, int(round(options.slot_time * options.channel_rate / frame_len)))
+    nsamples = int(options.run_time * options.channel_rate)
+    noise_power = 10.0**(options.noise_db/10.0)
+    tb = my_top_block(options, snr_db, nsamples, noise_power, occupancy, slot_frames,
+                      options.iq_file, options.write_iq)
+    tb.sense.set_hold_freq(True)
+    done = threading.Event()
+
+    def run():
+        tb.run()
+        done.set()
+
+    reports = []
+    cpu_start = time.clock()
+    t = threading.Thread(target=run)
+    t.start()
+    while True:
+        #frames aren't used here, keep them from piling up
+        tb.sense.frame_msgq.flush()
+        msg = tb.sense.msgq.delete_head_nowait()
+        if msg:
+            reports.append(channel_report(msg, tb.sense.channels))
+        elif done.isSet() and tb.sense.msgq.count() == 0:
+            break
+        else:
+            time.sleep(.001)
+    t.join()
+    cpu = time.clock() - cpu_start
+    return reports, cpu, tb.sense, slot_frames
+
+def score(decisions, windows, truth_of, transitions, frame_time):
+    """
+    Compare per-report decisions (1 primary, 0 not) with the true occupancy.
+
+    @param windows: list of (first frame, end frame) of each report
+    @param truth_of: fn(frame) -> 0/1
+    @param transitions: list of (frame, new state)
+    """
+    detections = 0
+    occupied = 0
+    false_alarms = 0
+    free = 0
+    for (first, end), d in zip(windows, decisions):
+        states = dict([(truth_of(f), True) for f in range(first, end)])
+        if len(states) != 1:
+            continue
+        if states.keys()[0] == 1:
+            occupied += 1
+            detections += d
+        else:
+            free += 1
+            false_alarms += d
+
+    latency = {0: [], 1: []}
+    missed = {0: 0, 1: 0}
+    for i in range(len(transitions)):
+        frame, state = transitions[i]
+        if i + 1 < len(transitions):
+            next_frame = transitions[i + 1][0]
+        else:
+            next_frame = None
+        found = False
+        for (first, end), d in zip(windows, decisions):
+            if end <= frame:
+                continue
+            if next_frame is not None and end > next_frame:
+                break
+            if d == state:
+                latency[state].append((end - frame) * frame_time)
+                found = True
+                break
+        if not found:
+            missed[state] += 1
+
+    result = {}
+    result["occupied_reports"] = occupied
+    result["free_reports"] = free
+    result["pd"] = None
+    result["pfa"] = None
+    if occupied:
+        result["pd"] = float(detections) / occupied
+    if free:
+        result["pfa"] = float(false_alarms) / free
+    for state, name in ((1, "onset"), (0, "release")):
+        l = latency[state]
+        result[name + "_missed"] = missed[state]
+        result[name + "_latency_mean"] = None
+        result[name + "_latency_max"] = None
+        if len(l) > 0:
+            result[name + "_latency_mean"] = sum(l) / len(l)
+            result[name + "_latency_max"] = max(l)
+    return result
+
+def main():
+    parser = OptionParser(option_class=eng_option, conflict_handler="resolve")
+    expert_grp = parser.add_option_group("Expert")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    parser.add_option("", "--fft-sizes", type="string", default="256,512,1024",
+                      help="comma separated FFT sizes to test [default=%default]")
+    parser.add_option("", "--dwells", type="string", default=".01,.02,.04",
+                      help="comma separated dwell delays (s) to test [default=%default]")
+    parser.add_option("", "--snrs", type="string", default="-15,-10,-5,0",
+                      help="comma separated primary SNRs (dB) to test [default=%default]")
+    parser.add_option("", "--thresholds", type="string", default="-60,-57,-54,-50",
+                      help="comma separated thresholds to test; thresh_primary in dB, or dB over "
+                      "the floor for the pilot detector [default=%default]")
+    parser.add_option("", "--run-time", type="eng_float", default=4,
+                      help="seconds of samples per configuration [default=%default]")
+    parser.add_option("", "--noise-db", type="eng_float", default=-30,
+                      help="noise power per sample in dB full scale [default=%default]")
+    parser.add_option("", "--occupancy", type="string", default="",
+                      help="comma separated 0/1 primary states per slot, random if empty [default=%default]")
+    parser.add_option("", "--slot-time", type="eng_float", default=.25,
+                      help="length of an occupancy slot in seconds [default=%default]")
+    parser.add_option("", "--slots", type="int", default=64,
+                      help="number of random occupancy slots (repeated) [default=%default]")
+    parser.add_option("", "--duty", type="eng_float", default=.5,
+                      help="fraction of random slots the primary is on [default=%default]")
+    parser.add_option("", "--mean-slots", type="eng_float", default=3,
+                      help="mean length of a random on period in slots [default=%default]")
+    parser.add_option("", "--pilot-below", type="eng_float", default=11.3,
+                      help="pilot power below the total primary power in dB [default=%default]")
+    parser.add_option("", "--seed", type="int", default=42,
+                      help="noise and occupancy seed [default=%default]")
+    parser.add_option("", "--iq-file", type="string", default=None,
+                      help="read the IQ from FILE instead of synthesizing it (use the same occupancy) [default=%default]")
+    parser.add_option("", "--write-iq", type="string", default=None,
+                      help="also save the synthesized IQ to FILE [default=%default]")
+    parser.add_option("-o", "--output", type="string", default=None,
+                      help="append JSON lines to FILE instead of stdout [default=%default]")
+    parser.add_option("", "--label", type="string", default="",
+                      help="free form label stored with every result [default=%default]")
+    cs_mac.add_options(parser, expert_grp)
+    sense_path.add_options(parser, expert_grp)
+    sprt_detector.add_options(parser, expert_grp)
+    spectrum_history_writer.add_options(parser, expert_grp)
+    occupancy_model.add_options(parser, expert_grp)
+
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    fft_sizes = [int(x) for x in options.fft_sizes.split(',')]
+    dwells = [float(x) for x in options.dwells.split(',')]
+    snrs = [float(x) for x in options.snrs.split(',')]
+    thresholds = [float(x) for x in options.thresholds.split(',')]
+    occupancy = make_occupancy(options)
+
+    if options.output is None:
+        out = sys.stdout
+    else:
+        out = open(options.output, 'a')
+
+    for fft_size in fft_sizes:
+        for dwell in dwells:
+            for snr in snrs:
+                o = copy.copy(options)
+                o.sense_fft_size = fft_size
+                o.dwell_delay = dwell
+                reports, cpu, sense, slot_frames = run_sense(o, snr, occupancy)
+
+                frame_time = float(sense.fft_size * sense.welch_depth) / o.channel_rate
+                cycle = sense.tune_frames + sense.dwell_frames
+                windows = []
+                for k in range(len(reports)):
+                    windows.append((k*cycle + sense.tune_frames, (k + 1)*cycle))
+
+                def truth_of(frame):
+                    return occupancy[(frame / slot_frames) % len(occupancy)]
+                transitions = []
+                last_frame = len(reports) * cycle
+                for s in range(1, last_frame / slot_frames + 1):
+                    if truth_of(s*slot_frames) != truth_of(s*slot_frames - 1):
+                        transitions.append((s*slot_frames, truth_of(s*slot_frames)))
+
+                # the same decision the sense service makes
+                service = sense_service(o)
+                service.set_flow_graph(sense_holder(sense))
+                channel = sense.channels[0]
+                detector = sense.detector(channel)
+                if service.history is not None:
+                    for m in reports:
+                        service.record(m, channel, service.classify_report(m, channel))
+                    service.history.close()
+                for thresh in thresholds:
+                    if detector == "pilot":
+                        service.pilot_thresh = thresh
+                    else:
+                        service.thresh_primary = thresh
+                    decisions = []
+                    for m in reports:
+                        decisions.append(int(service.classify_report(m, channel) == 1))
+                    result = score(decisions, windows, truth_of, transitions, frame_time)
+                    result["label"] = options.label
+                    result["timestamp"] = time.time()
+                    result["detector"] = detector
+                    result["fft_size"] = fft_size
+                    result["dwell_delay"] = dwell
+                    result["tune_delay"] = o.tune_delay
+                    result["snr_db"] = snr
+                    result["noise_db"] = o.noise_db
+                    result["threshold"] = thresh
+                    result["sense_time"] = cycle * frame_time
+                    result["reports"] = len(reports)
+                    result["cpu_per_sense"] = None
+                    if len(reports) > 0:
+                        result["cpu_per_sense"] = cpu / len(reports)
+                    out.write(json.dumps(result, sort_keys=True) + "\n")
+                    out.flush()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,110 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                         Cooperative Sensing Fusion
+#
+# FuNLab
+# University of Washington
+#
+# Nodes share their recent per-channel sensing results in sensing report
+# extensions (see mac_frames). The report_fusion merges this node's own
+# result for a channel with the fresh results its neighbors reported:
+#
+#   or        busy if anyone saw a primary (fewest misses)
+#   and       busy only if everyone did (fewest false alarms)
+#   majority  busy if at least half did
+#   soft      average the measured powers (in linear units) and compare
+#             the average against thresh_primary
+#
+# Because several nodes look at the channel, each can dwell for less time and
+# the network still reaches the same reliability. The fusion counts how often
+# it overruled the local decision.
+# /////////////////////////////////////////////////////////////////////////////
+
+import math
+
+class report_fusion(object):
+    """
+    Merges local and neighbor sensing results per channel.
+    """
+    def __init__(self, rule, ttl, thresh_primary):
+        """
+        @param rule: "or", "and", "majority" or "soft"
+        @param ttl: seconds a result is used for
+        @param thresh_primary: primary threshold (dB) for soft combining
+        """
+        self.rule = rule
+        self.ttl = ttl
+        self.thresh_primary = thresh_primary
+        self.reports = {} #freq -> {node: (timestamp, busy, power_db)}
+        self.decisions = 0
+        self.caught = 0 #local said free, neighbors said busy
+        self.cleared = 0 #local said busy, neighbors said free
+
+    def add(self, node, freq, timestamp, busy, power_db):
+        """
+        Add one result. The local node uses node None.
+        """
+        if freq not in self.reports:
+            self.reports[freq] = {}
+        old = self.reports[freq].get(node)
+        if old is None or old[0] <= timestamp:
+            self.reports[freq][node] = (timestamp, int(bool(busy)), power_db)
+
+    def fresh(self, freq, now):
+        """
+        Return the results for freq that are younger than ttl.
+        """
+        reports = []
+        for (timestamp, busy, power_db) in self.reports.get(freq, {}).values():
+            if now - timestamp <= self.ttl:
+                reports.append((busy, power_db))
+        return reports
+
+    def decide(self, freq, now, local_busy):
+        """
+        Fuse the results for freq.
+
+        @param local_busy: this node's own decision, used if nothing is fresh
+        @return: True if the channel should be treated as occupied
+        """
+        reports = self.fresh(freq, now)
+        if len(reports) == 0:
+            return local_busy
+        votes = [busy for (busy, power_db) in reports]
+        if self.rule == "or":
+            busy = max(votes) == 1
+        elif self.rule == "and":
+            busy = min(votes) == 1
+        elif self.rule == "majority":
+            busy = 2*sum(votes) >= len(votes)
+        else:
+            power = 0.0
+            for (b, power_db) in reports:
+                power += 10.0**(power_db/10.0)
+            busy = 10*math.log10(power / len(reports)) > self.thresh_primary
+        self.decisions += 1
+        if busy and not local_busy:
+            self.caught += 1
+        elif local_busy and not busy:
+            self.cleared += 1
+        return busy
+
+    def report(self):
+        """
+        Print how the fusion changed the local decisions.
+        """
+        print "fused decisions:              ", self.decisions
+        print "primaries only neighbors saw: ", self.caught
+        print "local detections overruled:   ", self.cleared
+
+    def add_options(normal, expert):
+        """
+        Adds cooperative sensing options to the Options Parser
+        """
+        normal.add_option("", "--coop-sense", type="choice", default="none",
+                          choices=["none", "or", "and", "majority", "soft"],
+                          help="share sensing results with neighbors and fuse them with "
+                          "none, or, and, majority or soft combining [default=%default]")
+        expert.add_option("", "--coop-ttl", type="eng_float", default=1.0, metavar="SECS",
+                          help="use neighbor results for up to SECS seconds [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
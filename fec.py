@@ -0,0 +1,277 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                        Payload Forward Error Correction
+#
+# FuNLab
+# University of Washington
+#
+# Reed-Solomon coding of the payload handed to ofdm_mod, so frames with a
+# few byte errors are repaired instead of failing the CRC and costing a full
+# RTS/CTS/DATA retransmission.
+#
+# A coded payload is
+#
+#   header   (code id, number of codewords) sent three times, voted bytewise
+#   body     the codewords, byte interleaved
+#
+# The data (a 2 byte length, the payload, zero padding) is split evenly over
+# as few shortened RS(255, k) codewords as hold it, and the codewords are
+# read out column by column. A deep fade on one subcarrier or a bad OFDM
+# symbol then hits consecutive bytes of different codewords, and each
+# codeword only sees a few of the errors.
+#
+# The header makes every frame self-describing: the receiver decodes
+# whatever code the sender picked, so the two ends agree on the code rate
+# frame by frame without any exchange. Code id 0 is the uncoded payload.
+#
+# Encoding and the syndrome check run on all codewords of a frame at once
+# with numpy; only codewords that have errors go through Berlekamp-Massey,
+# and the Chien search over the error positions is vectorized too.
+# /////////////////////////////////////////////////////////////////////////////
+
+import struct
+import numpy
+
+# name -> (code id, parity bytes per codeword); all are RS(255, 255 - parity)
+CODES = {"none": (0, 0), "rs239": (1, 16), "rs223": (2, 32), "rs191": (3, 64),
+         "rs127": (4, 128)}
+_PARITY = dict([(cid, nsym) for (cid, nsym) in CODES.values()])
+
+HEADER_COPIES = 3
+HEADER_LEN = 2 * HEADER_COPIES
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                 GF(256)
+# /////////////////////////////////////////////////////////////////////////////
+
+_EXP = numpy.zeros(512, dtype=numpy.int32)
+_LOG = numpy.zeros(256, dtype=numpy.int32)
+_x = 1
+for _i in range(255):
+    _EXP[_i] = _x
+    _LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+_EXP[255:510] = _EXP[:255]
+
+def _mul(a, b):
+    """
+    Elementwise product of two arrays (or scalars) in GF(256).
+    """
+    a = numpy.asarray(a, dtype=numpy.int32)
+    b = numpy.asarray(b, dtype=numpy.int32)
+    r = _EXP[_LOG[a] + _LOG[b]]
+    return numpy.where((a == 0) | (b == 0), 0, r)
+
+def _gmul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return int(_EXP[_LOG[a] + _LOG[b]])
+
+def _gdiv(a, b):
+    if a == 0:
+        return 0
+    return int(_EXP[(_LOG[a] - _LOG[b]) % 255])
+
+def _poly_eval(p, x):
+    """
+    Evaluate p (lowest degree first) at every element of the array x.
+    """
+    y = numpy.zeros(numpy.shape(x), dtype=numpy.int32)
+    for coef in reversed(p):
+        y = _mul(y, x) ^ coef
+    return y
+
+# /////////////////////////////////////////////////////////////////////////////
+#                               Reed-Solomon
+# /////////////////////////////////////////////////////////////////////////////
+
+class rs_codec(object):
+    """
+    Systematic RS code over GF(256) with nsym parity bytes (generator roots
+    alpha^0 .. alpha^(nsym-1)), on blocks of codewords.
+    """
+    def __init__(self, nsym):
+        self.nsym = nsym
+        #generator, highest degree first
+        g = [1]
+        for i in range(nsym):
+            root = int(_EXP[i])
+            h = g + [0]
+            for j in range(len(g)):
+                h[j + 1] ^= _gmul(g[j], root)
+            g = h
+        self.gen = numpy.array(g[1:], dtype=numpy.int32)
+
+    def encode(self, msgs):
+        """
+        @param msgs: (codewords, data bytes) int array
+        @return: (codewords, data bytes + nsym) array, data first
+        """
+        nblocks, m = msgs.shape
+        reg = numpy.zeros((nblocks, self.nsym), dtype=numpy.int32)
+        for i in range(m):
+            feedback = msgs[:, i] ^ reg[:, 0]
+            reg[:, :-1] = reg[:, 1:]
+            reg[:, -1] = 0
+            reg ^= _mul(feedback[:, None], self.gen[None, :])
+        return numpy.hstack((msgs, reg))
+
+    def syndromes(self, words):
+        """
+        @return: (codewords, nsym) array, all zero for a valid codeword
+        """
+        roots = _EXP[:self.nsym][None, :]
+        s = numpy.zeros((words.shape[0], self.nsym), dtype=numpy.int32)
+        for i in range(words.shape[1]):
+            s = _mul(s, roots) ^ words[:, i][:, None]
+        return s
+
+    def decode(self, words):
+        """
+        Correct a block of codewords in place.
+
+        @param words: (codewords, length) int array
+        @return: (ok, corrected): per codeword whether it decoded, and the
+                 number of bytes corrected in all of them
+        """
+        s = self.syndromes(words)
+        ok = numpy.ones(words.shape[0], dtype=bool)
+        corrected = 0
+        for row in numpy.nonzero(s.any(axis=1))[0]:
+            n = self._correct(words[row], [int(v) for v in s[row]])
+            if n is None:
+                ok[row] = False
+            else:
+                corrected += n
+        return ok, corrected
+
+    def _correct(self, word, synd):
+        length = len(word)
+        #error locator by Berlekamp-Massey, lowest degree first
+        c = [1]
+        b = [1]
+        l = 0
+        shift = 1
+        last = 1
+        for n in range(self.nsym):
+            d = synd[n]
+            for i in range(1, l + 1):
+                if i < len(c):
+                    d ^= _gmul(c[i], synd[n - i])
+            if d == 0:
+                shift += 1
+                continue
+            coef = _gdiv(d, last)
+            t = c[:]
+            c = c + [0] * max(0, len(b) + shift - len(c))
+            for i in range(len(b)):
+                c[i + shift] ^= _gmul(coef, b[i])
+            if 2 * l <= n:
+                l = n + 1 - l
+                b = t
+                last = d
+                shift = 1
+            else:
+                shift += 1
+        c = c[:l + 1]
+        if l == 0 or 2 * l > self.nsym:
+            return None
+
+        #Chien search: the error at power e (index length-1-e) makes
+        #c(alpha^-e) zero
+        powers = numpy.arange(length)
+        inv = _EXP[(255 - powers) % 255]
+        errors = numpy.nonzero(_poly_eval(c, inv) == 0)[0]
+        if len(errors) != l:
+            return None
+
+        #Forney: magnitude X * omega(1/X) / lambda'(1/X)
+        omega = [0] * self.nsym
+        for i in range(self.nsym):
+            for j in range(min(i, l) + 1):
+                omega[i] ^= _gmul(synd[i - j], c[j])
+        deriv = [c[k] if k % 2 == 1 else 0 for k in range(1, len(c))]
+        x_inv = inv[errors]
+        den = _poly_eval(deriv, x_inv)
+        if (den == 0).any():
+            return None
+        num = _poly_eval(omega, x_inv)
+        #num / den * X, in logs
+        mag = _EXP[(_LOG[num] - _LOG[den] + errors) % 255]
+        mag = numpy.where(num == 0, 0, mag)
+        word[length - 1 - errors] ^= mag
+        return l
+
+_codecs = {}
+
+def _codec(nsym):
+    if nsym not in _codecs:
+        _codecs[nsym] = rs_codec(nsym)
+    return _codecs[nsym]
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                 framing
+# /////////////////////////////////////////////////////////////////////////////
+
+def encode(payload, code):
+    """
+    Return the coded payload.
+
+    @param code: one of the CODES names
+    """
+    cid, nsym = CODES[code]
+    data = struct.pack("!H", len(payload)) + payload
+    if nsym == 0:
+        return (chr(cid) + chr(1)) * HEADER_COPIES + data
+    k = 255 - nsym
+    nblocks = (len(data) + k - 1) // k
+    if nblocks > 255:
+        raise ValueError, "payload too long for %s" % (code,)
+    m = (len(data) + nblocks - 1) // nblocks
+    data += "\0" * (nblocks * m - len(data))
+    msgs = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int32).reshape(nblocks, m)
+    words = _codec(nsym).encode(msgs)
+    #interleave: column by column across the codewords
+    body = words.T.astype(numpy.uint8).tostring()
+    return (chr(cid) + chr(nblocks)) * HEADER_COPIES + body
+
+def _vote(copies):
+    for x in copies:
+        if copies.count(x) * 2 > len(copies):
+            return x
+    return None
+
+def decode(frame):
+    """
+    Undo encode.
+
+    @return: (ok, payload, code id, bytes corrected); ok is False if the
+             header can't be read or a codeword has too many errors, in
+             which case payload is the best guess
+    """
+    if len(frame) < HEADER_LEN + 2:
+        return False, "", None, 0
+    cid = _vote([ord(frame[2*i]) for i in range(HEADER_COPIES)])
+    nblocks = _vote([ord(frame[2*i + 1]) for i in range(HEADER_COPIES)])
+    body = frame[HEADER_LEN:]
+    if cid not in _PARITY or not nblocks:
+        return False, "", cid, 0
+    nsym = _PARITY[cid]
+    ok = True
+    corrected = 0
+    if nsym == 0:
+        data = body
+    else:
+        length = len(body) // nblocks
+        if length * nblocks != len(body) or length <= nsym:
+            return False, "", cid, 0
+        words = numpy.frombuffer(body, dtype=numpy.uint8).astype(numpy.int32)
+        words = words.reshape(length, nblocks).T.copy()
+        block_ok, corrected = _codec(nsym).decode(words)
+        ok = bool(block_ok.all())
+        data = words[:, :length - nsym].astype(numpy.uint8).tostring()
+    (n,) = struct.unpack("!H", data[:2])
+    if n > len(data) - 2:
+        return False, data[2:], cid, corrected
+    return ok, data[2:2 + n], cid, corrected
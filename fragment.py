@@ -0,0 +1,252 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                      Fragmentation and Reassembly
+#
+# FuNLab
+# University of Washington
+#
+# Splits the frames the tunnel reads from TUN/TAP into radio sized
+# fragments and puts them back together on the other side. A long OFDM
+# frame is lost to a single bit error; in fragments only the hit fragment
+# is lost (and with it the packet, which TCP resends), but short frames
+# pay the preamble and framing overhead more often, so the best size
+# depends on the link.
+#
+# Every fragment carries a 5 byte header
+#
+#   sender, packet id (16 bits), fragment index, fragment count
+#
+# Packet ids are only unique per sender, so the reassembler keeps partial
+# packets by sender and id; the sender byte is --frag-sender, or random.
+#
+# A packet that fits goes out as the one fragment of its packet.
+#
+# With adaptation on, the fragment size follows the link: the bit error
+# rate is estimated from how many received frames fail their CRC for their
+# length, and the size that maximizes
+#
+#   size / (size + overhead) * P(fragment gets through)
+#
+# is used.
+#
+# The reassembler keeps a bounded number of partial packets; a packet whose
+# fragments don't all arrive within the timeout, or that is pushed out by
+# newer ones, is dropped.
+# /////////////////////////////////////////////////////////////////////////////
+
+import random
+import struct
+import time
+
+HEADER_FMT = "!BHBB"
+HEADER_LEN = struct.calcsize(HEADER_FMT)
+MAX_FRAGMENTS = 255
+
+# bytes ofdm_mod adds around every payload (header, CRC, trailer)
+_FRAMING = 9
+
+class fragmenter(object):
+    """
+    Cuts packets into fragments of at most frag_size bytes (header
+    included).
+    """
+    def __init__(self, frag_size, adapt=False, min_size=64, overhead=64, ewma=.95,
+                 sender=None):
+        """
+        @param frag_size: fragment size, the largest one with adapt
+        @param adapt: pick the size from the observed frame error rate
+        @param min_size: smallest size adapt picks
+        @param overhead: per frame cost in byte times, besides the framing
+                         (preamble symbol, symbol rounding, carrier sense)
+        @param ewma: weight of the history in the error rate estimate
+        @param sender: this node's byte in the header, None picks one at
+                       random
+        """
+        if frag_size <= HEADER_LEN:
+            raise ValueError, "fragment size must be more than %d bytes" % (HEADER_LEN,)
+        self.max_size = frag_size
+        self.frag_size = frag_size
+        self.adapt = adapt
+        self.min_size = max(HEADER_LEN + 1, min(min_size, frag_size))
+        self.overhead = overhead
+        self.ewma = ewma
+        self._ok_rate = None
+        self._bits = None
+        self._next_id = random.randint(0, 0xffff)
+        if sender is None:
+            sender = random.randint(0, 0xff)
+        if sender < 0 or sender > 0xff:
+            raise ValueError, "fragment sender id must be 0 to 255"
+        self.sender = sender
+
+        # counters
+        self.packets = 0
+        self.fragments = 0
+        self.bytes = 0
+        self.too_long = 0
+
+    def fragment(self, payload):
+        """
+        Return the fragments of payload, [] if it needs more than
+        MAX_FRAGMENTS.
+        """
+        room = self.frag_size - HEADER_LEN
+        count = max(1, (len(payload) + room - 1) // room)
+        if count > MAX_FRAGMENTS:
+            self.too_long += 1
+            return []
+        pkt_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xffff
+        frags = []
+        for i in range(count):
+            frags.append(struct.pack(HEADER_FMT, self.sender, pkt_id, i, count) +
+                         payload[i*room:(i + 1)*room])
+        self.packets += 1
+        self.fragments += count
+        self.bytes += len(payload)
+        return frags
+
+    def observe(self, ok, length):
+        """
+        Account a received frame of length payload bytes, for adaptation.
+        """
+        if not self.adapt:
+            return
+        bits = 8 * (length + _FRAMING)
+        ok = ok and 1.0 or 0.0
+        if self._ok_rate is None:
+            self._ok_rate = ok
+            self._bits = float(bits)
+        else:
+            self._ok_rate = self.ewma * self._ok_rate + (1 - self.ewma) * ok
+            self._bits = self.ewma * self._bits + (1 - self.ewma) * bits
+        self.frag_size = self._best_size()
+
+    def bit_error_rate(self):
+        """
+        Return the estimated bit error rate, None before any frame.
+        """
+        if self._ok_rate is None:
+            return None
+        if self._ok_rate <= 0:
+            return 1.0
+        return 1 - self._ok_rate ** (1.0 / self._bits)
+
+    def _best_size(self):
+        p = self.bit_error_rate()
+        if not p:
+            return self.max_size
+        if p >= 1:
+            return self.min_size
+        best = self.min_size
+        best_goodput = 0
+        for size in range(self.min_size, self.max_size + 1, 16) + [self.max_size]:
+            data = size - HEADER_LEN
+            goodput = float(data) / (size + _FRAMING + self.overhead) * \
+                      (1 - p) ** (8 * (size + _FRAMING))
+            if goodput > best_goodput:
+                best = size
+                best_goodput = goodput
+        return best
+
+    def add_options(normal, expert):
+        """
+        Adds fragmentation and reassembly options to the Options Parser
+        """
+        normal.add_option("", "--frag-size", type="int", default=0, metavar="BYTES",
+                          help="send TUN/TAP frames in fragments of at most BYTES, 0 sends them "
+                          "whole; all nodes must agree on 0 or not [default=%default]")
+        expert.add_option("", "--frag-adapt", action="store_true", default=False,
+                          help="pick the fragment size (up to --frag-size) from the frame error "
+                          "rate [default=%default]")
+        expert.add_option("", "--frag-min", type="int", default=64, metavar="BYTES",
+                          help="smallest fragment size --frag-adapt picks [default=%default]")
+        expert.add_option("", "--frag-sender", type="int", default=None, metavar="ID",
+                          help="this node's id (0-255) in fragment headers, different on every "
+                          "node; random if not given [default=%default]")
+        expert.add_option("", "--reasm-buffers", type="int", default=32,
+                          help="partial packets kept for reassembly [default=%default]")
+        expert.add_option("", "--reasm-timeout", type="eng_float", default=1.0, metavar="SECS",
+                          help="drop a partial packet after SECS [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
+
+
+class reassembler(object):
+    """
+    Puts fragments back together.
+    """
+    def __init__(self, max_packets=32, timeout=1.0):
+        """
+        @param max_packets: most partial packets kept
+        @param timeout: seconds a partial packet waits for its fragments
+        """
+        self.max_packets = max_packets
+        self.timeout = timeout
+        self._partial = {} # (sender, packet id) -> [first arrival, count, {index: data}]
+
+        # counters
+        self.fragments = 0
+        self.packets = 0
+        self.duplicates = 0
+        self.timed_out = 0
+        self.evicted = 0
+        self.bad = 0
+
+    def _expire(self, now):
+        for key in self._partial.keys():
+            if now - self._partial[key][0] > self.timeout:
+                del self._partial[key]
+                self.timed_out += 1
+
+    def add(self, frag, now=None):
+        """
+        Take a received fragment.
+
+        @return: the packet if frag completed one, else None
+        """
+        if now is None:
+            now = time.time()
+        if len(frag) < HEADER_LEN:
+            self.bad += 1
+            return None
+        sender, pkt_id, index, count = struct.unpack(HEADER_FMT, frag[:HEADER_LEN])
+        data = frag[HEADER_LEN:]
+        if count == 0 or index >= count:
+            self.bad += 1
+            return None
+        self.fragments += 1
+        if count == 1:
+            self.packets += 1
+            return data
+
+        self._expire(now)
+        key = (sender, pkt_id)
+        entry = self._partial.get(key)
+        if entry is not None and entry[1] != count:
+            #an old packet with the same id
+            del self._partial[key]
+            self.evicted += 1
+            entry = None
+        if entry is None:
+            if len(self._partial) >= self.max_packets:
+                oldest = min(self._partial.keys(), key=lambda k: self._partial[k][0])
+                del self._partial[oldest]
+                self.evicted += 1
+            entry = [now, count, {}]
+            self._partial[key] = entry
+        if index in entry[2]:
+            self.duplicates += 1
+            return None
+        entry[2][index] = data
+        if len(entry[2]) < count:
+            return None
+        del self._partial[key]
+        self.packets += 1
+        return "".join([entry[2][i] for i in range(count)])
+
+    def pending(self):
+        """
+        Return the number of partial packets held.
+        """
+        return len(self._partial)
+
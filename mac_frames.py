@@ -0,0 +1,145 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                       qpCSMA/CA Management Frames
+#
+# FuNLab
+# University of Washington
+#
+# Management information rides along with the MAC's frames as extensions. An
+# extension is
+#
+#   "\x7f" + 2 char kind + 1 byte body length + body
+#
+# and extensions can be chained. They are appended to RTS/CTS/ACK payloads
+# ("RTS\x7fSR..."), or sent on their own, in which case the payload starts
+# with "\x7f". Data payloads never start with "\x7f" (IP packets start with
+# the version nibble and the test traffic is printable), and a control
+# payload is exactly three chars, so neither is mistaken for management.
+# /////////////////////////////////////////////////////////////////////////////
+
+import struct
+
+TAG = "\x7f"
+CTL_FRAMES = ("RTS", "CTS", "ACK")
+
+#extension kinds
+SENSE_REPORT = "SR"
+CHANNEL_SWITCH = "CS"
+BACKUP_CHANNEL = "BC"
+QP_SCHEDULE = "QS"
+
+NO_CHANNEL = 255
+
+def add_ext(payload, kind, body):
+    """
+    Append a management extension to a control (or empty) payload.
+
+    @param kind: two char extension kind
+    @param body: extension body, at most 255 bytes
+    """
+    assert len(kind) == 2 and len(body) < 256
+    return payload + TAG + kind + chr(len(body)) + body
+
+def parse(payload):
+    """
+    Split a payload into the frame itself and its extensions.
+
+    @return: (base, [(kind, body), ...]); base is "" for a management-only
+             frame and the whole payload for data frames
+    """
+    if payload[:1] == TAG:
+        base = ""
+        rest = payload
+    elif payload[:3] in CTL_FRAMES and payload[3:4] == TAG:
+        base = payload[:3]
+        rest = payload[3:]
+    else:
+        return payload, []
+    exts = []
+    while len(rest) >= 4 and rest[0] == TAG:
+        n = ord(rest[3])
+        exts.append((rest[1:3], rest[4:4 + n]))
+        rest = rest[4 + n:]
+    return base, exts
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              sensing report
+# /////////////////////////////////////////////////////////////////////////////
+
+REPORT_ENTRY = "!BBh"
+REPORT_ENTRY_LEN = struct.calcsize(REPORT_ENTRY)
+
+def pack_sense_report(entries):
+    """
+    @param entries: list of (channel number, busy, power in dB, age in s)
+    """
+    body = ""
+    for (chan, busy, power_db, age) in entries[:255 / REPORT_ENTRY_LEN]:
+        #age in 10 ms steps (up to 1.27 s) in the flags byte, power in 0.1 dB
+        flags = int(bool(busy)) | (min(127, int(age * 100)) << 1)
+        power = max(-32768, min(32767, int(round(power_db * 10))))
+        body += struct.pack(REPORT_ENTRY, chan, flags, power)
+    return body
+
+def unpack_sense_report(body):
+    """
+    @return: list of (channel number, busy, power in dB, age in s)
+    """
+    entries = []
+    for i in range(len(body) / REPORT_ENTRY_LEN):
+        chan, flags, power = struct.unpack_from(REPORT_ENTRY, body, i*REPORT_ENTRY_LEN)
+        entries.append((chan, flags & 1, power / 10.0, (flags >> 1) / 100.0))
+    return entries
+
+# /////////////////////////////////////////////////////////////////////////////
+#                         channel switch announcement
+# /////////////////////////////////////////////////////////////////////////////
+
+SWITCH_FMT = "!BBH"
+SWITCH_LEN = struct.calcsize(SWITCH_FMT)
+
+def pack_channel_switch(target, backup, countdown):
+    """
+    @param target: channel number to move to
+    @param backup: backup channel number, None if there is none
+    @param countdown: seconds from now until the switch (up to 65 s)
+    """
+    if backup is None:
+        backup = NO_CHANNEL
+    return struct.pack(SWITCH_FMT, target, backup, min(65535, int(countdown * 1000)))
+
+def unpack_channel_switch(body):
+    """
+    @return: (target channel, backup channel or None, countdown in s), None
+             if body is too short
+    """
+    if len(body) < SWITCH_LEN:
+        return None
+    target, backup, countdown = struct.unpack(SWITCH_FMT, body[:SWITCH_LEN])
+    if backup == NO_CHANNEL:
+        backup = None
+    return target, backup, countdown / 1000.0
+
+# /////////////////////////////////////////////////////////////////////////////
+#                           quiet period schedule
+# /////////////////////////////////////////////////////////////////////////////
+
+SCHEDULE_FMT = "!HHI"
+SCHEDULE_LEN = struct.calcsize(SCHEDULE_FMT)
+
+def pack_qp_schedule(period, length, offset):
+    """
+    @param period: seconds between quiet periods
+    @param length: quiet period length in seconds
+    @param offset: seconds from now until the next quiet period
+    """
+    return struct.pack(SCHEDULE_FMT, min(65535, int(period * 1000)),
+                       min(65535, int(length * 1000)), max(0, int(offset * 1000)))
+
+def unpack_qp_schedule(body):
+    """
+    @return: (period, length, offset) in seconds, None if body is too short
+    """
+    if len(body) < SCHEDULE_LEN:
+        return None
+    period, length, offset = struct.unpack(SCHEDULE_FMT, body[:SCHEDULE_LEN])
+    return period / 1000.0, length / 1000.0, offset / 1000.0
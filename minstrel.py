@@ -0,0 +1,185 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                          Minstrel Rate Control
+#
+# FuNLab
+# University of Washington
+#
+# Picks the modulation of each data frame per destination, after the
+# Minstrel algorithm of the Linux wireless stack. For every neighbor and
+# every modulation the MAC reports whether a data frame got its ACK. Every
+# update interval the success counts are folded into an EWMA delivery
+# probability, and the expected goodput of each rate is
+#
+#   prob * payload bytes / (data frame symbols + RTS/CTS/ACK symbols)
+#
+# (the symbol time is the same for all rates, so symbols stand in for
+# airtime). Rates delivering less than 10% are not used.
+#
+# Frames go out at the best rate, except that a sample_ratio fraction tries
+# another rate so the statistics of the others stay current; only rates
+# that could beat the best one are sampled. Retries step down the chain
+# best, second best, most reliable, base rate.
+# /////////////////////////////////////////////////////////////////////////////
+
+import random
+import time
+
+# from current dir
+from pick_bitrate import ofdm_bits_per_symbol, ofdm_frame_symbols
+
+class rate_stats(object):
+    """
+    Delivery statistics of one rate to one neighbor.
+    """
+    def __init__(self):
+        self.attempts = 0 #this interval
+        self.successes = 0
+        self.total_attempts = 0
+        self.total_successes = 0
+        self.prob = None #EWMA delivery probability, None until tried
+        self.tp = 0.0
+
+
+class minstrel(object):
+    """
+    Per-neighbor rate selection.
+    """
+    def __init__(self, rates, occupied_tones, ewma=.75, sample_ratio=.1,
+                 interval=.1, frame_len=1500, ctl_len=5):
+        """
+        @param rates: modulations to choose from; the first is the base rate
+        @param occupied_tones: number of occupied subcarriers
+        @param ewma: weight of the old probability in each update
+        @param sample_ratio: fraction of frames sent at a sampled rate
+        @param interval: seconds between statistics updates
+        @param frame_len: payload bytes the goodput is computed for
+        @param ctl_len: control frame payload bytes (addresses included)
+        """
+        self.base = rates[0]
+        #slowest first
+        self.rates = list(rates)
+        self.rates.sort(key=lambda r: ofdm_bits_per_symbol[r])
+        self.ewma = ewma
+        self.sample_ratio = sample_ratio
+        self.interval = interval
+        self.frame_len = frame_len
+        self.symbols = {}
+        for rate in self.rates:
+            self.symbols[rate] = ofdm_frame_symbols(frame_len, occupied_tones, rate)
+        #RTS, CTS and ACK at the base rate
+        self.overhead = 3 * ofdm_frame_symbols(ctl_len, occupied_tones, self.base)
+        self.neighbors = {} #address -> {rate: rate_stats}
+        self.last_update = {}
+        self.sampled = 0
+        self.frames = 0
+
+    def _stats(self, dest):
+        if dest not in self.neighbors:
+            self.neighbors[dest] = dict([(rate, rate_stats()) for rate in self.rates])
+            self.last_update[dest] = time.time()
+        return self.neighbors[dest]
+
+    def _ideal_tp(self, rate):
+        return float(self.frame_len) / (self.symbols[rate] + self.overhead)
+
+    def _update(self, dest, stats):
+        """
+        Fold this interval's counts into the probabilities.
+        """
+        for rate in self.rates:
+            s = stats[rate]
+            if s.attempts > 0:
+                p = float(s.successes) / s.attempts
+                if s.prob is None:
+                    s.prob = p
+                else:
+                    s.prob = self.ewma * s.prob + (1 - self.ewma) * p
+                s.attempts = 0
+                s.successes = 0
+            if s.prob is None or s.prob < .1:
+                s.tp = 0.0
+            else:
+                s.tp = s.prob * self._ideal_tp(rate)
+        self.last_update[dest] = time.time()
+
+    def _ranked(self, stats):
+        """
+        Rates by expected goodput, best first. Untried and failing rates
+        (no goodput) go last, slowest first.
+        """
+        ranked = list(self.rates)
+        ranked.sort(key=lambda r: (stats[r].tp, -ofdm_bits_per_symbol[r]), reverse=True)
+        return ranked
+
+    def choose(self, dest, retry=0):
+        """
+        Return the modulation for a data frame to dest.
+
+        @param retry: number of times this frame has already failed
+        """
+        stats = self._stats(dest)
+        if time.time() - self.last_update[dest] >= self.interval:
+            self._update(dest, stats)
+        ranked = self._ranked(stats)
+        best = ranked[0]
+        if stats[best].tp == 0:
+            #nothing known yet
+            best = self.base
+        if retry == 0:
+            self.frames += 1
+            if random.random() < self.sample_ratio:
+                #only rates that could do better than the best one now
+                better = [r for r in self.rates
+                          if r != best and self._ideal_tp(r) > stats[best].tp]
+                if len(better) > 0:
+                    self.sampled += 1
+                    return random.choice(better)
+            return best
+        elif retry == 1 and len(ranked) > 1 and stats[ranked[1]].tp > 0:
+            return ranked[1]
+        elif retry == 2:
+            reliable = max(self.rates, key=lambda r: stats[r].prob or 0)
+            if stats[reliable].prob:
+                return reliable
+        return self.base
+
+    def report(self, dest, rate, ok):
+        """
+        Record whether a data frame sent at rate was acknowledged.
+        """
+        s = self._stats(dest)[rate]
+        s.attempts += 1
+        s.total_attempts += 1
+        if ok:
+            s.successes += 1
+            s.total_successes += 1
+
+    def print_stats(self):
+        """
+        Print the per-neighbor statistics.
+        """
+        print "frames: %d, sampled: %d" % (self.frames, self.sampled)
+        for dest in self.neighbors:
+            stats = self.neighbors[dest]
+            for rate in self.rates:
+                s = stats[rate]
+                prob = "-"
+                if s.prob is not None:
+                    prob = "%.2f" % (s.prob,)
+                print "node %d  %-7s prob %5s  goodput %6.2f B/sym  %d/%d acked" % \
+                      (ord(dest), rate, prob, s.tp, s.total_successes, s.total_attempts)
+
+    def add_options(normal, expert):
+        """
+        Adds rate control options to the Options Parser
+        """
+        normal.add_option("", "--rate-control", action="store_true", default=False,
+                          help="pick the data rate per neighbor from --link-rates [default=%default]")
+        expert.add_option("", "--rate-sample", type="eng_float", default=.1,
+                          help="fraction of frames that try another rate [default=%default]")
+        expert.add_option("", "--rate-ewma", type="eng_float", default=.75,
+                          help="weight of the old delivery probability in each update [default=%default]")
+        expert.add_option("", "--rate-interval", type="eng_float", default=.1, metavar="SECS",
+                          help="update the rate statistics every SECS seconds [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
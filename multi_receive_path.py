@@ -0,0 +1,204 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                        Multi-Channel Receive Path
+#
+# FuNLab
+# University of Washington
+#
+# Receives on several channels at once. The USRP captures capture_rate around
+# capture_freq, and every channel of the plan gets a frequency translating
+# filter that moves it to baseband, filters it and decimates it to samp_rate,
+# followed by its own OFDM receiver. Frames are delivered with the channel
+# they came in on, so a node still hears neighbors that are on another
+# channel of the plan.
+#
+# Plan channels can be anywhere, but only those that lie within the captured
+# band are received. When the node moves to a plan channel outside of it,
+# the capture is re-centered on it and the filters are retuned to their
+# channels' new offsets; the flow graph itself never changes.
+# /////////////////////////////////////////////////////////////////////////////
+
+from gnuradio import gr
+from gnuradio import eng_notation
+
+# from current dir
+from receive_path import receive_path
+
+class multi_receive_path(gr.hier_block2):
+    def __init__(self, rx_callback, options, channels):
+        """
+        @param rx_callback: called as rx_callback(ok, payload, metadata); the
+                            metadata's channel is the frame's center frequency
+        @param channels: the channel plan (center frequencies in Hz)
+        """
+        gr.hier_block2.__init__(self, "multi_receive_path",
+                gr.io_signature(1, 1, gr.sizeof_gr_complex), # Input signature
+                gr.io_signature(0, 0, 0)) # Output signature
+
+        self._verbose = options.verbose
+        self.samp_rate = options.samp_rate
+        self.capture_rate = options.capture_rate
+        decim = int(round(self.capture_rate / self.samp_rate))
+        if decim < 1 or abs(decim * self.samp_rate - self.capture_rate) > 1:
+            raise ValueError, "capture rate must be a multiple of the sample rate"
+        self.decim = decim
+
+        self._plan = list(channels)
+        self._rx_callback = rx_callback
+        self._options = options
+
+        self.capture_freq = options.capture_freq
+        if self.capture_freq is None:
+            self.capture_freq = self._default_center(channels)
+
+        # one translating filter and receiver per plan channel, all
+        # connected for good; each passes samp_rate around its channel
+        taps = gr.firdes.low_pass_2(1, self.capture_rate, .45 * self.samp_rate,
+                                    .1 * self.samp_rate, 60)
+        self.filters = {}
+        self._all_rxpaths = {}
+        for freq in self._plan:
+            xlate = gr.freq_xlating_fir_filter_ccc(decim, taps, freq - self.capture_freq,
+                                                   self.capture_rate)
+            self.filters[freq] = xlate
+            self.connect(self, xlate, self._rxpath(freq))
+
+        # the receivers of the plan channels within the capture
+        self.rxpaths = {}
+        self._update_rxpaths()
+        if len(self.rxpaths) == 0:
+            raise ValueError, "no channel of the plan within --capture-rate around %s" % \
+                  (eng_notation.num_to_str(self.capture_freq),)
+
+        # the channel carrier sense looks at
+        self.current = None
+        self.set_channel(self.channels()[0])
+
+        if self._verbose:
+            self._print_verbage()
+
+    def _default_center(self, channels):
+        """
+        Pick the plan channel as capture center that puts the most plan
+        channels within the capture.
+        """
+        best = channels[0]
+        best_count = 0
+        for center in channels:
+            count = len(self._covered(center))
+            if count > best_count:
+                best = center
+                best_count = count
+        return best
+
+    def _covered(self, center):
+        """
+        Return the plan channels within the capture around center.
+        """
+        return [freq for freq in self._plan if self._within(freq, center)]
+
+    def _within(self, freq, center):
+        #the whole channel has to be inside the capture filter
+        return abs(freq - center) + self.samp_rate / 2.0 <= self.capture_rate / 2.0
+
+    def _update_rxpaths(self):
+        self.rxpaths = {}
+        for freq in self._covered(self.capture_freq):
+            self.rxpaths[freq] = self._all_rxpaths[freq]
+
+    def _rxpath(self, freq):
+        if freq not in self._all_rxpaths:
+            self._all_rxpaths[freq] = receive_path(self._rx_callback, self._options,
+                                                   with_metadata=True, channel=freq,
+                                                   samp_rate=self.samp_rate)
+        return self._all_rxpaths[freq]
+
+    def recenter(self, freq):
+        """
+        Move the capture so freq is received, keeping as many other plan
+        channels within it as possible. The caller retunes the source to
+        the new capture_freq.
+        """
+        if freq in self.rxpaths:
+            return
+        best = freq
+        best_count = 0
+        for center in self._plan + [freq]:
+            if not self._within(freq, center):
+                continue
+            count = len(self._covered(center))
+            if count > best_count:
+                best = center
+                best_count = count
+        self.capture_freq = best
+        for (f, xlate) in self.filters.items():
+            xlate.set_center_freq(f - best)
+        self._update_rxpaths()
+        if self._verbose:
+            self._print_verbage()
+
+    def channels(self):
+        """
+        Return the plan channels that are received.
+        """
+        c = self.rxpaths.keys()
+        c.sort()
+        return c
+
+    def set_channel(self, freq):
+        """
+        Make freq the channel carrier sense looks at. freq has to be
+        received (see recenter).
+        """
+        if freq not in self.rxpaths:
+            raise ValueError, "%s is not received around %s" % \
+                  (eng_notation.num_to_str(freq), eng_notation.num_to_str(self.capture_freq))
+        self.current = self.rxpaths[freq]
+
+    def carrier_sensed(self):
+        """
+        Return True if we think carrier is present on the current channel.
+        """
+        return self.current.carrier_sensed()
+
+    def carrier_threshold(self):
+        """
+        Return current setting in dB.
+        """
+        return self.current.carrier_threshold()
+
+    def set_carrier_threshold(self, threshold_in_db):
+        """
+        Set carrier threshold on all channels.
+
+        @param threshold_in_db: set detection threshold
+        @type threshold_in_db:  float (dB)
+        """
+        for rxpath in self.rxpaths.values():
+            rxpath.set_carrier_threshold(threshold_in_db)
+
+    def add_options(normal, expert):
+        """
+        Adds multi-channel receive options to the Options Parser
+        """
+        normal.add_option("", "--multi-rx", action="store_true", default=False,
+                          help="receive all plan channels around --capture-freq at once [default=%default]")
+        expert.add_option("", "--capture-rate", type="eng_float", default=4e6,
+                          help="sample rate of the multi-channel capture, a multiple of the "
+                          "sample rate [default=%default]")
+        expert.add_option("", "--capture-freq", type="eng_float", default=None, metavar="FREQ",
+                          help="center of the multi-channel capture, picked from the plan if "
+                          "not given [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
+
+    def _print_verbage(self):
+        """
+        Prints information about the multi-channel receive path
+        """
+        print
+        print "capture freq     %s" % (eng_notation.num_to_str(self.capture_freq),)
+        print "capture rate     %s" % (eng_notation.num_to_str(self.capture_rate),)
+        print "decimation       %d" % (self.decim,)
+        for freq in self.channels():
+            print "rx channel       %s (offset %s)" % (eng_notation.num_to_str(freq),
+                                                      eng_notation.num_to_str(freq - self.capture_freq))
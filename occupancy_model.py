@@ -0,0 +1,147 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                        Primary Occupancy Prediction
+#
+# FuNLab
+# University of Washington
+#
+# Each channel is modelled as a two state (busy/idle) process. The lengths of
+# the busy and idle periods seen in the sensing results are learned online,
+# and the expected time a channel will stay idle is predicted from them. The
+# channel selection can then prefer the channel that is likely to stay free
+# the longest, rather than one the primary is about to come back to.
+#
+# The remaining idle time is the empirical mean residual life: the average of
+# (d - elapsed) over the learned idle periods d that are longer than the time
+# the channel has already been idle. For exponential periods this is just the
+# mean, but it also works for the fixed schedules simulated_primary uses.
+# /////////////////////////////////////////////////////////////////////////////
+
+class channel_model(object):
+    """
+    Learned busy/idle period lengths of one channel.
+    """
+    def __init__(self, prior_idle, history=32):
+        """
+        @param prior_idle: idle time (s) predicted before anything is learned
+        @param history: number of periods of each kind to remember
+        """
+        self.prior_idle = prior_idle
+        self.history = history
+        self.state = None #1 busy, 0 idle, None unknown
+        self.since = None #when the current period started
+        self.last_seen = None
+        self.periods = {0: [], 1: []}
+
+    def update(self, timestamp, busy):
+        """
+        Add a sensing result.
+
+        @param busy: True if a primary was detected
+        """
+        busy = int(bool(busy))
+        if self.state is None:
+            #we don't know when this period started, so it isn't learned
+            self.state = busy
+            self.since = None
+        elif busy != self.state:
+            #the change happened somewhere since we last looked
+            end = (self.last_seen + timestamp) / 2.0
+            if self.since is not None:
+                self._learn(self.state, end - self.since)
+            self.since = end
+            self.state = busy
+        self.last_seen = timestamp
+
+    def _learn(self, state, length):
+        p = self.periods[state]
+        p.append(length)
+        if len(p) > self.history:
+            del p[0]
+
+    def mean_period(self, state):
+        p = self.periods[state]
+        if len(p) == 0:
+            return None
+        return sum(p) / len(p)
+
+    def predicted_idle(self, now):
+        """
+        Expected time (s) from now that the channel stays idle, 0 if it is
+        busy.
+        """
+        if self.state == 1:
+            return 0.0
+        idle = self.periods[0]
+        if len(idle) == 0:
+            return self.prior_idle
+        elapsed = 0.0
+        if self.since is not None:
+            elapsed = now - self.since
+        longer = [d - elapsed for d in idle if d > elapsed]
+        if len(longer) == 0:
+            #idle longer than ever seen before, nothing says it will end soon
+            return max(idle)
+        return sum(longer) / len(longer)
+
+
+class occupancy_model(object):
+    """
+    Per-channel occupancy models, keyed by center frequency.
+    """
+    def __init__(self, prior_idle=10.0):
+        self.prior_idle = prior_idle
+        self.channels = {}
+
+    def _model(self, freq):
+        if freq not in self.channels:
+            self.channels[freq] = channel_model(self.prior_idle)
+        return self.channels[freq]
+
+    def update(self, freq, timestamp, busy):
+        """
+        Add a sensing result for a channel.
+        """
+        self._model(freq).update(timestamp, busy)
+
+    def predicted_idle(self, freq, now):
+        return self._model(freq).predicted_idle(now)
+
+    def best_channel(self, freqs, now, exclude=None):
+        """
+        Return the channel in freqs with the longest predicted idle time, or
+        None if there is none to choose from.
+
+        @param exclude: channel not to pick (the one being left), matched to
+                        the kHz like the sense cache
+        """
+        best = None
+        best_idle = -1
+        for freq in freqs:
+            if exclude is not None and int(round(freq / 1e3)) == int(round(exclude / 1e3)):
+                continue
+            idle = self.predicted_idle(freq, now)
+            if idle > best_idle:
+                best = freq
+                best_idle = idle
+        return best
+
+    def report(self):
+        """
+        Print the learned period lengths of each channel.
+        """
+        freqs = self.channels.keys()
+        freqs.sort()
+        for freq in freqs:
+            m = self.channels[freq]
+            print "%12.0f  busy %s s  idle %s s" % (freq, m.mean_period(1), m.mean_period(0))
+
+    def add_options(normal, expert):
+        """
+        Adds occupancy prediction options to the Options Parser
+        """
+        normal.add_option("", "--predict-channels", action="store_true", default=False,
+                          help="choose the channel with the longest predicted idle time [default=%default]")
+        expert.add_option("", "--prior-idle", type="eng_float", default=10, metavar="SECS",
+                          help="idle time assumed for a channel with no history [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
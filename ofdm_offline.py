@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+# /////////////////////////////////////////////////////////////////////////////
+#                          Offline OFDM Modem
+#
+# FuNLab
+# University of Washington
+#
+# A NumPy implementation of the ofdm_mod/ofdm_demod framing used by
+# transmit_path and receive_path, for decoding recorded captures without
+# streaming them through a flow graph.
+#
+# The framing is the one of blks2.ofdm_mod: a packet (4 byte header with
+# the length twice, whitened payload + CRC32, 0x55 trailer) is cut into
+# nbits groups, LSB first, each picking a constellation point for the next
+# subcarrier of the map; a known preamble symbol goes in front, then IFFT,
+# cyclic prefix and 1/sqrt(fft_length) scaling.
+#
+# The parameters that are internal to GNU Radio (the preamble, the
+# subcarrier map, the constellation and the whitening mask) are taken from
+# a frame modulated by the installed ofdm_mod once ("calibration"), and the
+# calibration checks that this module frames and decodes that frame the
+# same way. A calibration can be saved and used where GNU Radio is not
+# installed.
+#
+# The receiver works on a block of samples at a time: Schmidl-Cox metric
+# for every sample with cumulative sums, fine frequency offset from its
+# phase, integer offset from the preamble, channel estimate from the
+# preamble interpolated over the data carriers, per-symbol common phase
+# tracking, nearest point slicing. All frames found in a block are
+# demodulated together as arrays.
+#
+# Capture files (gr_complex samples, as written by gr.file_sink) are read
+# through numpy.memmap in overlapping chunks that are decoded by a pool of
+# worker processes.
+#
+# stream_decoder runs the same receiver on samples as they arrive, with
+# several link rates at once; receive_path uses it for live frames.
+# /////////////////////////////////////////////////////////////////////////////
+
+from optparse import OptionParser
+
+import math
+import struct
+import sys
+import time
+import zlib
+import multiprocessing
+import numpy
+
+HEADER_LEN = 4
+TRAILER = "\x55"
+MAX_PKT_LEN = 4095
+
+# /////////////////////////////////////////////////////////////////////////////
+#                               calibration
+# /////////////////////////////////////////////////////////////////////////////
+
+class _mod_options(object):
+    def __init__(self, modulation, fft_length, occupied_tones, cp_length):
+        self.modulation = modulation
+        self.fft_length = fft_length
+        self.occupied_tones = occupied_tones
+        self.cp_length = cp_length
+        self.verbose = False
+        self.log = False
+
+def _to_freq(symbols, fft_length):
+    """
+    FFT of time domain symbols (last axis), DC in the middle.
+    """
+    return numpy.fft.fftshift(numpy.fft.fft(symbols, axis=-1), axes=-1) / math.sqrt(fft_length)
+
+def _to_time(bins, fft_length):
+    return numpy.fft.ifft(numpy.fft.ifftshift(bins, axes=-1), axis=-1) * math.sqrt(fft_length)
+
+def calibrate(modulation, fft_length, occupied_tones, cp_length):
+    """
+    Find the framing parameters of the installed GNU Radio's ofdm_mod.
+
+    @return: calibration dict for ofdm_modem
+    """
+    from gnuradio import gr, blks2
+    from gnuradio import ofdm_packet_utils
+    from gnuradio.blks2impl import psk, qam
+
+    options = _mod_options(modulation, fft_length, occupied_tones, cp_length)
+    payload = "".join([chr((7*i) & 0xff) for i in range(200)])
+    tb = gr.top_block()
+    mod = blks2.ofdm_mod(options, msgq_limit=2, pad_for_usrp=False)
+    sink = gr.vector_sink_c()
+    tb.connect(mod, sink)
+    mod.send_pkt(payload)
+    mod.send_pkt(eof=True)
+    tb.run()
+    samples = numpy.array(sink.data(), dtype=numpy.complex128)
+
+    symbol_len = fft_length + cp_length
+    nsym = len(samples) // symbol_len
+    symbols = _to_freq(samples[:nsym*symbol_len].reshape(nsym, symbol_len)[:, cp_length:],
+                       fft_length)
+    data = numpy.abs(symbols[1])
+    arity = {"bpsk": 2, "qpsk": 4, "8psk": 8, "qam8": 8, "qam16": 16,
+             "qam64": 64, "qam256": 256}[modulation]
+    #the rotation ofdm_mod gives its constellations
+    rot = 1
+    if modulation == "qpsk":
+        rot = (0.707+0.707j)
+    if modulation.find("psk") >= 0:
+        points = [pt * rot for pt in psk.constellation[arity]]
+    else:
+        points = [pt * rot for pt in qam.constellation[arity]]
+
+    cal = {"modulation": modulation,
+           "fft_length": fft_length,
+           "cp_length": cp_length,
+           "known": symbols[0],
+           "data_bins": numpy.nonzero(data > 1e-3 * data.max())[0],
+           "points": numpy.array(points, dtype=numpy.complex128),
+           "mask": numpy.array(ofdm_packet_utils.random_mask_tuple, dtype=numpy.uint8)}
+
+    modem = ofdm_modem(cal)
+    pkt = ofdm_packet_utils.make_packet(payload, 1, 1, False, whitening=True)
+    if modem.frame_bytes(payload) != pkt:
+        raise ValueError, "packet framing doesn't match this GNU Radio's ofdm_packet_utils"
+    frames = modem.demodulate(samples)
+    if len(frames) != 1 or not frames[0][1] or frames[0][2] != payload:
+        raise ValueError, "can't demodulate this GNU Radio's ofdm_mod output"
+    return cal
+
+def save_calibration(path, cal):
+    numpy.savez(path, **cal)
+
+def load_calibration(path):
+    f = numpy.load(path)
+    cal = {}
+    for key in f.files:
+        cal[key] = f[key]
+    cal["modulation"] = str(cal["modulation"])
+    cal["fft_length"] = int(cal["fft_length"])
+    cal["cp_length"] = int(cal["cp_length"])
+    return cal
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                  modem
+# /////////////////////////////////////////////////////////////////////////////
+
+class ofdm_modem(object):
+    """
+    Batch modulator and demodulator for one calibration.
+    """
+    def __init__(self, cal, block_elements=1 << 22):
+        """
+        @param cal: dict from calibrate or load_calibration
+        @param block_elements: bound on the temporary arrays of the slicer
+        """
+        self.modulation = cal["modulation"]
+        self.fft_length = n = cal["fft_length"]
+        self.cp_length = cal["cp_length"]
+        self.symbol_len = n + self.cp_length
+        self.known = numpy.asarray(cal["known"], dtype=numpy.complex128)
+        self.data_bins = numpy.asarray(cal["data_bins"], dtype=numpy.int64)
+        self.points = numpy.asarray(cal["points"], dtype=numpy.complex128)
+        self.mask = numpy.asarray(cal["mask"], dtype=numpy.uint8)
+        self.nbits = int(round(math.log(len(self.points), 2)))
+        self.ncarriers = len(self.data_bins)
+        self.block_elements = block_elements
+
+        #preamble carriers, and how the channel estimate is interpolated
+        #from them to the data carriers
+        self.known_bins = numpy.nonzero(numpy.abs(self.known) > 1e-6)[0]
+        kb = self.known_bins
+        i = numpy.clip(numpy.searchsorted(kb, self.data_bins), 1, len(kb) - 1)
+        lo = kb[i - 1]
+        hi = kb[i]
+        self._interp_lo = i - 1
+        self._interp_hi = i
+        self._interp_w = numpy.clip((self.data_bins - lo) / (hi - lo).astype(numpy.float64), 0.0, 1.0)
+        self.preamble = _to_time(self.known, n)
+
+    # ----------------------------------------------------------------- tx ---
+
+    def frame_bytes(self, payload, whitener_offset=0):
+        """
+        The packet ofdm_mod's mapper gets for a payload.
+        """
+        crc = struct.pack("!I", zlib.crc32(payload) & 0xffffffff)
+        body = numpy.frombuffer(payload + crc, dtype=numpy.uint8)
+        body = body ^ self.mask[whitener_offset:whitener_offset + len(body)]
+        val = ((whitener_offset & 0xf) << 12) | (len(body) & 0x0fff)
+        return struct.pack("!HH", val, val) + body.tostring() + TRAILER
+
+    def _values(self, data):
+        """
+        Split bytes into nbits constellation indexes, LSB first. A last
+        partial group is dropped, as the mapper does.
+        """
+        b = numpy.frombuffer(data, dtype=numpy.uint8)
+        bits = ((b[:, None] >> numpy.arange(8)) & 1).reshape(-1)
+        nvals = len(bits) // self.nbits
+        bits = bits[:nvals * self.nbits].reshape(nvals, self.nbits)
+        return (bits << numpy.arange(self.nbits)).sum(axis=1)
+
+    def _bytes(self, values):
+        """
+        Inverse of _values on the last axis.
+        """
+        bits = (values[..., None] >> numpy.arange(self.nbits)) & 1
+        bits = bits.reshape(values.shape[:-1] + (-1,))
+        nbytes = bits.shape[-1] // 8
+        bits = bits[..., :nbytes * 8].reshape(values.shape[:-1] + (nbytes, 8))
+        return (bits << numpy.arange(8)).sum(axis=-1).astype(numpy.uint8)
+
+    def modulate(self, payloads, gap=0, seed=None):
+        """
+        Return the samples of a burst of frames, gap zero samples apart.
+        """
+        rng = numpy.random.RandomState(seed)
+        out = []
+        for payload in payloads:
+            values = self._values(self.frame_bytes(payload))
+            nsym = -(-len(values) // self.ncarriers)
+            #the rest of the last symbol is random, as in the mapper
+            fill = rng.randint(0, len(self.points), nsym * self.ncarriers - len(values))
+            values = numpy.concatenate((values, fill)).reshape(nsym, self.ncarriers)
+            bins = numpy.zeros((nsym + 1, self.fft_length), dtype=numpy.complex128)
+            bins[0] = self.known
+            bins[1:, self.data_bins] = self.points[values]
+            symbols = _to_time(bins, self.fft_length)
+            symbols = numpy.hstack((symbols[:, -self.cp_length:], symbols))
+            out.append(symbols.reshape(-1))
+            if gap:
+                out.append(numpy.zeros(gap, dtype=numpy.complex128))
+        if len(out) == 0:
+            return numpy.zeros(0, dtype=numpy.complex64)
+        return numpy.concatenate(out).astype(numpy.complex64)
+
+    # ----------------------------------------------------------------- rx ---
+
+    def frame_symbols(self, pkt_len):
+        """
+        Data symbols of a frame whose header says pkt_len.
+        """
+        nvals = 8 * (HEADER_LEN + pkt_len + len(TRAILER)) // self.nbits
+        return -(-nvals // self.ncarriers)
+
+    def max_frame_len(self):
+        """
+        Samples of the longest possible frame.
+        """
+        return (1 + self.frame_symbols(MAX_PKT_LEN)) * self.symbol_len
+
+    def detect(self, r, threshold=.7):
+        """
+        Find preambles with the Schmidl-Cox metric.
+
+        @return: (fft start of the preamble, fine offset in cycles/sample)
+                 arrays
+        """
+        n = self.fft_length
+        h = n // 2
+        if len(r) < n + 1:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        prod = numpy.conj(r[:-h]) * r[h:]
+        cs = numpy.concatenate(([0], numpy.cumsum(prod)))
+        p = cs[h:] - cs[:-h]
+        ce = numpy.concatenate(([0], numpy.cumsum(numpy.abs(r)**2)))
+        e = ce[n:] - ce[h:len(ce) - h]
+        metric = numpy.abs(p)**2 / (e**2 + 1e-30)
+
+        #plateaus (one per preamble, cp_length long)
+        above = numpy.concatenate(([0], (metric > threshold).astype(numpy.int8), [0]))
+        edges = numpy.diff(above)
+        starts = numpy.nonzero(edges == 1)[0]
+        ends = numpy.nonzero(edges == -1)[0]
+        keep = (ends - starts) >= max(2, self.cp_length // 4)
+        starts = starts[keep]
+        ends = ends[keep]
+        if len(starts) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+
+        #centroid of each plateau
+        idx = numpy.arange(len(metric))
+        cm = numpy.concatenate(([0], numpy.cumsum(metric)))
+        cmi = numpy.concatenate(([0], numpy.cumsum(metric * idx)))
+        center = (cmi[ends] - cmi[starts]) / (cm[ends] - cm[starts])
+        c = numpy.round(center).astype(numpy.int64)
+        fine = numpy.angle(p[c]) / (math.pi * n)
+        #the plateau runs over the cyclic prefix; start the FFT a bit before
+        #its end so small timing errors stay inside the prefix
+        fft_start = numpy.round(center + self.cp_length / 2.0).astype(numpy.int64) \
+                    - self.cp_length // 8
+        return fft_start, fine
+
+    def _gather(self, r, fft_start, cfo, nsym):
+        """
+        FFT nsym + 1 symbols (preamble first) of every frame, with the
+        frequency offset removed.
+        """
+        pos = fft_start[:, None] + self.symbol_len * numpy.arange(nsym + 1)[None, :]
+        idx = pos[:, :, None] + numpy.arange(self.fft_length)[None, None, :]
+        idx = numpy.minimum(idx, len(r) - 1)
+        rel = idx - fft_start[:, None, None]
+        x = r[idx] * numpy.exp(-2j * math.pi * cfo[:, None, None] * rel)
+        return _to_freq(x, self.fft_length)
+
+    def _coarse(self, r, fft_start, fine, search=4):
+        """
+        Integer frequency offset (in subcarriers) from the preamble. Products
+        of neighboring preamble carriers are compared, which takes out the
+        phase slope of the timing offset.
+        """
+        y = self._gather(r, fft_start, fine, 0)[:, 0, :]
+        kb = self.known_bins
+        ref = self.known[kb[:-1]] * numpy.conj(self.known[kb[1:]])
+        shifts = numpy.arange(-search, search + 1)
+        idx = numpy.clip(kb[None, :] + shifts[:, None], 0, self.fft_length - 1)
+        yk = y[:, idx]
+        diff = yk[:, :, :-1] * numpy.conj(yk[:, :, 1:])
+        corr = numpy.abs((diff * numpy.conj(ref)[None, None, :]).sum(axis=-1))
+        return shifts[numpy.argmax(corr, axis=1)]
+
+    def _slice(self, y):
+        """
+        Nearest constellation point of every element.
+        """
+        flat = y.reshape(-1)
+        out = numpy.empty(len(flat), dtype=numpy.int64)
+        step = max(1, self.block_elements // len(self.points))
+        for i in range(0, len(flat), step):
+            d = numpy.abs(flat[i:i + step, None] - self.points[None, :])
+            out[i:i + step] = numpy.argmin(d, axis=1)
+        return out.reshape(y.shape)
+
+    def _equalize(self, r, fft_start, cfo, nsym):
+        """
+        @return: (constellation indexes, equalized symbols), both
+                 (frames, nsym, carriers)
+        """
+        x = self._gather(r, fft_start, cfo, nsym)
+        kb = self.known_bins
+        h = x[:, 0, kb] / self.known[kb][None, :]
+        #take out the phase slope of the timing offset before interpolating
+        step = numpy.diff(kb)
+        slope = numpy.angle((h[:, 1:] * numpy.conj(h[:, :-1])).sum(axis=1)) / step.min()
+        h = h * numpy.exp(-1j * slope[:, None] * kb[None, :])
+        w = self._interp_w[None, :]
+        h = h[:, self._interp_lo] * (1 - w) + h[:, self._interp_hi] * w
+        h = h * numpy.exp(1j * slope[:, None] * self.data_bins[None, :])
+        y = x[:, 1:, :][:, :, self.data_bins] / h[:, None, :]
+        #common phase error of each symbol, decision directed
+        d = self.points[self._slice(y)]
+        phase = numpy.angle((y * numpy.conj(d)).sum(axis=-1))
+        y = y * numpy.exp(-1j * phase)[:, :, None]
+        return self._slice(y), y
+
+    def headers(self, r, fft_start, cfo):
+        """
+        Slice the headers of frames.
+
+        @return: (packet length, whitener offset, data symbols, header ok)
+                 arrays
+        """
+        values, y = self._equalize(r, fft_start, cfo, self.header_symbols())
+        hdr = self._bytes(values.reshape(len(fft_start), -1))[:, :HEADER_LEN].astype(numpy.int64)
+        val1 = (hdr[:, 0] << 8) | hdr[:, 1]
+        val2 = (hdr[:, 2] << 8) | hdr[:, 3]
+        pkt_len = val1 & 0x0fff
+        offset = val1 >> 12
+        nsym = numpy.array([self.frame_symbols(L) for L in pkt_len], dtype=numpy.int64)
+        return pkt_len, offset, nsym, (val1 == val2) & (pkt_len > 4)
+
+    def header_symbols(self):
+        """
+        Data symbols the header is sliced from.
+        """
+        return -(-(8 * HEADER_LEN // self.nbits + 1) // self.ncarriers)
+
+    def decode(self, r, fft_start, cfo, pkt_len, offset, nsym):
+        """
+        Demodulate whole frames whose headers were sliced.
+
+        @return: list of (ok, payload, SNR in dB) per frame
+        """
+        values, y = self._equalize(r, fft_start, cfo, nsym.max())
+        data = self._bytes(values.reshape(len(fft_start), -1))
+        d = self.points[values]
+        err = numpy.abs(y - d)**2
+        sig = numpy.abs(d)**2
+        valid = numpy.arange(values.shape[1])[None, :] < nsym[:, None]
+        snr = 10 * numpy.log10((sig.sum(axis=-1) * valid).sum(axis=1) /
+                               ((err.sum(axis=-1) * valid).sum(axis=1) + 1e-30))
+        results = []
+        for j in range(len(fft_start)):
+            L = pkt_len[j]
+            o = offset[j]
+            body = data[j, HEADER_LEN:HEADER_LEN + L] ^ self.mask[o:o + L]
+            body = body.tostring()
+            payload = body[:-4]
+            ok = struct.unpack("!I", body[-4:])[0] == (zlib.crc32(payload) & 0xffffffff)
+            results.append((ok, payload, float(snr[j])))
+        return results
+
+    def demodulate(self, r, threshold=.7):
+        """
+        Find and decode all frames in a block of samples.
+
+        @return: list of (preamble start, ok, payload, offset in subcarriers,
+                 SNR in dB, data symbols), in order
+        """
+        r = numpy.asarray(r, dtype=numpy.complex128)
+        fft_start, fine = self.detect(r, threshold)
+        if len(fft_start) == 0:
+            return []
+        cfo = fine + self._coarse(r, fft_start, fine) / float(self.fft_length)
+
+        #pass 1: the headers
+        pkt_len, offset, nsym, good = self.headers(r, fft_start, cfo)
+        end = fft_start + nsym * self.symbol_len + self.fft_length
+        frames = numpy.nonzero(good & (end <= len(r)))[0]
+        if len(frames) == 0:
+            return []
+
+        #pass 2: whole frames
+        decoded = self.decode(r, fft_start[frames], cfo[frames], pkt_len[frames],
+                              offset[frames], nsym[frames])
+
+        results = []
+        last_end = -1
+        for j, f in enumerate(frames):
+            start = fft_start[f] - self.cp_length + self.cp_length // 8
+            if start < last_end:
+                #a plateau inside a frame already decoded
+                continue
+            ok, payload, snr = decoded[j]
+            results.append((int(start), ok, payload, float(cfo[f] * self.fft_length),
+                            snr, int(nsym[f])))
+            last_end = end[f]
+        return results
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              stream decoder
+# /////////////////////////////////////////////////////////////////////////////
+
+class stream_decoder(object):
+    """
+    Decodes frames out of a stream of samples handed over as they come in,
+    for the receive path. The link rates share the preamble and the
+    subcarrier map, so a frame is found and equalized once; its header is
+    sliced with every rate's constellation and the rate whose header checks
+    out decodes the rest of it.
+    """
+    def __init__(self, cals, threshold=.7):
+        """
+        @param cals: calibrations, one per link rate
+        @param threshold: Schmidl-Cox detection threshold (0..1)
+        """
+        self.modems = [ofdm_modem(cal) for cal in cals]
+        m = self.modems[0]
+        self.fft_length = m.fft_length
+        self.cp_length = m.cp_length
+        self.symbol_len = m.symbol_len
+        self.threshold = threshold
+        self.max_frame_len = max([mod.max_frame_len() for mod in self.modems])
+        self._hsym = max([mod.header_symbols() for mod in self.modems])
+        #samples kept at the end of a push when nothing is pending, so a
+        #preamble that straddles two pushes is found in the second
+        self._tail = (self._hsym + 2) * self.symbol_len + self.fft_length
+        self._buf = numpy.zeros(0, dtype=numpy.complex128)
+        self._base = 0 # stream index of _buf[0]
+        self._done = 0 # stream index up to which frames are decided
+
+    def stream_end(self):
+        """
+        Stream index after the last sample pushed.
+        """
+        return self._base + len(self._buf)
+
+    def push(self, samples):
+        """
+        Add the next samples of the stream.
+
+        @return: list of the frames now complete, in order, as (stream index
+                 of the preamble, stream index after the frame, ok, payload,
+                 modulation, offset in subcarriers, SNR in dB, data symbols)
+        """
+        samples = numpy.asarray(samples, dtype=numpy.complex128)
+        self._buf = numpy.concatenate((self._buf, samples))
+        r = self._buf
+        n = len(r)
+        m = self.modems[0]
+        results = []
+        keep = n - self._tail
+        fft_start, fine = m.detect(r, self.threshold)
+        start = fft_start - self.cp_length + self.cp_length // 8
+        #a preamble near the end of the block may not be whole yet, and
+        #its header not in
+        ready = fft_start + (self._hsym + 1) * self.symbol_len + self.fft_length <= n
+        if not ready.all():
+            keep = min(keep, start[~ready].min() - self.symbol_len)
+        fft_start = fft_start[ready]
+        fine = fine[ready]
+        start = start[ready]
+        later = fft_start + self._base >= self._done
+        fft_start = fft_start[later]
+        fine = fine[later]
+        start = start[later]
+        if len(fft_start) > 0:
+            cfo = fine + m._coarse(r, fft_start, fine) / float(self.fft_length)
+            rate = -numpy.ones(len(fft_start), dtype=numpy.int64)
+            pkt_len = numpy.zeros(len(fft_start), dtype=numpy.int64)
+            offset = numpy.zeros(len(fft_start), dtype=numpy.int64)
+            nsym = numpy.zeros(len(fft_start), dtype=numpy.int64)
+            for k, mod in enumerate(self.modems):
+                todo = numpy.nonzero(rate < 0)[0]
+                if len(todo) == 0:
+                    break
+                L, o, ns, good = mod.headers(r, fft_start[todo], cfo[todo])
+                hit = todo[good]
+                rate[hit] = k
+                pkt_len[hit] = L[good]
+                offset[hit] = o[good]
+                nsym[hit] = ns[good]
+            end = fft_start + nsym * self.symbol_len + self.fft_length
+            decoded = {}
+            for k, mod in enumerate(self.modems):
+                f = numpy.nonzero((rate == k) & (end <= n))[0]
+                if len(f) > 0:
+                    for j, d in zip(f, mod.decode(r, fft_start[f], cfo[f], pkt_len[f],
+                                                  offset[f], nsym[f])):
+                        decoded[j] = d
+            last_end = self._done - self._base
+            for j in range(len(fft_start)):
+                if fft_start[j] < last_end or rate[j] < 0:
+                    #inside a frame already decoded, or no header
+                    continue
+                if end[j] > n:
+                    #the rest of the frame is still to come; keep its
+                    #whole plateau for the next push
+                    keep = min(keep, start[j] - self.symbol_len)
+                    break
+                ok, payload, snr = decoded[j]
+                mod = self.modems[rate[j]]
+                results.append((int(start[j] + self._base), int(end[j] + self._base), ok,
+                                payload, mod.modulation, float(cfo[j] * self.fft_length),
+                                snr, int(nsym[j])))
+                last_end = end[j]
+                self._done = int(end[j] + self._base)
+        #don't hold on to more than one frame
+        keep = max(0, keep, n - self.max_frame_len - self._tail)
+        self._buf = r[keep:]
+        self._base += keep
+        return results
+
+def _decode_chunk(args):
+    path, cal, start, length, overlap, threshold = args
+    samples = numpy.memmap(path, dtype=numpy.complex64, mode='r')
+    r = numpy.array(samples[start:start + length + overlap], dtype=numpy.complex128)
+    frames = ofdm_modem(cal).demodulate(r, threshold)
+    #frames starting in the overlap belong to the next chunk
+    return [(f[0] + start,) + f[1:] for f in frames if f[0] < length]
+
+def decode_file(path, cal, jobs=1, chunk=1 << 20, threshold=.7):
+    """
+    Generate the frames of a capture file of gr_complex samples, in order.
+    """
+    nsamples = len(numpy.memmap(path, dtype=numpy.complex64, mode='r'))
+    overlap = ofdm_modem(cal).max_frame_len()
+    args = [(path, cal, start, chunk, overlap, threshold)
+            for start in range(0, nsamples, chunk)]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(_decode_chunk, args)
+    else:
+        pool = None
+        results = map(_decode_chunk, args)
+    for frames in results:
+        for f in frames:
+            yield f
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                   main
+# /////////////////////////////////////////////////////////////////////////////
+
+def main():
+    parser = OptionParser(usage="%prog [options] CAPTURE")
+    parser.add_option("-m", "--modulation", type="choice", default="bpsk",
+                      choices=["bpsk", "qpsk", "8psk", "qam8", "qam16", "qam64", "qam256"],
+                      help="modulation of the frames [default=%default]")
+    parser.add_option("", "--fft-length", type="int", default=512,
+                      help="FFT length [default=%default]")
+    parser.add_option("", "--occupied-tones", type="int", default=200,
+                      help="number of occupied subcarriers [default=%default]")
+    parser.add_option("", "--cp-length", type="int", default=128,
+                      help="cyclic prefix length [default=%default]")
+    parser.add_option("", "--calibration", type="string", default=None, metavar="FILE",
+                      help="use a saved calibration instead of asking GNU Radio [default=%default]")
+    parser.add_option("", "--save-calibration", type="string", default=None, metavar="FILE",
+                      help="save the calibration to FILE (.npz) [default=%default]")
+    parser.add_option("-j", "--jobs", type="int", default=multiprocessing.cpu_count(),
+                      help="worker processes [default=%default]")
+    parser.add_option("", "--chunk", type="int", default=1 << 20,
+                      help="samples per work unit [default=%default]")
+    parser.add_option("", "--threshold", type="float", default=.7,
+                      help="Schmidl-Cox detection threshold (0..1) [default=%default]")
+    parser.add_option("-r", "--samp-rate", type="float", default=None,
+                      help="sample rate of the capture, for times [default=%default]")
+    parser.add_option("", "--payloads", type="string", default=None, metavar="FILE",
+                      help="write the good payloads to FILE, each after a 2 byte length [default=%default]")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+                      help="only print the summary")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        raise SystemExit, 1
+
+    if options.calibration is not None:
+        cal = load_calibration(options.calibration)
+    else:
+        cal = calibrate(options.modulation, options.fft_length, options.occupied_tones,
+                        options.cp_length)
+    if options.save_calibration is not None:
+        save_calibration(options.save_calibration, cal)
+
+    out = None
+    if options.payloads is not None:
+        out = open(options.payloads, 'wb')
+
+    t0 = time.time()
+    nframes = 0
+    nok = 0
+    for (start, ok, payload, cfo, snr, nsym) in decode_file(args[0], cal, options.jobs,
+                                                            options.chunk, options.threshold):
+        nframes += 1
+        if ok:
+            nok += 1
+            if out is not None:
+                out.write(struct.pack("!H", len(payload)) + payload)
+        if not options.quiet:
+            when = ""
+            if options.samp_rate:
+                when = "%12.6f" % (start / options.samp_rate,)
+            print "%12d %s ok: %-5r len: %4d  cfo: %6.3f  snr: %5.1f dB" % \
+                  (start, when, ok, len(payload), cfo, snr)
+    elapsed = time.time() - t0
+    if out is not None:
+        out.close()
+
+    nsamples = len(numpy.memmap(args[0], dtype=numpy.complex64, mode='r'))
+    print
+    print "frames: %d, ok: %d, %d samples in %.2f s" % (nframes, nok, nsamples, elapsed)
+    if options.samp_rate and elapsed > 0:
+        print "%.1fx real time" % (nsamples / options.samp_rate / elapsed,)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
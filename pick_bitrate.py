@@ -141,3 +141,33 @@ def pick_rx_bitrate(bitrate, bits_per_symbol, samples_per_symbol,
     """
     return _pick_bitrate(bitrate, bits_per_symbol, samples_per_symbol,
                          decim_rate, converter_rate, _gen_rx_info)
+
+# ---------------------------------------------------------------------------------------
+
+# bits carried per subcarrier by the ofdm_mod/ofdm_demod modulations
+ofdm_bits_per_symbol = {'bpsk': 1, 'qpsk': 2, '8psk': 3, 'qam8': 3, 'qam16': 4,
+                        'qam64': 6, 'qam256': 8}
+
+def ofdm_frame_symbols(payload_len, occupied_tones, modulation):
+    """
+    Number of OFDM symbols ofdm_mod makes out of a payload: the preamble
+    plus the packet with its 4 byte header, 4 byte CRC and 1 byte trailer.
+
+    @param payload_len: payload length in bytes
+    @param occupied_tones: number of occupied subcarriers
+    @param modulation: one of the keys of ofdm_bits_per_symbol
+    """
+    bits = occupied_tones * ofdm_bits_per_symbol[modulation]
+    return 1 + (8 * (payload_len + 9) + bits - 1) / bits
+
+def link_rates(options):
+    """
+    Return the modulations in use: -m (the base rate) first, then the
+    others from --link-rates.
+    """
+    rates = [options.modulation]
+    for modulation in options.link_rates.split(','):
+        modulation = modulation.strip()
+        if modulation != "" and modulation not in rates:
+            rates.append(modulation)
+    return rates
@@ -25,6 +25,11 @@ import time #for delay timing
 import random #for random backoff
 import threading #for main_loop
 from sense_path import * #for spectrum sensing
+from sense_service import sense_service #for asynchronous sensing
+from cooperative_sense import report_fusion #for sharing sensing results
+from minstrel import minstrel #for per-neighbor rate control
+from pick_bitrate import link_rates
+import mac_frames
 
 # /////////////////////////////////////////////////////////////////////////////
 #                           Carrier Sense MAC
@@ -71,25 +76,78 @@ class cs_mac(threading.Thread):
         self.DIFS_time = 2*options.backoff + options.sifs #options.difs
         self.ctl_pkt_time = options.ctl
         self.backoff_time_unit = options.backoff
+        #send control frames at a computed time instead of when the state
+        #machine gets around to it
+        self.timed_tx = options.timed_tx
+        self.last_rx_time = 0 #when the last frame came up from the PHY
+        #time response timeouts from when our frame really left the tx path
+        self.tx_notify = options.tx_notify
+        self.response_time = options.response_time
+        self.awaiting_frame = None #id of the sent frame we want an answer to
+        self.timeout_at = None #time.time() when the answer is overdue
+        self.answer_time = 0 #air time of the awaited answer beyond a control frame's
+        self.data_time = options.data_time
+        self.last_tx_end = None
+        self.turnarounds = [] #end of our frame to the answer coming up
+        self.link_stats = {} #sender -> rx_metadata of its last good frame
+        self.other_channel_frames = {} #channel -> frames heard there (--multi-rx)
+        self.ctl_cache = options.ctl_cache
+        self.cached_peers = {} #neighbors whose control frames are in the waveform cache
         
         #spectrum sense parameters
-        self.txrx_rate = options.samp_rate #transmit and receive bandwidth
-        self.channel_rate = options.channel_rate #sense bandwidth of channel (not nec. 6 MHz)
-        self.thresh_primary = options.thresh_primary
-        self.thresh_second = options.thresh_second
-        self.thresh_qp = options.thresh_qp
         self.sense_time = options.quiet_period
         self.quiet_period = int(self.sense_time/self.backoff_time_unit) #backoff units for qp
         #print "quiet period is ", self.quiet_period, " backoff units"
         self.qp_interval = options.qp_interval
         self.qp_counter = 0 #keep track of when we're at the qp interval
-        self.old_freq = 0
+        self.sensor = sense_service(options) #runs the senses asynchronously
+        self.fusion = None #merges our sensing results with the neighbors'
+        if options.coop_sense != "none":
+            self.fusion = report_fusion(options.coop_sense, options.coop_ttl,
+                                        options.thresh_primary)
+        self.rate_ctl = None #picks the data rate per neighbor
+        if options.rate_control:
+            self.rate_ctl = minstrel(link_rates(options), options.occupied_tones,
+                                     options.rate_ewma, options.rate_sample,
+                                     options.rate_interval)
+        self.data_rate = None #rate the data frame in flight went out at
         
-        #used in calculating the avg power in dB
-        self.k = 0
+        #channel switch coordination
+        self.announce_switch = options.announce_switch
+        self.switch_countdown = options.switch_countdown
+        self.csa_repeats = options.csa_repeats
+        self.rendezvous_after = options.rendezvous_after
+        self.pending_switch = None #(frequency, time to switch)
+        self.backup_freq = None #where the link meets if it gets lost
+        self.backup_owner = None #address of the node that chose the backup
+        self.link_failures = 0 #RTS in a row into silence without a CTS
+        #both ends of a link keep it alive, so a node that stops hearing its
+        #peer goes to the backup even if it has nothing to send
+        self.keepalive = options.keepalive
+        self.link_timeout = options.link_timeout
+        self.last_sent = time.time() #when we last sent anything
+        self.last_heard = time.time() #last good frame on our channel
+        self.link_up = False #heard someone since we came to this channel
+        self.last_activity = 0 #any frame coming in, decoded or not
+        self.rts_sent_at = 0
+        self.ext_interval = options.ext_interval
+        self.next_ext = 0 #when the next control frame carries our extensions
+        self.ext_backup = None #backup channel they carried last
+        
+        #network wide quiet periods, run by the lowest address that beacons
+        self.sync_qp = options.sync_qp
+        self.qp_period = options.qp_period
+        self.qp_timeout = options.qp_beacon_timeout * options.qp_period
+        self.qp_coordinator = None #address of the node running the schedule
+        self.qp_last_beacon = 0 #when we last heard (or sent) a beacon
+        self.qp_next = None #start of the next quiet period
+        self.quiet_until = 0 #end of the current quiet period
+        self.qp_length = None #quiet period length the coordinator advertises
+        self.qp_beacon_sent = True
         
         #state machine bookkeeping variables
         self.tx_queue = []
+        self.mgmt_queue = [] #broadcast management frames, sent after a backoff
         self.sender = None
         self.rx_callback = callback #what to do when we receive a data packet
         self.next_call = 0 #when to activate the MAC state machine again
@@ -109,9 +167,26 @@ class cs_mac(threading.Thread):
             times = []
             last_sense = time.clock()
             last_call = time.clock()
+            qp_pending = False #a quiet period sense is in progress
+            self.qp_last_beacon = time.time() #give the others a chance to beacon first
             #i = 0
             #do this until we get stopped by the host
             while not self.stopped(): # or len(self.tx_queue) > 0:
+                pending = self.pending_switch
+                if pending is not None and time.time() >= pending[1]:
+                    #announced switch is due, everyone on the link moves now
+                    self.pending_switch = None
+                    self._move_to(pending[0])
+                if self.announce_switch:
+                    self._keep_link()
+                if self.sync_qp:
+                    if self._sync_qp_tick():
+                        times.append(time.clock() - last_sense)
+                        last_sense = time.clock()
+                    if time.time() < self.quiet_until or self.sensor.busy():
+                        #everybody is quiet (or our radio is still sensing),
+                        #nothing gets sent
+                        continue
                 #last_call = time.clock()
                 #self.sense_current_freq()
                 #times.append(time.clock() - last_call)
@@ -125,13 +200,24 @@ class cs_mac(threading.Thread):
                     times.append(time.clock() - last_sense)
                     last_sense = time.clock()
                     
-                    occupied = self.sense_current_freq()
-                    if occupied == 1: #one means a primary is using the channel
-                        #change channels
-                        new_freq = self.find_best_freq()
-                    while self.next_call != "NOW" and (time.clock() - last_call < self.next_call):
-                        #if sensing didn't take a long as we thought it would, wait for a while
-                        pass
+                    #the sense runs in the sense service thread, the quiet period
+                    #timer keeps running here
+                    self.sensor.sense_current(self._qp_sense_done)
+                    qp_pending = True
+                if qp_pending and self.sensor.use_sprt and not self.sensor.busy() \
+                   and not self.sync_qp:
+                    #the sequential test finished early, give the rest of the
+                    #quiet period back to the state machine
+                    qp_pending = False
+                    if self.next_call != 0 and self.next_call != "NOW":
+                        self.state_machine()
+                        last_call = time.clock()
+                timeout_at = self.timeout_at
+                if timeout_at is not None and time.time() >= timeout_at:
+                    #no answer within the turnaround after our frame went out
+                    self.timeout_at = None
+                    self.state_machine()
+                    last_call = time.clock()
                 if self.next_call == "NOW" or (self.next_call != 0 and 
                                                time.clock() - last_call > self.next_call):
                     #run the MAC state machine
@@ -142,6 +228,40 @@ class cs_mac(threading.Thread):
             #print "max sense time is ", max(times)
             #print "avg backoff time slot is ", sum(self.backoff_times)/len(self.backoff_times)
             #print "max backoff time is ", max(self.backoff_times)
+            self.sensor.stop()
+            if self.sensor.use_sprt:
+                print
+                self.sensor.dwell_stats.report()
+            if self.tb.sense.planner.enabled:
+                print
+                self.tb.sense.planner.report()
+            if self.sensor.model is not None:
+                print
+                self.sensor.model.report()
+            if self.fusion is not None:
+                print
+                self.fusion.report()
+            if self.rate_ctl is not None:
+                print
+                self.rate_ctl.print_stats()
+            if self.ctl_cache:
+                print
+                self.tb.txpath.cache_report()
+            if self.timed_tx:
+                print
+                self.tb.txpath.timing_report()
+            if len(self.turnarounds) > 0:
+                print
+                print "avg turnaround (end of tx to rx) is: ", sum(self.turnarounds)/len(self.turnarounds)
+                print "max turnaround is:                   ", max(self.turnarounds)
+            for (sender, metadata) in self.link_stats.items():
+                print "last frame from node %d: snr %.1f dB, cfo %.3f subcarriers" % \
+                      (ord(sender), metadata.snr, metadata.cfo)
+            for (channel, n) in self.other_channel_frames.items():
+                print "frames heard on %d while on another channel: %d" % (channel, n)
+            if self.sensor.quiet_senses > 0:
+                print
+                print "avg quiet time per sense is: ", self.sensor.quiet_time/self.sensor.quiet_senses
             mean = sum(times)/len(times)
             print
             print "avg time between sensing is: ", mean
@@ -182,11 +302,10 @@ class cs_mac(threading.Thread):
         @param tb: the top block of the GNURadio flowgraph representing the PHY
         """
         self.tb = tb
-        mywindow = window.blackmanharris(self.tb.sense.fft_size)
-        power = 0
-        for tap in mywindow:
-            power += tap*tap		
-        self.k = -20*math.log10(self.tb.sense.fft_size)-10*math.log10(power/self.tb.sense.fft_size)
+        if self.tx_notify:
+            tb.txpath.set_tx_done_callback(self._tx_done)
+        self.sensor.set_flow_graph(tb)
+        self.sensor.start()
     
     def set_error_array(self, array):
     	self.err_array = array
@@ -202,144 +321,342 @@ class cs_mac(threading.Thread):
         if self.next_call == 0:
             self.next_call = "NOW"
     
-    def prep_to_sense(self, hold_freq):
-        """
-        Prepare the PHY to sense the spectrum.
-        
-        @param hold_freq: determines whether the PHY will switch channels as it senses.
-        """
-        #set frequency hold
-        self.old_freq = self.tb.u_snk.get_center_freq()
-        #print self.old_freq
-        if not hold_freq:
-            self.tb.sense.current_chan = self.tb.sense.num_channels
-        #    self.tb.sense.next_freq = self.tb.sense.channels[0] #min_center_freq
-        self.tb.sense.set_hold_freq(hold_freq)
-        #stop rcving
-        self.tb.rx_valve.set_enabled(False)
-        #set rate
-        self.tb.set_rate(self.channel_rate)
-        #flush the queue
-        self.tb.sense.msgq.flush()
-        #start the spectrum sense
-        self.tb.sense_valve.set_enabled(True)
-    
-    def prep_to_txrx(self):
+    def _queue_mgmt(self, build):
         """
-        Prepare the PHY to transmit and receive data
+        Send a broadcast management frame through the normal DIFS and
+        backoff, without RTS/CTS.
+
+        @param build: called when the backoff is over, returns the frame or
+                      None if it isn't worth sending anymore
         """
-        #done sensing
-        self.tb.sense_valve.set_enabled(False)
-        #flush the queue
-        #self.tb.sense.msgq.flush()
-        
-        #reset rate
-        self.tb.set_rate(self.txrx_rate)
-        #start rcving
-        self.tb.rx_valve.set_enabled(True)
-        
+        self.mgmt_queue.append(build)
+        if self.next_call == 0:
+            self.next_call = "NOW"
+
     def find_best_freq(self):
         """
-        Gather spectrum sense data and interpret it to find the frequency with the lowest noise
-        floor.
-        """
-        #TODO
-        #Ok, this algorithm totally sucks. It would be better if I could reliably sense the
-        #simulated primary signal, but that interferes too much with adjacent channels, even if
-        #those adjacent channels are like 10 MHz away. Fricken USRPs. 
-        #I'm cheating and making the USRPs choose one of only two frequencies. As soon as I get
-        #primary sensing more reliable, I'll switch back to the original frequency selection algorithm.
-        self.prep_to_sense(False)
-        frequencies = []#""
-        power_levels = []
-        while len(frequencies) == 0:
-            i = 0
-            while i < self.tb.sense.num_channels:
-                i = i+1
-                # Get the next message sent from the C++ code (blocking call).
-                # It contains the center frequency and the mag squared of the fft
-                m = parse_msg(self.tb.sense.msgq.delete_head())
-            
-                #fft_sum_db = 20*math.log10(sum(m.data)/m.vlen)
-                temp_list = []
-                for item in m.data:
-                    temp_list.append(10*math.log10(item) + self.k)
-                fft_sum_db = sum(temp_list)/m.vlen
-                
-                #print m.center_freq, fft_sum_db
-                
-                #this is a relic of using contiguous frequency bands rather than a set of
-                #channels to select from
-                #skip the first and last channels to account for noise at the edges
-                #if ((int(m.center_freq) / 1000000) * 1000000) <= self.tb.sense.min_center_freq or ((int(m.center_freq) / 1000000) * 1000000) >= self.tb.sense.max_freq:#i == 1 or i >= self.tb.sense.num_channels:#
-                #    pass
-                #else: #elif fft_sum_db < best_freq[1] or best_freq[1] == 0:
-                
-                #the >200MHz thing is because sometimes m.center_freq is returned 
-                #as 0 for some reason (bug somewhere?)
-                if fft_sum_db < self.thresh_primary and m.center_freq > 200000000:
-                    frequencies.append(m.center_freq)#= frequencies + "0"#
-                    power_levels.append(fft_sum_db)
-                #else:
-                #    frequencies = frequencies + "1"
-
-        #frequencies = frequencies + "\n"                    
-        #log_file = open('sense_log.dat', 'a')
-        #log_file.write(frequencies)
-        #log_file.close()                
-        #TODO: stop cheating
-        if self.old_freq == self.tb.sense.channels[1]:
-            best_freq = self.tb.sense.channels[4]
-        else:
-            best_freq = self.tb.sense.channels[1]
-        #TODO: this is what it should be
-        #best_freq = power_levels.index(min(power_levels)) #choose the best frequency
-        #best_freq = frequencies[best_freq]
+        Sweep all channels and switch to the best one (blocking call).
         
-        print "\nchoosing frequency ", best_freq, " at time ", time.strftime("%X")
-        #print 
-        self.tb.set_freq(best_freq)
-        self.prep_to_txrx()
-        return best_freq
+        @return: the chosen frequency
+        """
+        return self.sensor.find_best_freq().result()
 		
     def sense_current_freq(self):
         """
-        sense the current channel and look for a primary user
+        sense the current channel and look for a primary user (blocking call)
         """
-        self.prep_to_sense(True)
-        #do the sensing
-        m = parse_msg(self.tb.sense.msgq.delete_head())
-        
-        temp_list = []
-        for item in m.data:
-            temp_list.append(10*math.log10(item) + self.k)
-        fft_sum_db = sum(temp_list)/m.vlen
-        #print fft_sum_db
-        
-        #do threshold comparisons
-        ret_val = 0
-        if fft_sum_db > self.thresh_primary:
-            #print fft_sum_db
-            ret_val = 1
-        elif fft_sum_db > self.thresh_second:
-            ret_val = 2
-        elif fft_sum_db > self.thresh_qp:
-            ret_val = 3
-        
-        self.prep_to_txrx()
+        return self.sensor.sense_current().result()
+    
+    def _qp_sense_done(self, req):
+        """
+        Called from the sense service when a quiet period sense finishes.
+        """
+        busy = req.result() == 1 #one means a primary is using the channel
+        if self.fusion is not None:
+            freq = self.sensor.current_freq()
+            entry = self.sensor.results.get(freq)
+            if entry is not None:
+                self.fusion.add(None, freq, entry[0], busy, entry[2])
+            busy = self.fusion.decide(freq, time.time(), busy)
+        if busy:
+            #change channels, the sweep is queued before the quiet period sense
+            #is retired so the MAC never sees the sense service idle in between
+            if self.announce_switch:
+                self.sensor.find_best_freq(self._announce_switch, False)
+            else:
+                self.sensor.find_best_freq()
+
+    def _sync_qp_tick(self):
+        """
+        Keep the synchronized quiet period schedule: start the sense when a
+        quiet period begins and, as coordinator, beacon the schedule after
+        it ends.
         
-        return ret_val
+        @return: True if a quiet period just started
+        """
+        now = time.time()
+        if self.qp_coordinator != self.address and now - self.qp_last_beacon > self.qp_timeout:
+            #nobody is running the schedule (or the coordinator left), take over
+            self.qp_coordinator = self.address
+            self.qp_last_beacon = now
+            if self.qp_next is None:
+                self.qp_next = now + self.qp_period
+        if self.qp_coordinator == self.address or self.qp_length is None:
+            #the sense may take longer than --quiet-period; what we advertise
+            #is how long we really keep quiet
+            self.qp_length = max(self.sense_time, self.sensor.quiet_sense_time())
+        started = False
+        if self.qp_next is not None and now >= self.qp_next:
+            #everybody keeps quiet for the advertised length; a node whose
+            #own sense takes longer is held back by its busy radio only
+            self.quiet_until = self.qp_next + self.qp_length
+            while self.qp_next <= now:
+                self.qp_next += self.qp_period
+            self.qp_beacon_sent = False
+            if not self.sensor.busy():
+                self.sensor.sense_current(self._qp_sense_done)
+            started = True
+        if self.qp_coordinator == self.address and not self.qp_beacon_sent \
+           and now >= self.quiet_until:
+            self.qp_beacon_sent = True
+            self.qp_last_beacon = now
+
+            def beacon():
+                #the offset is from when the frame goes out, after its backoff
+                body = mac_frames.pack_qp_schedule(self.qp_period, self.qp_length,
+                                                   self.qp_next - time.time())
+                return 'x' + self.address + mac_frames.add_ext("", mac_frames.QP_SCHEDULE, body)
+            self._queue_mgmt(beacon)
+        return started
+
+    def _rx_qp_schedule(self, body):
+        """
+        Follow the quiet period schedule of the node with the lowest address.
+        """
+        if self.qp_coordinator is not None and self.sender != self.qp_coordinator \
+           and self.sender > self.qp_coordinator:
+            return
+        schedule = mac_frames.unpack_qp_schedule(body)
+        if schedule is None:
+            return
+        period, length, offset = schedule
+        self.qp_coordinator = self.sender
+        self.qp_last_beacon = time.time()
+        self.qp_period = period
+        self.qp_length = length
+        self.qp_next = time.time() + offset
+
+    def _quiet_soon(self, margin):
+        """
+        True if a synchronized quiet period starts within margin seconds.
+        """
+        return self.sync_qp and self.qp_next is not None and \
+               self.qp_next - time.time() < margin
+
+    def _announce_switch(self, req):
+        """
+        Called from the sense service when the sweep before an announced
+        switch is done. Tells the neighbors where we're going and when.
+        """
+        target = req.result()
+        if target is None:
+            return
+        channels = self.tb.sense.channels
+        #we decided, so our backup is the link's backup
+        self._set_backup(self.sensor.backup_freq, self.address, True)
+        backup = None
+        if self.backup_freq is not None:
+            backup = channels.index(self.backup_freq)
+        switch = (target, time.time() + self.switch_countdown)
+        self.pending_switch = switch
+
+        def csa():
+            #the countdown is from when the frame goes out, after its backoff
+            if self.pending_switch is not switch:
+                return None #done, or replaced by another switch
+            body = mac_frames.pack_channel_switch(channels.index(target), backup,
+                                                  max(0, switch[1] - time.time()))
+            return 'x' + self.address + mac_frames.add_ext("", mac_frames.CHANNEL_SWITCH, body)
+        #each repeat gets carrier sense and a backoff of its own
+        for i in range(self.csa_repeats):
+            self._queue_mgmt(csa)
+
+    def _keep_link(self):
+        """
+        Send a keepalive when we've been quiet for the keepalive interval,
+        and meet on the backup channel when the link has gone quiet for the
+        link timeout. The keepalive carries our backup channel.
+        """
+        now = time.time()
+        if now - self.last_sent > self.keepalive:
+            self.last_sent = now #once per interval, even if it's still queued
+
+            def keepalive():
+                chan = mac_frames.NO_CHANNEL
+                if self.backup_freq is not None:
+                    chan = self.tb.sense.channels.index(self.backup_freq)
+                return 'x' + self.address + mac_frames.add_ext("", mac_frames.BACKUP_CHANNEL, chr(chan))
+            self._queue_mgmt(keepalive)
+        if self.link_up and now - self.last_heard > self.link_timeout and \
+           self.pending_switch is None and self.backup_freq is not None:
+            print "\nlink lost, going to backup frequency ", self.backup_freq
+            self._move_to(self.backup_freq)
+
+    def _move_to(self, freq):
+        """
+        Switch the data channel now.
+        """
+        self.sensor.switch_to(freq)
+        self.link_failures = 0
+        self.link_up = False
+        self.last_heard = time.time()
+        if freq == self.backup_freq:
+            #used up, the next sweep picks a new one
+            self.backup_freq = None
+            self.backup_owner = None
+
+    def _set_backup(self, freq, owner, force=False):
+        """
+        Adopt a backup channel. Nodes keep the one chosen by the lowest
+        address so both ends of a link agree on it.
+        """
+        if freq is None:
+            return
+        if force or self.backup_owner is None or owner <= self.backup_owner:
+            self.backup_freq = freq
+            self.backup_owner = owner
+
+    def _send(self, pkt, tx_time, modulation=None):
+        """
+        Send a frame at tx_time (time.time() clock) with --timed-tx, right
+        away otherwise.
+
+        @param modulation: link rate for the frame, None for the base rate
+        """
+        #plain control frames repeat, keep their samples
+        cache = pkt[2:] in mac_frames.CTL_FRAMES
+        self.last_sent = time.time()
+        if self.timed_tx:
+            return self.tb.txpath.send_pkt(pkt, tx_time=tx_time, modulation=modulation,
+                                           cache=cache)
+        else:
+            return self.tb.txpath.send_pkt(pkt, modulation=modulation, cache=cache)
+
+    def _await(self, frame_id, answer_time=0):
+        """
+        Wait for the answer to a frame we sent. With --tx-notify the wait
+        is timed only from when the device has played the frame (see
+        _tx_done); otherwise the state machine is called again after a
+        SIFS and a control frame time.
+
+        @param answer_time: with --tx-notify, air time of the answer beyond
+                            a control frame's
+        """
+        if self.tx_notify:
+            self.awaiting_frame = frame_id
+            self.answer_time = answer_time
+            self.next_call = 0
+        else:
+            self.next_call = self.SIFS_time + self.ctl_pkt_time
+
+    def _tx_done(self, frame_id, t):
+        """
+        Called from the transmit path when the device has played a frame.
+        """
+        self.last_tx_end = t
+        if frame_id == self.awaiting_frame:
+            self.awaiting_frame = None
+            self.timeout_at = t + self.SIFS_time + self.response_time + self.answer_time
+
+    def _channel_busy(self):
+        """
+        True if we can't transmit now: carrier is sensed, or the sense
+        service has the radio (retuned, at the sense rate).
+        """
+        return self.sensor.busy() or self.tb.carrier_sensed()
+
+    def _next_slot(self):
+        """
+        Start of the next backoff slot, so RTSs line up on slot boundaries.
+        """
+        return (int(time.time() / self.backoff_time_unit) + 1) * self.backoff_time_unit
 
-    def phy_rx_callback(self, ok, payload):
+    def _with_ext(self, payload):
+        """
+        Add our management extensions to a control frame payload. They go
+        on one frame per ext_interval (sooner if the backup changed); the
+        others stay plain, so their samples can come from the cache.
+        """
+        if self.announce_switch:
+            #keep our pick current; a lower address's pick still wins
+            exclude = [self.sensor.current_freq()]
+            if self.pending_switch is not None:
+                exclude.append(self.pending_switch[0])
+            self._set_backup(self.sensor.pick_backup(exclude), self.address)
+        now = time.time()
+        if now < self.next_ext and self.backup_freq == self.ext_backup:
+            return payload
+        self.next_ext = now + self.ext_interval
+        self.ext_backup = self.backup_freq
+        payload = self._with_report(payload)
+        if self.announce_switch and self.backup_freq is not None:
+            chan = self.tb.sense.channels.index(self.backup_freq)
+            payload = mac_frames.add_ext(payload, mac_frames.BACKUP_CHANNEL, chr(chan))
+        return payload
+
+    def _with_report(self, payload):
+        """
+        Piggyback our recent sensing results on a control frame payload.
+        """
+        if self.fusion is None:
+            return payload
+        now = time.time()
+        channels = self.tb.sense.channels
+        entries = []
+        for freq, (timestamp, result, power_db) in self.sensor.results.items():
+            if now - timestamp <= self.fusion.ttl and freq in channels:
+                entries.append((channels.index(freq), result == 1, power_db, now - timestamp))
+        if len(entries) == 0:
+            return payload
+        return mac_frames.add_ext(payload, mac_frames.SENSE_REPORT,
+                                  mac_frames.pack_sense_report(entries))
+
+    def _rx_sense_report(self, sender, body):
+        """
+        Hand a neighbor's sensing results to the fusion.
+        """
+        if self.fusion is None:
+            return
+        now = time.time()
+        channels = self.tb.sense.channels
+        for (chan, busy, power_db, age) in mac_frames.unpack_sense_report(body):
+            if chan < len(channels):
+                self.fusion.add(sender, channels[chan], now - age, busy, power_db)
+
+    def _rx_channel_switch(self, body):
+        """
+        A neighbor announced a switch; follow it at the same time.
+        """
+        channels = self.tb.sense.channels
+        switch = mac_frames.unpack_channel_switch(body)
+        if switch is None:
+            return
+        target, backup, countdown = switch
+        if target >= len(channels):
+            return
+        self.pending_switch = (channels[target], time.time() + countdown)
+        if backup is not None and backup < len(channels):
+            self._set_backup(channels[backup], self.sender, True)
+
+    def _rx_other_channel(self, payload, metadata):
+        """
+        A frame heard on another channel (--multi-rx). We can't answer it
+        from here, so the state machine never sees it; data and sensing
+        reports are still passed on.
+        """
+        channel = metadata.channel
+        self.other_channel_frames[channel] = self.other_channel_frames.get(channel, 0) + 1
+        sender = payload[1]
+        payload, exts = mac_frames.parse(payload[2:])
+        for (kind, body) in exts:
+            if kind == mac_frames.SENSE_REPORT:
+                self._rx_sense_report(sender, body)
+        if len(payload) > 3:
+            self.rx_callback("R:" + payload)
+
+    def phy_rx_callback(self, ok, payload, metadata=None):
         """
         Invoked by thread associated with PHY to pass received packet up.
 
         @param ok: bool indicating whether payload CRC was OK
         @param payload: contents of the packet (string)
+        @param metadata: rx_metadata of the packet, if the receive path gives it
         """
         #if the rcvd packet is empty or from this node, ignore it completely
         if len(payload) == 0 or (payload[1] == self.address):
             return
+        #garbled frames count too, they're what a collision leaves
+        self.last_activity = time.time()
 
         #if self.verbose:
         #    print "Rx: ok = %r  len(payload) = %4d" % (ok, len(payload))
@@ -351,10 +668,41 @@ class cs_mac(threading.Thread):
                 log_file.write("RX - not ok")
             log_file.close()
             
-        if ok:
+        if ok and metadata is not None and metadata.channel is not None and \
+           metadata.channel != self.tb.cur_freq:
+            self._rx_other_channel(payload, metadata)
+        elif ok:
             #the packet probably isn't corrupted and it's not from this node
+            self.last_heard = time.time()
+            self.link_up = True
+            if metadata is not None:
+                self.last_rx_time = metadata.timestamp
+                self.link_stats[payload[1]] = metadata
+            else:
+                self.last_rx_time = time.time()
+            if self.last_tx_end is not None:
+                self.turnarounds.append(self.last_rx_time - self.last_tx_end)
+                self.last_tx_end = None
             self.sender = payload[1]
-            payload = payload[2:]
+            if self.ctl_cache and self.sender not in self.cached_peers:
+                #modulate what we may have to answer it with before we need it
+                self.cached_peers[self.sender] = True
+                self.tb.txpath.cache_frames([self.sender + self.address + f
+                                             for f in mac_frames.CTL_FRAMES], block=False)
+            payload, exts = mac_frames.parse(payload[2:])
+            for (kind, body) in exts:
+                if kind == mac_frames.SENSE_REPORT:
+                    self._rx_sense_report(self.sender, body)
+                elif kind == mac_frames.CHANNEL_SWITCH:
+                    self._rx_channel_switch(body)
+                elif kind == mac_frames.QP_SCHEDULE and self.sync_qp:
+                    self._rx_qp_schedule(body)
+                elif kind == mac_frames.BACKUP_CHANNEL and len(body) > 0:
+                    if ord(body[0]) < len(self.tb.sense.channels):
+                        self._set_backup(self.tb.sense.channels[ord(body[0])], self.sender)
+            if len(payload) == 0:
+                #management only, nothing for the state machine
+                return
             if self.verbose:
                 print "RX: ", payload, ", State: ", self.state, ", backoff: ", self.backoff, ", next call: ", self.next_call
 
@@ -404,6 +752,9 @@ class cs_mac(threading.Thread):
             
         self.lock.acquire()
         self.next_call = 0
+        #whatever we were waiting for is handled now
+        self.awaiting_frame = None
+        self.timeout_at = None
             
         if self.verbose:
             print "S: ", self.state, ", L:", len(self.tx_queue)
@@ -412,7 +763,7 @@ class cs_mac(threading.Thread):
         if self.state == 0: #idle state
             if self.RTS_rcvd: #someone wants to send to us
                 self.RTS_rcvd = False
-                if self.tb.carrier_sensed(): #they can't send because someone else is talking
+                if self._channel_busy(): #they can't send because someone else is talking (or we're sensing)
                     #do nothing and remain in the idle state if we can't do a CTS
                     self.next_call = self.SIFS_time
                 else: #they can send, so give them a CTS
@@ -420,15 +771,18 @@ class cs_mac(threading.Thread):
                          log_file = open('csma_ca_mac_log.dat', 'w')
                          log_file.write("TX:" + self.sender + self.address + "CTS")
                          log_file.close()
-                    self.tb.txpath.send_pkt(self.sender + self.address + "CTS")
+                    frame_id = self._send(self.sender + self.address + self._with_ext("CTS"),
+                               self.last_rx_time + self.SIFS_time)
                     self.state = 6
-                    self.next_call = self.SIFS_time + self.ctl_pkt_time
-            elif len(self.tx_queue) > 0: #nobody wants to send to us and we want to send
-                if not self.tb.carrier_sensed() and self.tx_tries < self.packet_lifetime:
+                    #the answer is a data frame
+                    self._await(frame_id, self.data_time)
+            elif len(self.tx_queue) > 0 or len(self.mgmt_queue) > 0: #nobody wants to send to us and we want to send
+                if not self._channel_busy() and \
+                   (len(self.mgmt_queue) > 0 or self.tx_tries < self.packet_lifetime):
                     self.state = 2
                     self.qp_counter = (self.qp_counter + 1) % self.qp_interval
                     self.next_call = self.DIFS_time
-                elif self.tx_tries >= self.packet_lifetime:
+                elif len(self.mgmt_queue) == 0 and self.tx_tries >= self.packet_lifetime:
                     if self.err_array != None:
                         self.err_array.append(1)
                     if self.verbose:
@@ -451,7 +805,7 @@ class cs_mac(threading.Thread):
                     #TODO: Make sure this way of dealing with backoff and qp fits Chitto's algorithm
                 #    self.backoff = self.backoff - self.quiet_period
                 self.state = 3
-                if self.qp_counter == 0:
+                if self.qp_counter == 0 and not self.sync_qp:
                     self.next_call = "QP"
                 else:
                     self.next_call = self.backoff_time_unit
@@ -459,18 +813,33 @@ class cs_mac(threading.Thread):
                 self.state = 0
                 self.next_call = "NOW"
         elif self.state == 3: #backoff state
-            if cb and not self.tb.carrier_sensed(): #we're still ok, so keep backing off
+            if cb and self.sensor.busy():
+                #the radio is still sensing, so the quiet period isn't over yet
+                self.next_call = self.backoff_time_unit
+            elif cb and self.backoff <= 1 and self._quiet_soon(4*self.ctl_pkt_time + 3*self.SIFS_time):
+                #the exchange wouldn't finish before the quiet period, hold the RTS
+                self.next_call = self.backoff_time_unit
+            elif cb and not self.tb.carrier_sensed(): #we're still ok, so keep backing off
                 self.backoff -= 1
-                if self.backoff <= 0:
+                if self.backoff <= 0 and len(self.mgmt_queue) > 0:
+                    #management frames go first, nobody answers them
+                    pkt = self.mgmt_queue.pop(0)()
+                    if pkt is not None:
+                        self._send(pkt, self._next_slot())
+                    self.state = 0
+                    self.next_call = "NOW"
+                elif self.backoff <= 0:
                     #self.ready_to_backoff = 0
                     if self.log_mac:
                         log_file = open('csma_ca_mac_log.dat', 'w')
                         log_file.write("TX:" + self.tx_queue[0][0] + self.address + "RTS")
                         log_file.close()
-                    self.tb.txpath.send_pkt(self.tx_queue[0][0] + self.address + "RTS")
+                    frame_id = self._send(self.tx_queue[0][0] + self.address + self._with_ext("RTS"),
+                               self._next_slot())
+                    self.rts_sent_at = time.time()
                     self.tx_tries += 1
                     self.state = 4
-                    self.next_call = self.SIFS_time + self.ctl_pkt_time
+                    self._await(frame_id)
                 else:
                     #if self.ready_to_backoff != 0:
                         #self.backoff_times.append(time.clock() - self.ready_to_backoff)
@@ -483,18 +852,39 @@ class cs_mac(threading.Thread):
         elif self.state == 4: #RTS sent, wait for CTS
             if not self.CTS_rcvd: #timeout (or something)
                 self.collisions += 1
+                #with anything else on the air since the RTS it may have been
+                #contention, that says nothing about the peer
+                if self.last_activity < self.rts_sent_at and not self.tb.carrier_sensed():
+                    self.link_failures += 1
+                if self.announce_switch and self.link_failures >= self.rendezvous_after \
+                   and self.backup_freq is not None:
+                    #the peer is gone, maybe it missed a switch; meet on the backup
+                    print "\nlink lost, going to backup frequency ", self.backup_freq
+                    self._move_to(self.backup_freq)
+                self.state = 0
+                self.next_call = "NOW"
+            elif self.sensor.busy():
+                #the sense service took the radio, the data has to wait
+                self.CTS_rcvd = False
                 self.state = 0
                 self.next_call = "NOW"
             else: #awesome, now we can send
                 self.CTS_rcvd = False
+                self.link_failures = 0
                 if self.log_mac:
                     log_file = open('csma_ca_mac_log.dat', 'w')
                     log_file.write("TX:" + self.tx_queue[0])
                     log_file.close()
-                self.tb.txpath.send_pkt(self.tx_queue[0])
+                if self.rate_ctl is not None:
+                    #tx_tries already counts this attempt's RTS
+                    self.data_rate = self.rate_ctl.choose(self.tx_queue[0][0], self.tx_tries - 1)
+                frame_id = self._send(self.tx_queue[0], self.last_rx_time + self.SIFS_time,
+                                      self.data_rate)
                 self.state = 5
-                self.next_call = self.SIFS_time + self.ctl_pkt_time
+                self._await(frame_id)
         elif self.state == 5: #data sent, wait for ACK
+            if self.rate_ctl is not None:
+                self.rate_ctl.report(self.tx_queue[0][0], self.data_rate, self.ACK_rcvd)
             if self.ACK_rcvd == True:
                 #awesome, we're done
                 self.tx_queue.pop(0)
@@ -513,12 +903,12 @@ class cs_mac(threading.Thread):
                 self.state = 0
                 self.next_call = "NOW"
         elif self.state == 7: #data rcvd, send ACK
-            if not self.tb.carrier_sensed():
+            if not self._channel_busy():
                 if self.log_mac:
                     log_file = open('csma_ca_mac_log.dat', 'w')
                     log_file.write("TX:" + self.sender + self.address + "ACK")
                     log_file.close()
-                self.tb.txpath.send_pkt(self.sender + self.address + "ACK")
+                self._send(self.sender + self.address + "ACK", self.last_rx_time + self.SIFS_time)
             self.state = 0
             self.next_call = "NOW"
         else:
@@ -549,12 +939,44 @@ class cs_mac(threading.Thread):
                           help="set sample rate for USRP to SAMP_RATE [default=%default]")
         expert.add_option("", "--channel_rate", type="intx", default=4000000,
                           help="set channel rate for USRP spectrum sense to SAMP_RATE [default=%default]")
+        expert.add_option("", "--sense-at-txrx-rate", action="store_true", default=False,
+                          help="sense at samp_rate instead of switching to channel_rate [default=%default]")
         expert.add_option("", "--thresh_primary", type="eng_float", default=-50,
                           help="set primary detection threshold [default=%default]")
         expert.add_option("", "--thresh_second", type="eng_float", default=-60,
                           help="set secondary detection threshold [default=%default]")
         expert.add_option("", "--thresh_qp", type="eng_float", default=-80,
                           help="set qpCSMA/CA detection threshold [default=%default]")
+        expert.add_option("", "--response-time", type="eng_float", default=.01,
+                          help="with --tx-notify, time a control frame answer may take after "
+                          "ours was played [default=%default]")
+        expert.add_option("", "--data-time", type="eng_float", default=.05,
+                          help="time a data frame takes beyond a control frame, for the wait "
+                          "after a CTS [default=%default]")
+        expert.add_option("", "--announce-switch", action="store_true", default=False,
+                          help="announce channel switches so peers follow [default=%default]")
+        expert.add_option("", "--switch-countdown", type="eng_float", default=.1,
+                          help="time between the announcement and the switch in seconds [default=%default]")
+        expert.add_option("", "--csa-repeats", type="int", default=3,
+                          help="number of times a switch announcement is sent [default=%default]")
+        expert.add_option("", "--ext-interval", type="eng_float", default=.2, metavar="SECS",
+                          help="attach sensing reports and the backup channel to one control "
+                          "frame per SECS [default=%default]")
+        expert.add_option("", "--rendezvous-after", type="int", default=5,
+                          help="RTS failures in a row on an otherwise quiet channel before "
+                          "moving to the backup channel [default=%default]")
+        expert.add_option("", "--keepalive", type="eng_float", default=.5, metavar="SECS",
+                          help="with --announce-switch, send a keepalive after SECS without "
+                          "sending anything [default=%default]")
+        expert.add_option("", "--link-timeout", type="eng_float", default=2, metavar="SECS",
+                          help="with --announce-switch, move to the backup channel after SECS "
+                          "without hearing the link [default=%default]")
+        expert.add_option("", "--sync-qp", action="store_true", default=False,
+                          help="hold quiet periods at the same time on all nodes [default=%default]")
+        expert.add_option("", "--qp-period", type="eng_float", default=.5,
+                          help="time between synchronized quiet periods in seconds [default=%default]")
+        expert.add_option("", "--qp-beacon-timeout", type="int", default=3,
+                          help="missed schedule beacons before a node takes over [default=%default]")
         expert.add_option("", "--quiet-period", type="eng_float", default=.03,
                           help="set quiet period length in seconds [default=%default]") 
         expert.add_option("", "--qp-interval", type="int", default=1,
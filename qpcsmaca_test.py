@@ -29,10 +29,16 @@ import os
 # from current dir
 from transmit_path import transmit_path
 from receive_path import receive_path
+from multi_receive_path import multi_receive_path
 #using state machine MAC, not while loop MAC (maybe this will work better?)
 from qpcsmaca_mac import *
 #spectrum sense code
 from sense_path import *
+from sequential_sense import sprt_detector
+from spectrum_history import spectrum_history_writer
+from occupancy_model import occupancy_model
+from cooperative_sense import report_fusion
+from minstrel import minstrel
     
 
 # /////////////////////////////////////////////////////////////////////////////
@@ -46,8 +52,12 @@ class usrp_graph(gr.top_block):
         #self._tx_freq            = options.tx_freq         # tranmitter's center frequency
         self._tx_gain            = options.tx_gain         # transmitter's gain
         self._samp_rate          = options.samp_rate       # sample rate for USRP
+        self._cur_rate           = None                    # rate the USRP is set to now
         #self._rx_freq            = options.rx_freq         # receiver's center frequency
         self._rx_gain            = options.rx_gain         # receiver's gain
+        self._multi_rx           = options.multi_rx        # receive all channels at once
+        self._capture_rate       = options.capture_rate    # source rate when receiving all
+        self.cur_freq            = None                    # channel we're on
 
         #if self._tx_freq is None:
         #    sys.stderr.write("-f FREQ or --freq FREQ or --tx-freq FREQ must be specified\n")
@@ -62,15 +72,29 @@ class usrp_graph(gr.top_block):
         self._setup_usrp_source()
 
         self.txpath = transmit_path(options)
-        self.rxpath = receive_path(callback, options)
+        #timed frames are placed against the sink's clock
+        self.txpath.set_clock(self._device_time, self.u_snk.get_samp_rate())
         self.rx_valve = gr.copy(gr.sizeof_gr_complex)
                 
         self.sense = sense_path(self.set_freq, options)
+
+        if self._multi_rx:
+            self.rxpath = multi_receive_path(callback, options, self.sense.channels)
+            #the source runs at the capture rate whenever we're not sensing
+            self._cur_rate = None
+            self.set_rate(self._samp_rate)
+        else:
+            self.rxpath = receive_path(callback, options, with_metadata=True,
+                                       samp_rate=self._samp_rate)
         
         # Set center frequency of USRP
-        ok = self.set_freq(self.sense.channels[0]) #self._tx_freq)
+        first = self.sense.channels[0]
+        if self._multi_rx and first not in self.rxpath.rxpaths:
+            #start where the capture is, not by re-centering it
+            first = self.rxpath.channels()[0]
+        ok = self.set_freq(first) #self._tx_freq)
         if not ok:
-            print "Failed to set Tx frequency to %s" % (eng_notation.num_to_str(self.sense.channels[0]),)
+            print "Failed to set Tx frequency to %s" % (eng_notation.num_to_str(first),)
             raise ValueError
         
         self.sense_valve = gr.copy(gr.sizeof_gr_complex)
@@ -95,12 +119,43 @@ class usrp_graph(gr.top_block):
         """
         return self.rxpath.carrier_sensed()
         
+    def _device_time(self):
+        """
+        Return the USRP's time in seconds.
+        """
+        return self.u_snk.get_time_now().get_real_secs()
+
     def set_rate(self, rate):
         """
-        Set the sample rate of the USRP
+        Set the sample rate of the USRP. Nothing is done if the USRP is
+        already at that rate, since every switch costs device latency and
+        can drop samples.
         """
-        self.u_src.set_samp_rate(rate)
+        if rate == self._cur_rate:
+            return
         self.u_snk.set_samp_rate(rate)
+        self.txpath.set_clock(self._device_time, self.u_snk.get_samp_rate())
+        self._cur_rate = rate
+        if self._multi_rx and rate == self._samp_rate:
+            #back to receiving: capture the whole band again
+            self.u_src.set_samp_rate(self._capture_rate)
+            self.u_src.set_center_freq(self.rxpath.capture_freq, 0)
+        else:
+            self.u_src.set_samp_rate(rate)
+            if self._multi_rx and self.cur_freq is not None:
+                #the sense path looks where we transmit; the capture moved
+                #the source's LO, so it has to be placed again
+                self.sense.planner.invalidate()
+                self.set_freq(self.cur_freq)
+
+    def set_rx_gain(self, gain):
+        """
+        Set the receive gain of the USRP. Cached sensing results were measured
+        at the old gain, so they are thrown away.
+        """
+        self._rx_gain = gain
+        self.u_src.set_gain(gain)
+        self.sense.cache.invalidate()
 
     def _setup_usrp_sink(self):
         """
@@ -125,6 +180,7 @@ class usrp_graph(gr.top_block):
                                  
         self.u_src.set_subdev_spec("",0)
         self.u_src.set_samp_rate(self._samp_rate)
+        self._cur_rate = self._samp_rate
         
         g = self.u_src.get_gain_range()
         #set the gain to the midpoint if it's currently out of bounds
@@ -143,10 +199,47 @@ class usrp_graph(gr.top_block):
         tune as close to the desired frequency as it can.  Then we use
         the result of that operation and our target_frequency to
         determine the value for the digital up converter.
+
+        With a tuning planner (--lo-span), channels that share an LO
+        position are reached by moving only the DSP offset, and the LO is
+        placed where the planner wants it.
+
+        With --multi-rx the source stays on the capture band while we
+        transmit and receive; only the sink (and the channel carrier sense
+        looks at) moves. A channel outside the capture re-centers the
+        capture on it first.
         """
-        r_snk = self.u_snk.set_center_freq(target_freq, 0)
-        r_src = self.u_src.set_center_freq(target_freq, 0)
+        planner = self.sense.planner
+        #the source only follows while it isn't capturing the whole band
+        move_src = not (self._multi_rx and self._cur_rate == self._samp_rate)
+        on_plan = self._multi_rx and target_freq in self.sense.channels
+        if on_plan and target_freq not in self.rxpath.rxpaths:
+            self.rxpath.recenter(target_freq)
+            if not move_src:
+                self.u_src.set_center_freq(self.rxpath.capture_freq, 0)
+        if not planner.enabled:
+            r_snk = self.u_snk.set_center_freq(target_freq, 0)
+            r_src = True
+            if move_src:
+                r_src = self.u_src.set_center_freq(target_freq, 0)
+        else:
+            tr = uhd.tune_request(target_freq)
+            if planner.kind(target_freq) == "dsp":
+                #leave the LO alone
+                tr.rf_freq_policy = uhd.tune_request.POLICY_NONE
+            else:
+                tr.rf_freq_policy = uhd.tune_request.POLICY_MANUAL
+                tr.rf_freq = planner.lo_for(target_freq)
+            r_snk = self.u_snk.set_center_freq(tr, 0)
+            r_src = True
+            if move_src:
+                r_src = self.u_src.set_center_freq(tr, 0)
         if r_snk and r_src:
+            planner.tuned(target_freq)
+            self.sense.retuned()
+            self.cur_freq = target_freq
+            if on_plan:
+                self.rxpath.set_channel(target_freq)
             return True
 
         return False
@@ -238,7 +331,8 @@ def main():
     expert_grp = parser.add_option_group("Expert")
     parser.add_option("-m", "--modulation", type="choice", choices=['bpsk', 'qpsk'],
                       default='bpsk',
-                      help="Select modulation from: bpsk, qpsk [default=%%default]")
+                      help="Select the base modulation from: bpsk, qpsk; see --link-rates "
+                      "for the others [default=%%default]")
     parser.add_option("-v","--verbose", action="store_true", default=False)
     parser.add_option("-p","--packets", type="int", default = 3000, 
                       help="set number of packets to send [default=%default]")
@@ -258,10 +352,16 @@ def main():
     usrp_graph.add_options(parser, expert_grp)
     transmit_path.add_options(parser, expert_grp)
     receive_path.add_options(parser, expert_grp)
+    multi_receive_path.add_options(parser, expert_grp)
     blks2.ofdm_mod.add_options(parser, expert_grp)
     blks2.ofdm_demod.add_options(parser, expert_grp)
     cs_mac.add_options(parser, expert_grp)
     sense_path.add_options(parser, expert_grp)
+    sprt_detector.add_options(parser, expert_grp)
+    spectrum_history_writer.add_options(parser, expert_grp)
+    occupancy_model.add_options(parser, expert_grp)
+    report_fusion.add_options(parser, expert_grp)
+    minstrel.add_options(parser, expert_grp)
 
     (options, args) = parser.parse_args ()
     if len(args) != 0:
@@ -272,6 +372,12 @@ def main():
     #    sys.stderr.write("You must specify -f FREQ or --freq FREQ\n")
     #    parser.print_help(sys.stderr)
     #    sys.exit(1)
+    if options.sense_at_txrx_rate:
+        #the sense path sees the same stream as the receiver
+        options.channel_rate = options.samp_rate
+    if options.multi_rx and options.sense_at_txrx_rate:
+        sys.stderr.write("--multi-rx and --sense-at-txrx-rate can't be used together\n")
+        sys.exit(1)
     if options.address is None:
     	sys.stderr.write("You must specify a node address\n")
     	parser.print_help(sys.stderr)
@@ -25,16 +25,69 @@ from gnuradio import gr, gru, blks2
 from gnuradio import eng_notation
 import copy
 import sys
+import time
+import threading
+import numpy
 
 # from current dir
-from pick_bitrate import pick_rx_bitrate
+from pick_bitrate import pick_rx_bitrate, ofdm_frame_symbols, link_rates
+from ofdm_offline import calibrate, stream_decoder
+import fec
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              receive metadata
+# /////////////////////////////////////////////////////////////////////////////
+
+class rx_metadata(object):
+    """
+    What the receiver knows about one received frame.
+
+    timestamp  time.time() the frame's last sample was received, from the
+               sample clock (the receive path's samp_rate); without a
+               sample rate, when the samples it ends in reached the decoder
+    snr        SNR estimate (dB) from the error of the frame's own
+               equalized symbols
+    cfo        carrier frequency offset estimate of the frame in subcarrier
+               spacings (multiply by sample rate / fft_length for Hz)
+    symbols    number of OFDM symbols in the frame, preamble included
+    modulation modulation the frame was sent with
+    channel    center frequency the frame came in on, None if the receive
+               path only has the one it is tuned to
+    corrected  bytes the FEC corrected, None without FEC
+    """
+    __slots__ = ('timestamp', 'snr', 'cfo', 'symbols', 'modulation', 'channel',
+                 'corrected')
+
+    def __init__(self, timestamp, snr, cfo, symbols, modulation, channel=None,
+                 corrected=None):
+        self.timestamp = timestamp
+        self.snr = snr
+        self.cfo = cfo
+        self.symbols = symbols
+        self.modulation = modulation
+        self.channel = channel
+        self.corrected = corrected
+
+    def __repr__(self):
+        return "rx_metadata(timestamp=%.6f, snr=%.1f, cfo=%.3f, symbols=%d, modulation=%s)" % \
+               (self.timestamp, self.snr, self.cfo, self.symbols, self.modulation)
 
 # /////////////////////////////////////////////////////////////////////////////
 #                              receive path
 # /////////////////////////////////////////////////////////////////////////////
 
 class receive_path(gr.hier_block2):
-    def __init__(self, rx_callback, options):
+    def __init__(self, rx_callback, options, with_metadata=False, channel=None,
+                 samp_rate=None):
+        """
+        @param rx_callback: called as rx_callback(ok, payload), or
+                            rx_callback(ok, payload, metadata) with an
+                            rx_metadata if with_metadata is set
+        @param channel: channel put in the metadata
+        @param samp_rate: input sample rate, for frame times from the sample
+                          clock (without it, a frame's time is when the
+                          samples it ends in came in)
+        """
 
         gr.hier_block2.__init__(self, "receive_path",
                 gr.io_signature(1, 1, gr.sizeof_gr_complex), # Input signature
@@ -46,23 +99,112 @@ class receive_path(gr.hier_block2):
         self._verbose     = options.verbose
         self._log         = options.log
         self._rx_callback = rx_callback      # this callback is fired when there's a packet available
+        self._channel     = channel
+        self._fec         = options.fec != "none"
+        self.fec_frames   = 0  # frames the FEC saved from a CRC failure
+
+        self._with_metadata = with_metadata
+        self._base_modulation = options.modulation
+        self._occupied_tones = options.occupied_tones
+        self._samp_rate = samp_rate
 
-        # receiver
-        self.ofdm_rx = \
-                     blks2.ofdm_demod(options, callback=self._rx_callback)
+        # With several link rates, one receiver takes them all: the rates
+        # share the preamble and the subcarrier map, so stream_decoder finds
+        # and equalizes a frame once and picks its rate from the header.
+        # It also gives each frame's SNR, CFO and sample position with the
+        # frame, so it's used for the metadata too. Otherwise it's the
+        # ofdm_demod of the one rate.
+        self.demods = {}
+        self._decoder = None
+        rates = link_rates(options)
+        if len(rates) > 1 or with_metadata:
+            cals = [calibrate(m, options.fft_length, options.occupied_tones,
+                              options.cp_length) for m in rates]
+            self._decoder = stream_decoder(cals, options.sync_threshold)
+            # the channel filter of ofdm_receiver
+            bw = (float(options.occupied_tones) / float(options.fft_length)) / 2.0
+            tb = bw*0.08
+            chan_coeffs = gr.firdes.low_pass (1.0, 1.0, bw+tb, tb, gr.firdes.WIN_HAMMING)
+            self.chan_filt = gr.fft_filter_ccc(1, chan_coeffs)
+            # the decoder must see every sample, so the sink blocks rather
+            # than drop when it falls behind
+            self._samples_msgq = gr.msg_queue()
+            self.connect(self, self.chan_filt,
+                         gr.message_sink(gr.sizeof_gr_complex, self._samples_msgq, False))
+            self.ofdm_rx = self.chan_filt
+            self._decode_thread = threading.Thread(target=self._decode_loop)
+            self._decode_thread.setDaemon(True)
+            self._decode_thread.start()
+        else:
+            demod = blks2.ofdm_demod(options, callback=self._deliver)
+            self.demods[self._base_modulation] = demod
+            self.connect(self, demod)
+            self.ofdm_rx = demod
 
         # Carrier Sensing Blocks
         alpha = 0.001
         thresh = 30   # in dB, will have to adjust
         self.probe = gr.probe_avg_mag_sqrd_c(thresh,alpha)
 
-        self.connect(self, self.ofdm_rx)
         self.connect(self.ofdm_rx, self.probe)
 
         # Display some information about the setup
         if self._verbose:
             self._print_verbage()
         
+    def _deliver(self, ok, payload):
+        """
+        Called by the demodulator's queue watcher for every frame.
+        """
+        self._hand_on(ok, payload, self._base_modulation)
+
+    def _hand_on(self, ok, payload, modulation, timestamp=None, snr=None, cfo=None):
+        """
+        Hand a frame to the callback as it is (decoded first with FEC on).
+        """
+        coded_len = len(payload)
+        corrected = None
+        if self._fec:
+            fec_ok, payload, code, corrected = fec.decode(payload)
+            if fec_ok and not ok:
+                self.fec_frames += 1
+            ok = fec_ok
+        if not self._with_metadata:
+            self._rx_callback(ok, payload)
+            return
+        metadata = rx_metadata(timestamp, snr, cfo,
+                               ofdm_frame_symbols(coded_len, self._occupied_tones,
+                                                  modulation),
+                               modulation, self._channel, corrected)
+        self._rx_callback(ok, payload, metadata)
+
+    def _decode_loop(self):
+        """
+        Feed the samples to the stream decoder and hand on what it finds.
+        """
+        while True:
+            msgs = [self._samples_msgq.delete_head()]
+            #take whatever else came in, fewer and bigger pushes
+            while True:
+                msg = self._samples_msgq.delete_head_nowait()
+                if not msg:
+                    break
+                msgs.append(msg)
+            now = time.time()
+            samples = numpy.fromstring("".join([m.to_string() for m in msgs]),
+                                       dtype=numpy.complex64)
+            frames = self._decoder.push(samples)
+            stream_end = self._decoder.stream_end()
+            for (start, end, ok, payload, modulation, cfo, snr, nsym) in frames:
+                #when the frame's last sample came in, from the sample clock
+                timestamp = now
+                if self._samp_rate:
+                    timestamp = now - (stream_end - end) / float(self._samp_rate)
+                try:
+                    self._hand_on(ok, payload, modulation, timestamp, snr, cfo)
+                except Exception, e:
+                    print "receive_path: rx callback exception: ", e
+
     def carrier_sensed(self):
         """
         Return True if we think carrier is present.
@@ -93,6 +235,17 @@ class receive_path(gr.hier_block2):
         normal.add_option("-v", "--verbose", action="store_true", default=False)
         expert.add_option("", "--log", action="store_true", default=False,
                           help="Log all parts of flow graph to files (CAUTION: lots of data)")
+        expert.add_option("", "--link-rates", type="string", default="",
+                          help="comma separated modulations frames may be sent and received "
+                          "with, besides -m [default=%default]")
+        expert.add_option("", "--sync-threshold", type="eng_float", default=.7,
+                          help="preamble detection threshold (0..1) of the receiver that "
+                          "takes several link rates [default=%default]")
+        fec_choices = fec.CODES.keys()
+        fec_choices.sort()
+        expert.add_option("", "--fec", type="choice", choices=fec_choices, default="none",
+                          help="Reed-Solomon code around the payload, one of %s; a receiver "
+                          "with FEC on decodes any of them [default=%%default]" % (", ".join(fec_choices),))
 
     # Make a static method to call before instantiation
     add_options = staticmethod(add_options)
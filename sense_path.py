@@ -25,6 +25,10 @@ from gnuradio.eng_option import eng_option
 #from usrpm import usrp_dbid
 import sys, struct
 import math
+import time
+
+# from current dir
+from tune_planner import tune_planner
 
 
 
@@ -71,6 +75,96 @@ class parse_msg(object):
         self.data = struct.unpack('%df' % (self.vlen,), t)
 
 
+class channel_report(object):
+    """
+    Compact sensing result for one channel. The flowgraph reduces each FFT
+    frame to a mean and a peak power (in dB) over the selected bins, so a
+    bin_statistics_f message only carries those two values. With the pilot
+    detector on, it also carries the pilot power and the noise floor around
+    the pilot (in dB).
+    """
+    def __init__(self, msg, channels):
+        m = parse_msg(msg)
+        self.center_freq = m.center_freq
+        self.mean_db = m.data[0]
+        self.peak_db = m.data[1]
+        self.pilot_db = None
+        self.floor_db = None
+        if m.vlen >= 4:
+            self.pilot_db = m.data[2]
+            self.floor_db = m.data[3]
+        self.timestamp = time.time()
+        
+        #center_freq is 0 when the sense path is holding its frequency
+        self.channel = None
+        for i in range(len(channels)):
+            if abs(channels[i] - self.center_freq) < 1:
+                self.channel = i
+                break
+                
+    def pilot_snr(self):
+        """
+        Pilot power over the surrounding noise floor in dB, None without the
+        pilot detector.
+        """
+        if self.pilot_db is None:
+            return None
+        return self.pilot_db - self.floor_db
+
+
+class sense_cache(object):
+    """
+    Recent sensing results keyed by center frequency and sense bandwidth.
+    
+    Entries expire after ttl seconds. They are also dropped explicitly when
+    something changes what a measurement would read (gain changes, moving
+    the data channel).
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        
+    def _key(self, center_freq, bandwidth):
+        #tuned frequencies come back from the device with a few Hz of error
+        return (int(round(center_freq / 1e3)), int(round(bandwidth / 1e3)))
+        
+    def put(self, center_freq, bandwidth, power_db, result):
+        """
+        Store a sensing result.
+        
+        @param power_db: measured channel power in dB
+        @param result: the classification of the channel (see sense_service.classify)
+        """
+        if self.ttl <= 0:
+            return
+        self.entries[self._key(center_freq, bandwidth)] = (time.time(), power_db, result)
+        
+    def get(self, center_freq, bandwidth):
+        """
+        Return (power_db, result) if there is a fresh result, otherwise None.
+        """
+        entry = self.entries.get(self._key(center_freq, bandwidth))
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1:]
+        
+    def invalidate(self, center_freq=None):
+        """
+        Drop cached results for one center frequency, or all of them.
+        """
+        if center_freq is None:
+            self.entries.clear()
+            return
+        f = int(round(center_freq / 1e3))
+        for key in self.entries.keys():
+            if key[0] == f:
+                del self.entries[key]
+
+
 class sense_path(gr.hier_block2):
 
     def __init__(self, tuner_callback, options):
@@ -92,6 +186,12 @@ class sense_path(gr.hier_block2):
         self.channels = [600000000, 620000000, 625000000, 640000000, 645000000, 650000000]
         self.current_chan = 0
         self.num_channels = len(self.channels) #(self.max_freq - self.min_freq)/self.freq_step
+        #which channels can be reached without moving the LO
+        self.planner = tune_planner(self.channels, options.lo_span, self.usrp_rate)
+        self.sweep_channels = self.planner.order(self.channels) #channels visited by a sweep
+        
+        #recent sensing results, so a channel isn't measured again before it could change
+        self.cache = sense_cache(options.sense_ttl)
 
         #if self.min_freq > self.max_freq:
         #    self.min_freq, self.max_freq = self.max_freq, self.min_freq   # swap them
@@ -111,19 +211,95 @@ class sense_path(gr.hier_block2):
                 print "Note: failed to enable realtime scheduling"
 
         # build graph
-        s2v = gr.stream_to_vector(gr.sizeof_gr_complex, self.fft_size)
-
         mywindow = window.blackmanharris(self.fft_size)
-        fft = gr.fft_vcc(self.fft_size, True, mywindow)
         power = 0
         for tap in mywindow:
             power += tap*tap
-            
-        c2mag = gr.complex_to_mag_squared(self.fft_size)
+        
+        # Welch mode: segment i sees the stream delayed by i hops, so the
+        # segments overlap by welch_overlap. Their periodograms are summed and
+        # then averaged over welch_depth frames before anything is reduced.
+        if options.welch_overlap < 0 or options.welch_overlap >= 1:
+            raise ValueError, "--welch-overlap must be at least 0 and below 1"
+        self.welch_segments = max(1, int(round(1.0 / (1.0 - options.welch_overlap))))
+        if options.welch_overlap > 0 and self.welch_segments == 1:
+            print "Note: --welch-overlap below 1/3 leaves a single segment, Welch is off"
+        self.welch_depth = max(1, options.welch_depth)
+        hop = self.fft_size / self.welch_segments
+        
+        #offset that turns mag squared into dB relative to full scale
+        self.k = -20*math.log10(self.fft_size)-10*math.log10(power/self.fft_size) \
+                 -10*math.log10(self.welch_segments)
+        
+        if self.welch_segments > 1:
+            spectrum = gr.add_vff(self.fft_size)
+        for i in range(self.welch_segments):
+            s2v = gr.stream_to_vector(gr.sizeof_gr_complex, self.fft_size)
+            fft = gr.fft_vcc(self.fft_size, True, mywindow)
+            c2mag = gr.complex_to_mag_squared(self.fft_size)
+            if i == 0:
+                self.connect(self, s2v)
+            else:
+                delay = gr.delay(gr.sizeof_gr_complex, i*hop)
+                self.connect(self, delay, s2v)
+            if self.welch_segments > 1:
+                self.connect(s2v, fft, c2mag, (spectrum, i))
+            else:
+                self.connect(s2v, fft, c2mag)
+                spectrum = c2mag
+        
+        if self.welch_depth > 1:
+            avg = gr.single_pole_iir_filter_ff(1.0 / self.welch_depth, self.fft_size)
+            decim = gr.keep_one_in_n(self.fft_size * gr.sizeof_float, self.welch_depth)
+            self.connect(spectrum, avg, decim)
+            spectrum = decim
 
-        # FIXME the log10 primitive is dog slow
-        log = gr.nlog10_ff(10, self.fft_size,
-                           -20*math.log10(self.fft_size)-10*math.log10(power/self.fft_size))
+        # Reduce every FFT frame to (mean, peak) over the selected bins in the
+        # flowgraph. Only two floats per frame reach the log10 and the message
+        # queue, no matter how large the FFT is.
+        self.mean_mask = gr.multiply_const_vff([0.0] * self.fft_size)
+        self.peak_mask = gr.multiply_const_vff([0.0] * self.fft_size)
+        self.set_bin_fraction(options.sense_bin_fraction)
+        mean_v2s = gr.vector_to_stream(gr.sizeof_float, self.fft_size)
+        mean_sum = gr.integrate_ff(self.fft_size)
+        peak = gr.max_ff(self.fft_size)
+        interleave = gr.interleave(gr.sizeof_float)
+        
+        # Pilot detector: peak power in a few bins around a narrowband pilot
+        # (the ATSC pilot by default) against the mean power of the bins
+        # around it. A pilot stands out of the per-bin noise well before the
+        # whole channel's energy rises above thresh_primary.
+        self.pilot_channels = []
+        for chan in options.pilot_channels.split(','):
+            if chan.strip() != '':
+                self.pilot_channels.append(self.channels[int(chan)])
+        pilot_bin = int(round(options.pilot_offset * self.fft_size / self.usrp_rate))
+        pilot_guard = 8 * options.pilot_bins
+        if len(self.pilot_channels) > 0 and abs(pilot_bin) + pilot_guard >= self.fft_size / 2:
+            print "Note: pilot is outside the sensed band, increase --channel_rate to use the pilot detector"
+            self.pilot_channels = []
+        self.report_len = 2
+        if len(self.pilot_channels) > 0:
+            self.report_len = 4
+            pilot_k = [0.0] * self.fft_size
+            floor_k = [0.0] * self.fft_size
+            floor_bins = 2 * (pilot_guard - options.pilot_bins)
+            for b in range(-pilot_guard, pilot_guard + 1):
+                if abs(b) <= options.pilot_bins:
+                    pilot_k[(pilot_bin + b) % self.fft_size] = 1.0
+                else:
+                    floor_k[(pilot_bin + b) % self.fft_size] = 1.0 / floor_bins
+            pilot_mask = gr.multiply_const_vff(pilot_k)
+            floor_mask = gr.multiply_const_vff(floor_k)
+            pilot_peak = gr.max_ff(self.fft_size)
+            floor_v2s = gr.vector_to_stream(gr.sizeof_float, self.fft_size)
+            floor_sum = gr.integrate_ff(self.fft_size)
+            pilot_avg = gr.single_pole_iir_filter_ff(1.0 / options.pilot_avg)
+            floor_avg = gr.single_pole_iir_filter_ff(1.0 / options.pilot_avg)
+            self.connect(spectrum, pilot_mask, pilot_peak, pilot_avg, (interleave, 2))
+            self.connect(spectrum, floor_mask, floor_v2s, floor_sum, floor_avg, (interleave, 3))
+        reduced = gr.stream_to_vector(gr.sizeof_float, self.report_len)
+        log = gr.nlog10_ff(10, self.report_len, self.k)
         
         # Set the freq_step to 75% of the actual data throughput.
         # This allows us to discard the bins on both ends of the spectrum.
@@ -136,17 +312,42 @@ class sense_path(gr.hier_block2):
 
         self.next_freq = self.channels[self.current_chan] #self.min_center_freq
         
-        tune_delay  = max(0, int(round(options.tune_delay * self.usrp_rate / self.fft_size)))  # in fft_frames
-        dwell_delay = max(1, int(round(options.dwell_delay * self.usrp_rate / self.fft_size))) # in fft_frames
+        frame_len = self.fft_size * self.welch_depth #samples per spectrum frame
+        tune_delay  = max(0, int(round(options.tune_delay * self.usrp_rate / frame_len)))  # in fft_frames
+        if self.planner.enabled:
+            # most steps are DSP-only now, LO moves get a whole settling dwell
+            # of their own (see set_next_freq)
+            tune_delay = max(0, int(round(options.dsp_tune_delay * self.usrp_rate / frame_len)))
+        dwell_delay = max(1, int(round(options.dwell_delay * self.usrp_rate / frame_len))) # in fft_frames
+        # The averagers keep the last channel's power in their state across a
+        # retune; it takes about 1/alpha vectors to wash out. Frames before
+        # that are thrown away like the tune delay's.
+        self.settle_frames = 0
+        if self.welch_depth > 1:
+            self.settle_frames += 1 #welch_depth spectra, one frame after keep_one_in_n
+        if len(self.pilot_channels) > 0:
+            self.settle_frames += int(math.ceil(options.pilot_avg))
+        tune_delay = max(tune_delay, self.settle_frames)
+        self.stale_frames = 0 #frames still to throw away after a retune nobody waited out
+        self.tune_frames = tune_delay
+        self.dwell_frames = dwell_delay
 
         self.msgq = gr.msg_queue(16)
         self._tune_callback = tune(self)        # hang on to this to keep it from being GC'd
-        self.stats = gr.bin_statistics_f(self.fft_size, self.msgq,
+        self.stats = gr.bin_statistics_f(self.report_len, self.msgq,
                                     self._tune_callback, tune_delay, dwell_delay)
 
-        # FIXME leave out the log10 until we speed it up
-        #self.connect(self, s2v, fft, c2mag, log, stats)
-        self.connect(self, s2v, fft, c2mag, self.stats)
+        #log10 is cheap now that it only sees a few values per frame
+        #self.connect(self, s2v, fft, c2mag, self.stats)
+        self.connect(spectrum, self.mean_mask, mean_v2s, mean_sum, (interleave, 0))
+        self.connect(spectrum, self.peak_mask, peak, (interleave, 1))
+        self.connect(interleave, reduced, log, self.stats)
+        
+        # per-frame reduced power for sequential detection; drops frames if
+        # nobody is reading them
+        self.frame_msgq = gr.msg_queue(64)
+        frame_sink = gr.message_sink(self.report_len*gr.sizeof_float, self.frame_msgq, True)
+        self.connect(log, frame_sink)
 
         
     def set_next_freq(self):
@@ -154,8 +355,17 @@ class sense_path(gr.hier_block2):
             return 0 #current_freq
             
         target_freq = self.next_freq
-        self.current_chan = (self.current_chan + 1) % self.num_channels
-        self.next_freq = self.channels[self.current_chan] #self.next_freq + self.freq_step
+        if self.planner.enabled and self.planner.kind(target_freq) == "rf":
+            # Move the LO now and spend this dwell letting it settle. The
+            # report comes back with center_freq 0 and is thrown away; the
+            # next step reaches target_freq with a DSP-only retune.
+            if not self.set_freq(target_freq):
+                print "Failed to set frequency to", target_freq
+            if self.planner.kind(target_freq) == "dsp":
+                return 0
+            
+        self.current_chan = (self.current_chan + 1) % len(self.sweep_channels)
+        self.next_freq = self.sweep_channels[self.current_chan] #self.next_freq + self.freq_step
         #if self.next_freq >= self.max_center_freq:
         #    self.next_freq = self.min_center_freq
             
@@ -175,11 +385,130 @@ class sense_path(gr.hier_block2):
         tune as close to the desired frequency as it can.  Then we use
         the result of that operation and our target_frequency to
         determine the value for the digital down converter.
+        
+        The tuner callback reports successful tunes to self.planner.
         """
         #updated 2011 May 31, MR
         #return self.u.tune(0, self.subdev, target_freq)
         return self.usrp_tune(target_freq)
     
+    def set_bin_mask(self, bins):
+        """
+        Select the FFT bins that go into the mean and peak power.
+        
+        @param bins: list of bin indices (FFT order, bin 0 is the center frequency)
+        """
+        mean_k = [0.0] * self.fft_size
+        peak_k = [0.0] * self.fft_size
+        for b in bins:
+            mean_k[b] = 1.0 / len(bins)
+            peak_k[b] = 1.0
+        self.bins = list(bins)
+        self.mean_mask.set_k(mean_k)
+        self.peak_mask.set_k(peak_k)
+        
+    def set_bin_fraction(self, fraction):
+        """
+        Use the given fraction of the FFT bins, centered on the tuned frequency.
+        """
+        half_width = max(1, int(fraction * self.fft_size / 2))
+        bins = []
+        for b in range(self.fft_size):
+            #the FFT output isn't shifted, so the upper half are negative frequencies
+            if min(b, self.fft_size - b) <= half_width:
+                bins.append(b)
+        self.set_bin_mask(bins)
+        
+    def next_report(self):
+        """
+        Get the next sensing result (blocking call).
+        """
+        return channel_report(self.msgq.delete_head(), self.channels)
+    
+    def next_dwell_report(self):
+        """
+        Build a report from the next dwell_frames frames of the frame queue
+        (blocking call). Unlike next_report this doesn't wait out the tune
+        delay, for senses where nothing was retuned. Like bin_statistics, it
+        keeps the max of each value over the dwell.
+        """
+        peak = None
+        n = 0
+        while n < self.dwell_frames:
+            for f in self.parse_frames(self.frame_msgq.delete_head()):
+                if self.stale_frames > 0:
+                    self.stale_frames -= 1
+                    continue
+                n += 1
+                if peak is None:
+                    peak = list(f)
+                else:
+                    peak = map(max, peak, f)
+                if n == self.dwell_frames:
+                    break
+        t = struct.pack('%df' % (self.report_len,), *peak)
+        return channel_report(gr.message_from_string(t, 0, 0, self.report_len), self.channels)
+    
+    def next_frames(self):
+        """
+        Get the mean power (dB) of the FFT frames in the next frame message
+        (blocking call).
+        """
+        t = self.frame_msgq.delete_head().to_string()
+        n = len(t) / gr.sizeof_float
+        return struct.unpack('%df' % (n,), t)[0::self.report_len]
+    
+    def parse_frames(self, msg):
+        """
+        Split a frame message into per-frame tuples of (mean, peak) or
+        (mean, peak, pilot, floor) in dB.
+        """
+        t = msg.to_string()
+        n = len(t) / gr.sizeof_float
+        data = struct.unpack('%df' % (n,), t)
+        frames = []
+        for i in range(0, n - self.report_len + 1, self.report_len):
+            frames.append(data[i:i + self.report_len])
+        return frames
+    
+    def detector(self, center_freq):
+        """
+        Return which detector decides on primaries for a channel, "pilot"
+        or "energy".
+        """
+        for freq in self.pilot_channels:
+            if abs(freq - center_freq) < 1e3:
+                return "pilot"
+        return "energy"
+    
+    def set_sweep_channels(self, freqs):
+        """
+        Restrict the next sweeps to the given channels and restart the sweep
+        at the first of them.
+        
+        @param freqs: list of center frequencies (Hz)
+        """
+        self.sweep_channels = self.planner.order(freqs)
+        self.current_chan = 0
+        self.next_freq = self.sweep_channels[0]
+    
+    def sweep_reports(self):
+        """
+        Upper bound on the reports one pass over sweep_channels produces,
+        counting the settling dwells after LO moves.
+        """
+        n = len(self.sweep_channels)
+        if self.planner.enabled:
+            n += self.planner.lo_positions(self.sweep_channels)
+        return n
+    
+    def retuned(self):
+        """
+        The front end moved (to the data channel, or anywhere else outside a
+        sweep); the frames until the averagers have settled are stale.
+        """
+        self.stale_frames = self.settle_frames
+
     def set_hold_freq(self, hold):
         self.hold_freq = hold
         self.set_next_freq()
@@ -197,8 +526,26 @@ class sense_path(gr.hier_block2):
                           help="time to delay (in seconds) after changing frequency [default=%default]")
         normal.add_option("", "--dwell-delay", type="eng_float", default=.04, metavar="SECS",
                           help="time to dwell (in seconds) at a given frequncy [default=%default]")
+        normal.add_option("", "--sense-ttl", type="eng_float", default=0, metavar="SECS",
+                          help="reuse a sensing result for up to SECS seconds, 0 disables [default=%default]")
         normal.add_option("-F", "--sense-fft-size", type="int", default=512,
                           help="specify number of FFT bins [default=%default]")
+        normal.add_option("", "--welch-overlap", type="eng_float", default=0,
+                          help="overlap of Welch segments (0 to <1), 0 disables [default=%default]")
+        normal.add_option("", "--welch-depth", type="int", default=1,
+                          help="number of Welch frames averaged per spectrum [default=%default]")
+        normal.add_option("", "--sense-bin-fraction", type="eng_float", default=1.0,
+                          help="fraction of FFT bins (centered) used for channel power [default=%default]")
+        normal.add_option("", "--pilot-channels", type="string", default="",
+                          help="comma separated channel numbers that use the pilot detector [default=%default]")
+        expert.add_option("", "--pilot-offset", type="eng_float", default=-2.69056e6,
+                          help="pilot frequency relative to the channel center (ATSC) [default=%default]")
+        expert.add_option("", "--pilot-bins", type="int", default=2,
+                          help="bins on either side of the pilot to search [default=%default]")
+        expert.add_option("", "--pilot-avg", type="eng_float", default=8,
+                          help="frames averaged by the pilot detector [default=%default]")
+        expert.add_option("", "--pilot-thresh", type="eng_float", default=8,
+                          help="pilot detection threshold in dB over the local noise floor [default=%default]")
         normal.add_option("", "--threshold", type="eng_float", default=-54, 
                           help="set detection threshold [default=%default]")
         expert.add_option("", "--real-time", action="store_true", default=False,
@@ -209,6 +556,7 @@ class sense_path(gr.hier_block2):
         #                  help="set the start of the frequency band to sense over [default=%default]")
         #normal.add_option("", "--end-freq", type="eng_float", default="671M",
         #                  help="set the end of the frequency band to sense over [default=%default]")
+        tune_planner.add_options(normal, expert)
         expert.add_option("", "--chan-bandwidth", type="eng_float", default=6000000,
                           help="set the sample rate of each 6MHz channel [default=%default]")
     # Make a static method to call before instantiation
@@ -0,0 +1,575 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                       Asynchronous Spectrum Sense Service
+#
+# FuNLab
+# University of Washington
+#
+# Runs quiet period senses and channel sweeps in their own thread. The MAC
+# issues a request and gets a sense_request back right away (a very small
+# future), so its timers keep running while the PHY is sensing. Results are
+# picked up with sense_request.result() or by a callback.
+#
+# Only one request is serviced at a time since there is only one radio.
+# /////////////////////////////////////////////////////////////////////////////
+
+import time
+import threading
+import Queue
+
+from sequential_sense import sprt_detector, dwell_stats
+from spectrum_history import spectrum_history_writer
+from occupancy_model import occupancy_model
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              sense request
+# /////////////////////////////////////////////////////////////////////////////
+
+class sense_request(object):
+    """
+    Handle for a sensing operation that has been queued with the sense_service.
+    """
+    def __init__(self, kind, callback=None):
+        self.kind = kind
+        self.issued = time.time()
+        self.finished = None
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        Return True once the sensing operation has finished.
+        """
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the sensing operation and return its result.
+
+        @param timeout: seconds to wait, None waits forever
+        @return: the result, or None if the timeout expired first
+        """
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            return None
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(request) when the operation finishes. If it has already
+        finished, fn is called right away.
+        """
+        self._lock.acquire()
+        if not self.done():
+            self._callbacks.append(fn)
+            fn = None
+        self._lock.release()
+        if fn is not None:
+            fn(self)
+
+    def _finish(self, result, error=None):
+        self._lock.acquire()
+        self._result = result
+        self._error = error
+        self.finished = time.time()
+        self._event.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                print "sense_request: callback exception: ", e
+
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              sense service
+# /////////////////////////////////////////////////////////////////////////////
+
+class sense_service(threading.Thread):
+    """
+    Owns the sense side of the PHY and services sensing requests in order.
+
+    Callbacks run in the service thread before the request is retired, so a
+    callback that queues a follow-up request (e.g. a sweep after the current
+    channel turned out to be occupied) keeps busy() True without a gap.
+    """
+    def __init__(self, options):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.tb = None
+        self.verbose = options.verbose
+
+        #spectrum sense parameters
+        self.txrx_rate = options.samp_rate #transmit and receive bandwidth
+        self.channel_rate = options.channel_rate #sense bandwidth of channel (not nec. 6 MHz)
+        #sense through the rx stream without a rate switch
+        self.at_txrx_rate = options.sense_at_txrx_rate
+        self.thresh_primary = options.thresh_primary
+        self.thresh_second = options.thresh_second
+        self.thresh_qp = options.thresh_qp
+        self.pilot_thresh = options.pilot_thresh
+        self.old_freq = 0
+        self.backup_freq = None #second best channel of the last sweep
+
+        #sequential detection for quiet period senses
+        self.use_sprt = options.sprt
+        self.sprt_options = options
+        self.sprt = None
+        self.dwell_stats = dwell_stats()
+
+        #learn when the primaries come and go, to pick channels that stay free
+        self.model = None
+        if options.predict_channels:
+            self.model = occupancy_model(options.prior_idle)
+
+        #latest result per channel, {freq: (timestamp, result, power_db)}
+        self.results = {}
+        #time spent in quiet period senses
+        self.quiet_time = 0.0
+        self.quiet_senses = 0
+
+        #long term record of the reports
+        self.history_path = options.sense_history
+        self.history = None
+
+        self._requests = Queue.Queue()
+
+    def set_flow_graph(self, tb):
+        """
+        Gives the sense service access to the PHY.
+
+        @param tb: the top block of the GNURadio flowgraph representing the PHY
+        """
+        self.tb = tb
+        if self.use_sprt:
+            o = self.sprt_options
+            self.sprt = sprt_detector(self.thresh_primary, o.sprt_margin, o.sprt_sigma,
+                                      o.sprt_false_alarm, o.sprt_miss, tb.sense.dwell_frames)
+        if self.history_path is not None:
+            self.history = spectrum_history_writer(self.history_path, tb.sense.report_len)
+            self.history.start()
+
+    def stop(self):
+        """
+        Stop the service once all queued requests have been handled.
+        """
+        self._requests.put(None)
+
+    def busy(self):
+        """
+        Return True while a request is queued or in progress (the radio is
+        not available for tx/rx).
+        """
+        return self._requests.unfinished_tasks > 0
+
+    def quiet_sense_time(self):
+        """
+        Seconds a sense of the current channel keeps the radio, not
+        counting the rate switch: the settling frames (none when sensing at
+        the tx/rx rate) and the dwell, or the longest sequential test.
+        """
+        sense = self.tb.sense
+        frames = sense.dwell_frames
+        if self.sprt is not None:
+            frames = self.sprt.max_frames
+        if not self.at_txrx_rate:
+            frames += sense.tune_frames
+        return frames * sense.fft_size * sense.welch_depth / float(sense.usrp_rate)
+
+    def sense_current(self, callback=None):
+        """
+        Queue a sense of the current channel.
+
+        The result is 1 if a primary is present, 2 if a secondary is present,
+        3 if a qpCSMA/CA node is present and 0 if the channel is clear.
+
+        @param callback: optional fn(request) called when the sense is done
+        @rtype: sense_request
+        """
+        return self._submit(sense_request("current", callback))
+
+    def find_best_freq(self, callback=None, switch=True):
+        """
+        Queue a sweep of all channels followed by a switch to the best one.
+        The result is the chosen frequency.
+
+        @param callback: optional fn(request) called when the switch is done
+        @param switch: if False, return to the current channel after the
+                       sweep instead of switching (the switch is announced
+                       first and done with switch_to)
+        @rtype: sense_request
+        """
+        req = sense_request("sweep", callback)
+        req.switch = switch
+        return self._submit(req)
+
+    def switch_to(self, freq, callback=None):
+        """
+        Queue a move of the data channel to freq. The result is freq.
+
+        @rtype: sense_request
+        """
+        req = sense_request("switch", callback)
+        req.freq = freq
+        return self._submit(req)
+
+    def _submit(self, req):
+        self._requests.put(req)
+        return req
+
+    def run(self):
+        while True:
+            req = self._requests.get()
+            if req is None:
+                if self.history is not None:
+                    self.history.close()
+                    if self.history.dropped > 0:
+                        print "sense_service: history dropped", self.history.dropped, "reports"
+                self._requests.task_done()
+                break
+            try:
+                try:
+                    if req.kind == "current":
+                        result = self._sense_current_freq()
+                    elif req.kind == "switch":
+                        result = self._switch_to(req.freq)
+                    else:
+                        result = self._find_best_freq(req.switch)
+                    req._finish(result)
+                except Exception, e:
+                    print "sense_service: exception: ", e
+                    req._finish(None, e)
+            finally:
+                self._requests.task_done()
+
+    def classify(self, power_db):
+        """
+        Compare a channel power (dB) against the detection thresholds.
+
+        @return: 1 primary, 2 secondary, 3 qpCSMA/CA node, 0 clear
+        """
+        if power_db > self.thresh_primary:
+            return 1
+        elif power_db > self.thresh_second:
+            return 2
+        elif power_db > self.thresh_qp:
+            return 3
+        return 0
+
+    def classify_report(self, m, center_freq):
+        """
+        Classify a channel_report with the detector chosen for its channel.
+
+        @param center_freq: the channel the report is for (reports taken
+                            while holding frequency don't carry it)
+        """
+        if self.tb.sense.detector(center_freq) == "pilot" and m.pilot_db is not None:
+            if m.pilot_snr() > self.pilot_thresh:
+                return 1
+            #energy without a pilot is some other secondary, not a primary
+            return self.classify(min(m.mean_db, self.thresh_primary))
+        return self.classify(m.mean_db)
+
+    def record(self, m, center_freq, ret_val):
+        """
+        Add a classified channel_report to the occupancy model and the
+        spectrum history, if there are any.
+        """
+        values = [m.mean_db, m.peak_db]
+        if m.pilot_db is not None:
+            values += [m.pilot_db, m.floor_db]
+        self._record(center_freq, m.timestamp, ret_val, values)
+
+    def _record(self, center_freq, timestamp, ret_val, values):
+        """
+        @param values: mean and peak power, then pilot and floor power with
+                       the pilot detector on (dB)
+        """
+        center_freq = self.plan_freq(center_freq)
+        self._note(center_freq, timestamp, ret_val, values[0])
+        if self.history is None:
+            return
+        if len(values) != self.history.nvalues:
+            print "sense_service: not recording", len(values), "values, the history takes", \
+                  self.history.nvalues
+            return
+        self.history.add(timestamp, center_freq, values)
+
+    def pick_backup(self, exclude, freqs=None):
+        """
+        Pick a backup channel from what is known now: the channel the
+        occupancy model expects to stay free longest, or without a model the
+        quietest channel last sensed free.
+
+        @param exclude: channels that can't be the backup (current, target)
+        @param freqs: channels to choose from (default all)
+        """
+        if freqs is None:
+            freqs = self.tb.sense.channels
+        others = [f for f in freqs if f not in exclude]
+        backup = None
+        if self.model is not None:
+            backup = self.model.best_channel(others, time.time())
+        else:
+            best_db = None
+            for f in others:
+                entry = self.results.get(f)
+                if entry is not None and entry[1] != 1 and \
+                   (best_db is None or entry[2] < best_db):
+                    backup = f
+                    best_db = entry[2]
+        return backup
+
+    def plan_freq(self, freq):
+        """
+        Return the channel of the sensing plan freq is on, to the kHz the
+        sense cache keys on, or freq itself if it's on none.
+        """
+        for chan in self.tb.sense.channels:
+            if int(round(chan / 1e3)) == int(round(freq / 1e3)):
+                return chan
+        return freq
+
+    def current_freq(self):
+        """
+        Return the data channel as the plan has it, which is the key of the
+        results, the model and the fusion (the USRP reports the frequency it
+        actually tuned to, which is off by the synthesizer's resolution).
+        """
+        if self.tb.cur_freq is not None:
+            return self.tb.cur_freq
+        return self.plan_freq(self.tb.u_snk.get_center_freq())
+
+    def _note(self, freq, timestamp, ret_val, power_db):
+        freq = self.plan_freq(freq)
+        self.results[freq] = (timestamp, ret_val, power_db)
+        if self.model is not None:
+            self.model.update(freq, timestamp, ret_val == 1)
+
+    def prep_to_sense(self, hold_freq, sweep=None):
+        """
+        Prepare the PHY to sense the spectrum.
+
+        @param hold_freq: determines whether the PHY will switch channels as it senses.
+        @param sweep: channels to sweep over if not holding frequency (default all)
+        """
+        #set frequency hold
+        self.old_freq = self.current_freq()
+        #print self.old_freq
+        if not hold_freq:
+            if sweep is None:
+                sweep = self.tb.sense.channels
+            self.tb.sense.set_sweep_channels(sweep)
+        self.tb.sense.set_hold_freq(hold_freq)
+        #stop rcving, unless we're staying on the channel at the rx rate, in
+        #which case the receiver can keep its state through the quiet period
+        if not (hold_freq and self.at_txrx_rate):
+            self.tb.rx_valve.set_enabled(False)
+        #set rate (no-op when sensing at the tx/rx rate)
+        self.tb.set_rate(self.channel_rate)
+        #flush the queues
+        self.tb.sense.msgq.flush()
+        self.tb.sense.frame_msgq.flush()
+        #start the spectrum sense
+        self.tb.sense_valve.set_enabled(True)
+
+    def prep_to_txrx(self):
+        """
+        Prepare the PHY to transmit and receive data
+        """
+        #done sensing
+        self.tb.sense_valve.set_enabled(False)
+        #flush the queue
+        #self.tb.sense.msgq.flush()
+
+        #reset rate
+        self.tb.set_rate(self.txrx_rate)
+        #start rcving
+        self.tb.rx_valve.set_enabled(True)
+
+    def _find_best_freq(self, switch=True):
+        """
+        Gather spectrum sense data and interpret it to find the frequency with the lowest noise
+        floor.
+        """
+        #TODO
+        #Ok, this algorithm totally sucks. It would be better if I could reliably sense the
+        #simulated primary signal, but that interferes too much with adjacent channels, even if
+        #those adjacent channels are like 10 MHz away. Fricken USRPs.
+        #I'm cheating and making the USRPs choose one of only two frequencies. As soon as I get
+        #primary sensing more reliable, I'll switch back to the original frequency selection algorithm.
+        cache = self.tb.sense.cache
+        self.old_freq = self.current_freq()
+        frequencies = []
+        power_levels = []
+        sensed = False #the PHY is in sense mode
+        resweep = False
+        while len(frequencies) == 0:
+            #start from the recent results and only sweep the channels we
+            #don't have one for. Once we've swept, look at everything again.
+            results = {}
+            stale = []
+            for freq in self.tb.sense.channels:
+                entry = cache.get(freq, self.channel_rate)
+                if entry is None or resweep:
+                    stale.append(freq)
+                else:
+                    results[freq] = entry
+            if len(stale) > 0:
+                if not sensed:
+                    self.prep_to_sense(False, stale)
+                    sensed = True
+                else:
+                    self.tb.sense.set_sweep_channels(stale)
+                    self.tb.sense.msgq.flush()
+            #LO moves add a settling report (center_freq 0) of their own
+            i = 0
+            n_reports = self.tb.sense.sweep_reports()
+            pending = dict([(freq, True) for freq in stale])
+            while i < n_reports and len(pending) > 0:
+                i = i+1
+                # Get the next message sent from the C++ code (blocking call).
+                # It contains the center frequency and the channel power in dB
+                m = self.tb.sense.next_report()
+                if m.center_freq in pending:
+                    del pending[m.center_freq]
+
+                #the >200MHz thing is because sometimes m.center_freq is returned
+                #as 0 for some reason (bug somewhere?)
+                if m.center_freq > 200000000:
+                    results[m.center_freq] = (m.mean_db, self.classify_report(m, m.center_freq))
+                    self.record(m, m.center_freq, results[m.center_freq][1])
+                    cache.put(m.center_freq, self.channel_rate, *results[m.center_freq])
+
+            for freq in self.tb.sense.channels:
+                if freq in results and results[freq][1] != 1:
+                    frequencies.append(freq)
+                    power_levels.append(results[freq][0])
+            #if the cached results say everything is occupied, the next pass sweeps
+            resweep = True
+
+        best_freq = None
+        if self.model is not None:
+            #the free channel the primaries are likely to leave alone longest
+            best_freq = self.model.best_channel(frequencies, time.time(), self.old_freq)
+        if best_freq is None:
+            #TODO: stop cheating
+            if self.old_freq == self.tb.sense.channels[1]:
+                best_freq = self.tb.sense.channels[4]
+            else:
+                best_freq = self.tb.sense.channels[1]
+        #TODO: this is what it should be
+        #best_freq = power_levels.index(min(power_levels)) #choose the best frequency
+        #best_freq = frequencies[best_freq]
+
+        #keep a second channel ready in case the link is lost after a switch
+        self.backup_freq = self.pick_backup([best_freq, self.old_freq], frequencies)
+
+        print "\nchoosing frequency ", best_freq, " at time ", time.strftime("%X")
+        if switch:
+            self.tb.set_freq(best_freq)
+            #we'll be transmitting on the new channel and not on the old one
+            cache.invalidate(self.old_freq)
+            cache.invalidate(best_freq)
+        else:
+            #go back so the switch can be announced on the old channel
+            self.tb.set_freq(self.old_freq)
+        if sensed:
+            self.prep_to_txrx()
+        return best_freq
+
+    def _switch_to(self, freq):
+        """
+        Move the data channel to freq.
+        """
+        old_freq = self.current_freq()
+        if freq != old_freq:
+            print "\nswitching to frequency ", freq, " at time ", time.strftime("%X")
+            self.tb.set_freq(freq)
+            self.tb.sense.cache.invalidate(old_freq)
+            self.tb.sense.cache.invalidate(freq)
+        return freq
+
+    def _sense_current_freq(self):
+        """
+        sense the current channel and look for a primary user
+        """
+        freq = self.current_freq()
+        entry = self.tb.sense.cache.get(freq, self.channel_rate)
+        if entry is not None:
+            #measured recently enough, skip the rate switch and the dwell
+            return entry[1]
+
+        start = time.time()
+        self.prep_to_sense(True)
+        #do the sensing
+        if self.sprt is not None and self.tb.sense.detector(freq) == "energy":
+            ret_val, values = self._sense_sequential()
+            power_db = values[0]
+            self._record(freq, time.time(), ret_val, values)
+        elif self.at_txrx_rate:
+            #no rate switch or retune to wait out, just the dwell
+            m = self.tb.sense.next_dwell_report()
+            ret_val = self.classify_report(m, freq)
+            power_db = m.mean_db
+            self.record(m, freq, ret_val)
+        else:
+            m = self.tb.sense.next_report()
+            #print m.mean_db
+            ret_val = self.classify_report(m, freq)
+            power_db = m.mean_db
+            self.record(m, freq, ret_val)
+
+        self.prep_to_txrx()
+        self.quiet_time += time.time() - start
+        self.quiet_senses += 1
+        self.tb.sense.cache.put(freq, self.channel_rate, power_db, ret_val)
+
+        return ret_val
+
+    def _sense_sequential(self):
+        """
+        Sense frame by frame until the sequential test can decide.
+
+        @return: (result, values) with values the mean power the test saw,
+                 the peak and, with the pilot detector on, the mean pilot and
+                 floor power (dB), as record takes them
+        """
+        start = time.time()
+        skip = self.tb.sense.tune_frames #let the rate change settle
+        if self.at_txrx_rate:
+            skip = self.tb.sense.stale_frames #only a retune to wait out, if any
+        self.tb.sense.stale_frames = 0
+        self.sprt.reset()
+        decision = None
+        used = []
+        while decision is None:
+            msg = self.tb.sense.frame_msgq.delete_head()
+            for frame in self.tb.sense.parse_frames(msg):
+                if skip > 0:
+                    skip -= 1
+                    continue
+                used.append(frame)
+                decision = self.sprt.update(frame[0])
+                if decision is not None:
+                    break
+        self.dwell_stats.add(self.sprt.frames, time.time() - start,
+                             decision, self.sprt.truncated)
+
+        values = [self.sprt.mean_power(), max([f[1] for f in used])]
+        if len(used[0]) >= 4:
+            values += [sum([f[2] for f in used]) / len(used),
+                       sum([f[3] for f in used]) / len(used)]
+        if decision == 1:
+            return 1, values
+        #keep the secondary / qp levels, but the test has the final word on primaries
+        return self.classify(min(self.sprt.mean_power(), self.thresh_primary)), values
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# /////////////////////////////////////////////////////////////////////////////
+#                       Sequential Detection for Quiet Periods
+#
+# FuNLab
+# University of Washington
+#
+# A quiet period sense normally dwells for the whole --dwell-delay even when
+# the first FFT frame is already far above or below thresh_primary. The
+# sprt_detector runs Wald's sequential probability ratio test on the per-frame
+# channel power coming out of sense_path and stops as soon as the occupied /
+# free decision reaches the requested false alarm and miss probabilities.
+#
+# Per-frame power (in dB) is modelled as Gaussian with standard deviation
+# sigma around thresh_primary - margin (free) or thresh_primary + margin
+# (occupied).
+#
+# Running this file directly does a Monte Carlo check of the test and prints
+# the dwell time distribution and the achieved false alarm and miss rates.
+# /////////////////////////////////////////////////////////////////////////////
+
+from gnuradio.eng_option import eng_option
+from optparse import OptionParser
+
+import math
+import random
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              SPRT detector
+# /////////////////////////////////////////////////////////////////////////////
+
+class sprt_detector(object):
+    """
+    Sequential probability ratio test between a free and an occupied channel.
+    """
+    def __init__(self, threshold, margin, sigma, false_alarm, miss, max_frames):
+        """
+        @param threshold: primary detection threshold in dB
+        @param margin: distance (dB) of the free/occupied means from the threshold
+        @param sigma: standard deviation (dB) of the per-frame power
+        @param false_alarm: target probability of calling a free channel occupied
+        @param miss: target probability of calling an occupied channel free
+        @param max_frames: frames after which the test is truncated
+        """
+        self.mu0 = threshold - margin
+        self.mu1 = threshold + margin
+        self.max_frames = max(1, max_frames)
+        self.upper = math.log((1.0 - miss) / false_alarm)
+        self.lower = math.log(miss / (1.0 - false_alarm))
+        self.scale = (self.mu1 - self.mu0) / (sigma * sigma)
+        self.midpoint = (self.mu0 + self.mu1) / 2.0
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new test.
+        """
+        self.llr = 0.0
+        self.frames = 0
+        self.power_sum = 0.0
+        self.truncated = False
+        self.decision = None
+
+    def mean_power(self):
+        """
+        Average power (dB) of the frames seen so far.
+        """
+        if self.frames == 0:
+            return self.mu0
+        return self.power_sum / self.frames
+
+    def update(self, power_db):
+        """
+        Add one frame to the test.
+
+        @param power_db: channel power of the frame in dB
+        @return: 1 if the channel is occupied, 0 if it is free, None if the
+                 test needs more frames
+        """
+        if self.decision is not None:
+            return self.decision
+        self.frames += 1
+        self.power_sum += power_db
+        self.llr += self.scale * (power_db - self.midpoint)
+        if self.llr >= self.upper:
+            self.decision = 1
+        elif self.llr <= self.lower:
+            self.decision = 0
+        elif self.frames >= self.max_frames:
+            #out of quiet period, fall back on the sign of the log-likelihood
+            self.truncated = True
+            if self.llr > 0:
+                self.decision = 1
+            else:
+                self.decision = 0
+        return self.decision
+
+    def add_options(normal, expert):
+        """
+        Adds sequential detection options to the Options Parser
+        """
+        normal.add_option("", "--sprt", action="store_true", default=False,
+                          help="end quiet period senses early with a sequential test [default=%default]")
+        expert.add_option("", "--sprt-margin", type="eng_float", default=3,
+                          help="dB between thresh_primary and the free/occupied means [default=%default]")
+        expert.add_option("", "--sprt-sigma", type="eng_float", default=2,
+                          help="standard deviation of the per-frame power in dB [default=%default]")
+        expert.add_option("", "--sprt-false-alarm", type="eng_float", default=.01,
+                          help="target false alarm probability [default=%default]")
+        expert.add_option("", "--sprt-miss", type="eng_float", default=.01,
+                          help="target miss probability [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
+
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              dwell statistics
+# /////////////////////////////////////////////////////////////////////////////
+
+class dwell_stats(object):
+    """
+    Keeps track of how long each sequential test dwelled and what it decided.
+    If the true channel state is known (benchmarks) the achieved false alarm
+    and miss rates are reported as well.
+    """
+    def __init__(self):
+        self.frames = []
+        self.seconds = []
+        self.truncated = 0
+        self.false_alarms = 0
+        self.misses = 0
+        self.free_tests = 0
+        self.occupied_tests = 0
+
+    def add(self, frames, seconds, decision, truncated, truth=None):
+        """
+        Record one finished test.
+
+        @param truth: 1 if a primary was really there, 0 if not, None if unknown
+        """
+        self.frames.append(frames)
+        self.seconds.append(seconds)
+        if truncated:
+            self.truncated += 1
+        if truth == 0:
+            self.free_tests += 1
+            if decision == 1:
+                self.false_alarms += 1
+        elif truth == 1:
+            self.occupied_tests += 1
+            if decision == 0:
+                self.misses += 1
+
+    def report(self):
+        """
+        Print the dwell time distribution and error rates.
+        """
+        n = len(self.frames)
+        if n == 0:
+            print "no sequential senses were done"
+            return
+        frames = sorted(self.frames)
+        seconds = sorted(self.seconds)
+        print "sequential senses:           ", n
+        print "dwell frames min/med/90%/max:", frames[0], frames[n/2], \
+              frames[min(n - 1, (9*n)/10)], frames[-1]
+        print "avg dwell frames:            ", float(sum(frames))/n
+        print "avg dwell time:              ", sum(seconds)/n
+        print "90th percentile dwell time:  ", seconds[min(n - 1, (9*n)/10)]
+        print "truncated tests:             ", self.truncated
+        if self.free_tests:
+            print "false alarm rate:            ", float(self.false_alarms)/self.free_tests
+        if self.occupied_tests:
+            print "miss rate:                   ", float(self.misses)/self.occupied_tests
+
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                   main
+# /////////////////////////////////////////////////////////////////////////////
+
+def main():
+    parser = OptionParser(option_class=eng_option, conflict_handler="resolve")
+    parser.add_option("", "--trials", type="int", default=10000,
+                      help="number of simulated senses per hypothesis [default=%default]")
+    parser.add_option("", "--noise-db", type="eng_float", default=-56,
+                      help="mean per-frame power of a free channel [default=%default]")
+    parser.add_option("", "--primary-db", type="eng_float", default=-44,
+                      help="mean per-frame power of an occupied channel [default=%default]")
+    parser.add_option("", "--max-frames", type="int", default=78,
+                      help="frames in a full dwell [default=%default]")
+    sprt_detector.add_options(parser, parser)
+    parser.add_option("", "--thresh_primary", type="eng_float", default=-50,
+                      help="set primary detection threshold [default=%default]")
+    (options, args) = parser.parse_args()
+
+    det = sprt_detector(options.thresh_primary, options.sprt_margin, options.sprt_sigma,
+                        options.sprt_false_alarm, options.sprt_miss, options.max_frames)
+    stats = dwell_stats()
+    for truth, mean in ((0, options.noise_db), (1, options.primary_db)):
+        for i in range(options.trials):
+            det.reset()
+            decision = None
+            while decision is None:
+                decision = det.update(random.gauss(mean, options.sprt_sigma))
+            stats.add(det.frames, 0.0, decision, det.truncated, truth)
+    stats.report()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
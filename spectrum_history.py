@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# /////////////////////////////////////////////////////////////////////////////
+#                           Spectrum History Store
+#
+# FuNLab
+# University of Washington
+#
+# Keeps every sensing report in an append-only, memory-mapped file so channel
+# occupancy can be looked at after a long run.
+#
+# File layout (little endian):
+#   header   magic "SPHIST01", version (I), values per record (I),
+#            number of records (Q), padded to 32 bytes
+#   records  timestamp (d), center_freq (d), nvalues power values in dB (f)
+#
+# The values are the reduced report from sense_path: mean and peak power, plus
+# pilot and floor power when the pilot detector is on. A sidecar file
+# (<name>.idx) holds (timestamp (d), record number (Q)) pairs every
+# index-interval seconds, so a reader can find a time range without scanning.
+#
+# Records are handed to a writer thread through a bounded queue. If the disk
+# falls behind, reports are dropped and counted rather than holding up the
+# sensing thread.
+#
+# Running this file prints the records of a history file, optionally limited
+# to a time range and a channel.
+# /////////////////////////////////////////////////////////////////////////////
+
+from optparse import OptionParser
+
+import os
+import mmap
+import struct
+import bisect
+import threading
+import Queue
+import time
+
+MAGIC = "SPHIST01"
+VERSION = 1
+HEADER_FMT = "<8sIIQ8x"
+HEADER_LEN = struct.calcsize(HEADER_FMT)
+INDEX_FMT = "<dQ"
+INDEX_LEN = struct.calcsize(INDEX_FMT)
+
+def record_fmt(nvalues):
+    return "<dd%df" % (nvalues,)
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                  writer
+# /////////////////////////////////////////////////////////////////////////////
+
+class spectrum_history_writer(threading.Thread):
+    """
+    Appends sensing reports to a history file from its own thread.
+    """
+    def __init__(self, path, nvalues, queue_len=4096, index_interval=1.0,
+                 chunk_records=16384):
+        """
+        @param path: history file, appended to if it exists with the same layout
+        @param nvalues: power values per record
+        @param queue_len: reports that can be waiting for the disk
+        @param index_interval: seconds between time index entries
+        @param chunk_records: records the file grows by at a time
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.nvalues = nvalues
+        self.fmt = record_fmt(nvalues)
+        self.rec_len = struct.calcsize(self.fmt)
+        self.index_interval = index_interval
+        self.chunk_records = chunk_records
+        self.written = 0
+        self.dropped = 0 # reports that didn't make it to the file
+
+        self.count = 0
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_LEN:
+            f = open(path, 'rb')
+            magic, version, n, count = struct.unpack(HEADER_FMT, f.read(HEADER_LEN))
+            f.close()
+            if magic != MAGIC or version != VERSION or n != nvalues:
+                raise ValueError, "%s is not a history file with %d values per record" % (path, nvalues)
+            self.count = count
+            self.f = open(path, 'r+b')
+        else:
+            self.f = open(path, 'w+b')
+            self.f.write(struct.pack(HEADER_FMT, MAGIC, VERSION, nvalues, 0))
+            self.f.flush()
+        self.map = None
+        self._map_file(self.count + chunk_records)
+
+        self.index = open(path + ".idx", 'ab')
+        self.last_index = 0
+
+        self._queue = Queue.Queue(queue_len)
+
+    def _map_file(self, capacity):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.f.truncate(HEADER_LEN + capacity*self.rec_len)
+        self.capacity = capacity
+        self.map = mmap.mmap(self.f.fileno(), HEADER_LEN + capacity*self.rec_len)
+
+    def add(self, timestamp, center_freq, values):
+        """
+        Queue one report for writing. Never blocks; if the queue is full the
+        report is dropped.
+
+        @param values: sequence of nvalues powers in dB
+        """
+        if len(values) != self.nvalues:
+            raise ValueError, "history records take %d values, not %d" % (self.nvalues, len(values))
+        try:
+            self._queue.put_nowait((timestamp, center_freq, values))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write out everything that is queued and close the file.
+        """
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            #take whatever else is waiting so the header is updated once
+            try:
+                while batch[-1] is not None and len(batch) < 256:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            done = batch[-1] is None
+            if done:
+                batch.pop()
+            try:
+                self._write(batch)
+            except Exception, e:
+                #keep the thread alive, a dead writer would drop everything after
+                print "spectrum_history: lost %d reports: %s" % (len(batch), e)
+                self.dropped += len(batch)
+            if done:
+                break
+        self.map.flush()
+        self.map.close()
+        #don't leave the unused capacity at the end of the file
+        self.f.truncate(HEADER_LEN + self.count*self.rec_len)
+        self.f.close()
+        self.index.close()
+
+    def _write(self, batch):
+        if len(batch) == 0:
+            return
+        if self.count + len(batch) > self.capacity:
+            self._map_file(self.count + len(batch) + self.chunk_records)
+        for (timestamp, center_freq, values) in batch:
+            if timestamp - self.last_index >= self.index_interval:
+                self.index.write(struct.pack(INDEX_FMT, timestamp, self.count))
+                self.last_index = timestamp
+            struct.pack_into(self.fmt, self.map, HEADER_LEN + self.count*self.rec_len,
+                             timestamp, center_freq, *values)
+            self.count += 1
+        #readers only trust the records the header counts
+        struct.pack_into(HEADER_FMT, self.map, 0, MAGIC, VERSION, self.nvalues, self.count)
+        self.index.flush()
+        self.written += len(batch)
+
+    def add_options(normal, expert):
+        """
+        Adds spectrum history options to the Options Parser
+        """
+        normal.add_option("", "--sense-history", type="string", default=None, metavar="FILE",
+                          help="append every sensing report to FILE [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
+
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                  reader
+# /////////////////////////////////////////////////////////////////////////////
+
+class spectrum_history_reader(object):
+    """
+    Reads records out of a history file without loading all of it. The file
+    may still be growing; the records present when it was opened are seen.
+    """
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        self.map = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, self.nvalues, count = struct.unpack_from(HEADER_FMT, self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError, "%s is not a spectrum history file" % (path,)
+        self.fmt = record_fmt(self.nvalues)
+        self.rec_len = struct.calcsize(self.fmt)
+        self.count = min(count, (size - HEADER_LEN) / self.rec_len)
+
+        self.index_times = []
+        self.index_records = []
+        if os.path.exists(path + ".idx"):
+            t = open(path + ".idx", 'rb').read()
+            for i in range(len(t) / INDEX_LEN):
+                timestamp, n = struct.unpack_from(INDEX_FMT, t, i*INDEX_LEN)
+                if n < self.count:
+                    self.index_times.append(timestamp)
+                    self.index_records.append(n)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, n):
+        """
+        Return record n as (timestamp, center_freq, values).
+        """
+        r = struct.unpack_from(self.fmt, self.map, HEADER_LEN + n*self.rec_len)
+        return (r[0], r[1], r[2:])
+
+    def slice(self, start=None, end=None, center_freq=None):
+        """
+        Generate the records with start <= timestamp <= end, optionally only
+        those for one channel.
+        """
+        first = 0
+        if start is not None:
+            i = bisect.bisect_right(self.index_times, start) - 1
+            if i >= 0:
+                first = self.index_records[i]
+        for n in xrange(first, self.count):
+            r = self.record(n)
+            if start is not None and r[0] < start:
+                continue
+            if end is not None and r[0] > end:
+                break
+            if center_freq is not None and abs(r[1] - center_freq) >= 1:
+                continue
+            yield r
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+
+# /////////////////////////////////////////////////////////////////////////////
+#                                   main
+# /////////////////////////////////////////////////////////////////////////////
+
+def main():
+    parser = OptionParser(usage="%prog [options] FILE")
+    parser.add_option("", "--start", type="float", default=None,
+                      help="first timestamp (seconds since the epoch) [default=%default]")
+    parser.add_option("", "--end", type="float", default=None,
+                      help="last timestamp (seconds since the epoch) [default=%default]")
+    parser.add_option("", "--channel", type="float", default=None,
+                      help="only show this center frequency (Hz) [default=%default]")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        raise SystemExit, 1
+
+    reader = spectrum_history_reader(args[0])
+    for (timestamp, center_freq, values) in reader.slice(options.start, options.end,
+                                                          options.channel):
+        print "%s %.6f %12.0f %s" % (time.strftime("%X", time.localtime(timestamp)), timestamp,
+                                     center_freq, " ".join(["%7.2f" % v for v in values]))
+    reader.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -25,6 +25,55 @@ from gnuradio import eng_notation
 
 import copy
 import sys
+import threading
+import Queue
+import heapq
+import time
+
+# from current dir
+from pick_bitrate import ofdm_frame_symbols, link_rates
+import fec
+
+# /////////////////////////////////////////////////////////////////////////////
+#                              burst modulator
+# /////////////////////////////////////////////////////////////////////////////
+
+class burst_modulator(gr.top_block):
+    """
+    An ofdm_mod running in its own flow graph, turning one payload at a
+    time into the complex samples of its frame.
+    """
+    def __init__(self, options):
+        gr.top_block.__init__(self, "burst_modulator")
+        self.ofdm_tx = blks2.ofdm_mod(options, msgq_limit=2, pad_for_usrp=False)
+        self.msgq = gr.msg_queue()
+        self.connect(self.ofdm_tx, gr.message_sink(gr.sizeof_gr_complex, self.msgq, False))
+        self._frame_bytes = (options.fft_length + options.cp_length) * gr.sizeof_gr_complex
+        self._occupied_tones = options.occupied_tones
+        self._modulation = options.modulation
+        self._busy = threading.Lock()
+        self.start()
+
+    def modulate(self, payload):
+        """
+        Return the samples of payload's frame as a string (blocking call).
+        The modulator holds nothing back, so all of the frame's symbols
+        come out once the payload is in; reading exactly that many keeps
+        frames from running into each other.
+        """
+        n = ofdm_frame_symbols(len(payload), self._occupied_tones,
+                               self._modulation) * self._frame_bytes
+        self._busy.acquire()
+        try:
+            self.ofdm_tx.send_pkt(payload)
+            chunks = []
+            got = 0
+            while got < n:
+                chunks.append(self.msgq.delete_head().to_string())
+                got += len(chunks[-1])
+            return "".join(chunks)
+        finally:
+            self._busy.release()
 
 # /////////////////////////////////////////////////////////////////////////////
 #                              transmit path
@@ -45,12 +94,87 @@ class transmit_path(gr.hier_block2):
         self._verbose      = options.verbose         # turn verbose mode on/off
         self._tx_amplitude = options.tx_amplitude    # digital amplitude sent to USRP
 
-        self.ofdm_tx = \
-                     blks2.ofdm_mod(options, msgq_limit=4, pad_for_usrp=False)
+        # -m is the base rate, used when a packet doesn't ask for another.
+        # With one rate and no waveform cache, the rate's ofdm_mod is the
+        # output. With several rates or the cache, every frame is modulated
+        # ahead by a modulator in a flow graph of its own (one per rate)
+        # unless the cache has its samples, and the samples go out through
+        # one message source that stays connected, so a rate change or a
+        # control frame never rewires the output; see _submit.
+        rates = link_rates(options)
+        self._stream = options.timed_tx or options.tx_notify
+        self._relay = options.ctl_cache or len(rates) > 1 or self._stream
+        self._base_modulation = options.modulation
+        self._bursts = {}
+        if self._relay:
+            for modulation in rates:
+                o = copy.copy(options)
+                o.modulation = modulation
+                self._bursts[modulation] = burst_modulator(o)
+            self._iq_msgq = gr.msg_queue(options.tx_queue_depth)
+            self.ofdm_tx = gr.message_source(gr.sizeof_gr_complex, self._iq_msgq)
+        else:
+            self.ofdm_tx = blks2.ofdm_mod(options, msgq_limit=options.tx_queue_depth,
+                                          pad_for_usrp=False)
+
+        # modulated control frames, (payload, modulation) -> samples
+        self._cache = {}
+        self._cache_size = options.ctl_cache_size
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._mod_lock = threading.Lock()
+        self._fec = options.fec
+        self._tx_queue_depth = options.tx_queue_depth
+
+        # packets handed to send_pkts(block=False) wait here for the feeder
+        # thread, which is the one that blocks on the modulator's queue
+        self._tx_backlog = options.tx_backlog
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._feeder = None
+        self._batches = Queue.Queue()
+
+        # With --timed-tx the output never stops: a streamer thread keeps
+        # tx_latency + tx_lead seconds of samples ahead of the device, zeros
+        # when there is nothing to send. Sample n then goes on the air at
+        # t0 + n/rate on the device clock (see set_clock), so a timed frame
+        # is placed at the sample of its air time instead of being released
+        # on the host clock. When the device gets ahead of the stream (it
+        # ran dry) t0 is taken again.
+        self._tx_lead = options.tx_lead
+        self._tx_latency = options.tx_latency
+        self._clock = None
+        self._clock_offset = 0.0  # device clock - time.time()
+        self._clock_synced = None
+        self._samp_rate = None
+        self._t0 = None
+        self._written = 0
+        self._queued = []
+        self._timed = []
+        self._stream_cond = threading.Condition()
+        self._streamer = None
+        self._stream_eof = False
+        self._zeros = ""
+        self.timed_sent = 0
+        self.timed_late = 0
+        self.max_release_error = 0.0
+        self.min_device_lead = None
+        self.underflows = 0
 
         self.amp = gr.multiply_const_cc(1)
         self.set_tx_amplitude(self._tx_amplitude)
 
+        # frames written to the stream, in order, as [frame id, index after
+        # its last sample]; the streamer retires them once the device has
+        # played that sample
+        self._frame_id = 0
+        self._id_lock = threading.Lock()
+        self._in_flight = []
+        self._tx_done_callback = None
+        self._occupied_tones = options.occupied_tones
+        self._symbol_len = options.fft_length + options.cp_length
+
         # Display some information about the setup
         if self._verbose:
             self._print_verbage()
@@ -68,19 +192,445 @@ class transmit_path(gr.hier_block2):
         self._tx_amplitude = max(0.0, min(ampl, 1.0))
         self.amp.set_k(self._tx_amplitude)
         
-    def send_pkt(self, payload='', eof=False):
+    def send_pkt(self, payload='', eof=False, tx_time=None, modulation=None, cache=False):
         """
         Calls the transmitter method to send a packet
+
+        @param tx_time: time.time() at which the packet should go on the air,
+                        None sends it now (needs --timed-tx and set_clock).
+                        Timed packets are modulated and placed on the
+                        stream at that time, and this returns without
+                        waiting for it; they go ahead of packets still
+                        waiting in send_pkts' backlog.
+        @param modulation: one of the link rates, None for the base rate
+        @param cache: keep the modulated frame for the next time the same
+                      payload is sent (with --ctl-cache); for frames that
+                      repeat, like RTS/CTS/ACK
         """
-        return self.ofdm_tx.send_pkt(payload, eof)
+        frame_id = self._new_id()
+        if tx_time is not None:
+            self._schedule(tx_time, frame_id, payload, modulation, cache)
+            return frame_id
+        # keep the order with packets still waiting in the feeder
+        self.flush()
+        if eof and self._stream:
+            self._stream_cond.acquire()
+            self._stream_eof = True
+            self._stream_cond.notifyAll()
+            self._stream_cond.release()
+        elif eof and self._relay:
+            self._iq_msgq.insert_tail(gr.message(1))
+        elif eof:
+            self.ofdm_tx.send_pkt(payload, eof)
+        else:
+            self._submit(frame_id, payload, modulation, cache)
+        return frame_id
+
+    def _new_id(self):
+        self._id_lock.acquire()
+        self._frame_id += 1
+        frame_id = self._frame_id
+        self._id_lock.release()
+        return frame_id
+
+    def _submit(self, frame_id, payload, modulation=None, cache=False):
+        """
+        Hand one packet to the modulator (blocks if its queue is full).
+        """
+        if modulation is None:
+            modulation = self._base_modulation
+        if self._relay:
+            self._submit_burst(frame_id, self._burst(payload, modulation, cache))
+            return
+        if modulation != self._base_modulation:
+            raise ValueError, "%s is not one of the link rates" % (modulation,)
+        if self._fec != "none":
+            payload = fec.encode(payload, self._fec)
+        self._mod_lock.acquire()
+        try:
+            self.ofdm_tx.send_pkt(payload)
+        finally:
+            self._mod_lock.release()
+
+    def _burst(self, payload, modulation, cache=False):
+        """
+        Return the samples of a frame, from the cache if it's there.
+
+        @param cache: look the frame up in the cache and keep it there
+        """
+        key = (payload, modulation)
+        if cache:
+            self._cache_lock.acquire()
+            burst = self._cache.get(key)
+            if burst is not None:
+                self.cache_hits += 1
+            self._cache_lock.release()
+            if burst is not None:
+                return burst
+        if modulation not in self._bursts:
+            raise ValueError, "%s is not one of the link rates" % (modulation,)
+        coded = payload
+        if self._fec != "none":
+            coded = fec.encode(payload, self._fec)
+        burst = self._bursts[modulation].modulate(coded)
+        if cache:
+            self._cache_lock.acquire()
+            self.cache_misses += 1
+            if len(self._cache) < self._cache_size:
+                self._cache[key] = burst
+            self._cache_lock.release()
+        return burst
+
+    def _submit_burst(self, frame_id, burst):
+        if self._stream:
+            self._stream_cond.acquire()
+            self._start_stream()
+            while len(self._queued) >= self._tx_queue_depth:
+                self._stream_cond.wait()
+            self._queued.append((frame_id, burst))
+            self._stream_cond.notifyAll()
+            self._stream_cond.release()
+            return
+        self._mod_lock.acquire()
+        try:
+            self._iq_msgq.insert_tail(gr.message_from_string(burst))
+        finally:
+            self._mod_lock.release()
+
+    def cache_frames(self, payloads, modulation=None, block=True):
+        """
+        Modulate frames into the waveform cache ahead of their first send
+        (with --ctl-cache).
+
+        @param block: if False, do it in a thread of its own
+        """
+        if not self._relay:
+            return
+        if modulation is None:
+            modulation = self._base_modulation
+        if not block:
+            t = threading.Thread(target=self.cache_frames, args=(payloads, modulation))
+            t.setDaemon(True)
+            t.start()
+            return
+        for payload in payloads:
+            if (payload, modulation) not in self._cache:
+                self._burst(payload, modulation, True)
+
+    def cache_report(self):
+        """
+        Print how often the waveform cache was used.
+        """
+        print "cached frames:          ", len(self._cache)
+        print "cache hits:             ", self.cache_hits
+        print "cache misses:           ", self.cache_misses
+
+    def frame_symbols(self, payload_len, modulation=None):
+        """
+        Number of OFDM symbols the modulator makes out of a payload.
+        """
+        if modulation is None:
+            modulation = self._base_modulation
+        return ofdm_frame_symbols(payload_len, self._occupied_tones, modulation)
+
+    def frame_time(self, payload_len, samp_rate, modulation=None):
+        """
+        Seconds the frame of a payload takes on the air at samp_rate.
+        """
+        return self.frame_symbols(payload_len, modulation) * self._symbol_len / float(samp_rate)
+
+    def set_tx_done_callback(self, callback):
+        """
+        Call callback(frame id, time) when the device has played the last
+        sample of a frame (needs --tx-notify and set_clock). The time is the
+        time.time() of that sample on the stream's clock, and the id is the
+        one send_pkt returned. It runs in the streamer thread.
+        """
+        self._tx_done_callback = callback
+
+    def set_clock(self, clock, samp_rate):
+        """
+        Give the clock timed packets are placed against, and the rate the
+        sink plays samples at. Call it again when the sink's rate changes;
+        the stream is then taken up from the device's time again.
+
+        @param clock: returns the device's time in seconds, e.g. from the
+                      UHD sink's get_time_now()
+        """
+        self._stream_cond.acquire()
+        self._clock = clock
+        self._clock_synced = None
+        self._samp_rate = float(samp_rate)
+        self._t0 = None
+        ahead = self._tx_latency + self._tx_lead
+        self._zeros = "\0" * (int(self._samp_rate * ahead + 2) * gr.sizeof_gr_complex)
+        self._stream_cond.notifyAll()
+        self._stream_cond.release()
+
+    def _device_time(self):
+        """
+        The device's time now. The device is asked once a second (it's a
+        round trip over the bus) and time.time() carries it in between.
+        """
+        if self._clock is None:
+            return time.time()
+        now = time.time()
+        if self._clock_synced is None or now - self._clock_synced > 1.0:
+            before = time.time()
+            device = self._clock()
+            after = time.time()
+            self._clock_offset = device - (before + after) / 2.0
+            self._clock_synced = after
+            now = after
+        return now + self._clock_offset
+
+    def _start_stream(self):
+        # called with _stream_cond held
+        if self._samp_rate is None:
+            raise ValueError, "timed sends need set_clock() first"
+        if self._streamer is None:
+            self._streamer = threading.Thread(target=self._run_stream)
+            self._streamer.setDaemon(True)
+            self._streamer.start()
+
+    def _schedule(self, tx_time, frame_id, payload, modulation, cache):
+        if not self._stream:
+            raise ValueError, "timed sends need --timed-tx"
+        #modulated here, the streamer must never wait for a modulator
+        burst = self._burst(payload, modulation, cache)
+        self._stream_cond.acquire()
+        self._start_stream()
+        heapq.heappush(self._timed, (tx_time, frame_id, burst))
+        self._stream_cond.notifyAll()
+        self._stream_cond.release()
+
+    def _run_stream(self):
+        while True:
+            done = []
+            self._stream_cond.acquire()
+            try:
+                if self._stream_eof and not self._queued and not self._timed:
+                    break
+                rate = self._samp_rate
+                now = self._device_time()
+                if self._t0 is None or now > self._t0 + self._written / rate:
+                    #the device ran dry (or we just started): the next
+                    #sample goes out as soon as it gets there
+                    if self._t0 is not None:
+                        self.underflows += 1
+                    self._t0 = now + self._tx_latency - self._written / rate
+                done = self._retire(now)
+                horizon = int((now - self._t0 + self._tx_latency + self._tx_lead) * rate)
+                out = []
+                if self._written < horizon:
+                    out = self._fill(horizon, now)
+                elif not done:
+                    wait = (self._written - horizon) / rate
+                    if self._in_flight:
+                        #wake up for the next frame's end, too
+                        wait = min(wait, self._t0 + self._in_flight[0][1] / rate - now)
+                    self._stream_cond.wait(max(.0002, wait))
+            finally:
+                self._stream_cond.release()
+            for samples in out:
+                self._iq_msgq.insert_tail(gr.message_from_string(samples))
+            self._notify_done(done)
+        self._iq_msgq.insert_tail(gr.message(1))
+
+    def _fill(self, horizon, now):
+        """
+        Write the stream up to horizon: timed frames at their sample,
+        other frames where they fit before the next timed one, zeros in
+        between. Called with _stream_cond held.
+        """
+        rate = self._samp_rate
+        out = []
+        while self._written < horizon:
+            start = None
+            if self._timed:
+                tx_time, frame_id, burst = self._timed[0]
+                start = int(round((tx_time + self._clock_offset - self._t0) * rate))
+                if start <= self._written:
+                    heapq.heappop(self._timed)
+                    #how late the frame goes on the air, in samples of the
+                    #device's clock, and how far ahead of the device it is
+                    error = (self._written - start) / rate
+                    if self._written > start:
+                        self.timed_late += 1
+                    self.max_release_error = max(self.max_release_error, error)
+                    lead = self._t0 + self._written / rate - now
+                    if self.min_device_lead is None or lead < self.min_device_lead:
+                        self.min_device_lead = lead
+                    self.timed_sent += 1
+                    self._place(frame_id, burst, out)
+                    continue
+            if self._queued:
+                frame_id, burst = self._queued[0]
+                n = len(burst) / gr.sizeof_gr_complex
+                if start is None or self._written + n <= start:
+                    del self._queued[0]
+                    self._stream_cond.notifyAll()
+                    self._place(frame_id, burst, out)
+                    continue
+            end = horizon
+            if start is not None:
+                end = min(end, start)
+            n = end - self._written
+            out.append(self._zeros[:n * gr.sizeof_gr_complex])
+            self._written = end
+        return out
+
+    def _place(self, frame_id, burst, out):
+        out.append(burst)
+        self._written += len(burst) / gr.sizeof_gr_complex
+        if self._tx_done_callback is not None:
+            self._in_flight.append([frame_id, self._written])
+
+    def _retire(self, now):
+        """
+        Take the frames whose last sample the device has played off the
+        in flight list, as (frame id, time.time() it went). Called with
+        _stream_cond held.
+        """
+        done = []
+        while self._in_flight:
+            end = self._t0 + self._in_flight[0][1] / self._samp_rate
+            if end > now:
+                break
+            done.append((self._in_flight.pop(0)[0], end - self._clock_offset))
+        return done
+
+    def _notify_done(self, done):
+        callback = self._tx_done_callback
+        for (frame_id, t) in done:
+            if callback is not None:
+                try:
+                    callback(frame_id, t)
+                except Exception, e:
+                    print "transmit_path: tx done callback exception: ", e
+
+    def timing_report(self):
+        """
+        Print how well timed sends were released.
+        """
+        print "timed packets:          ", self.timed_sent
+        print "placed too late:        ", self.timed_late
+        print "max placement error (s):", self.max_release_error
+        print "min lead on device (s): ", self.min_device_lead
+        print "stream underflows:      ", self.underflows
+
+    def send_pkts(self, payloads, block=True, callback=None):
+        """
+        Send a batch of packets.
+
+        @param payloads: list of packet payloads (strings)
+        @param block: if False, return right away and let a feeder thread
+                      hand the packets to the modulator
+        @param callback: fn(n) called once the n accepted packets of this
+                         batch are all in the modulator's queue
+        @return: number of packets accepted. Without blocking this is
+                 limited by tx_credits(); the rest are not sent.
+        """
+        if block:
+            self.flush()
+            for payload in payloads:
+                self._submit(self._new_id(), payload)
+            if callback is not None:
+                callback(len(payloads))
+            return len(payloads)
+
+        self._pending_lock.acquire()
+        n = max(0, min(len(payloads), self._tx_backlog - self._pending))
+        self._pending += n
+        self._pending_lock.release()
+        if n == 0:
+            return 0
+        if self._feeder is None:
+            self._feeder = threading.Thread(target=self._feed)
+            self._feeder.setDaemon(True)
+            self._feeder.start()
+        self._batches.put((payloads[:n], callback))
+        return n
+
+    def tx_credits(self):
+        """
+        Number of packets send_pkts(block=False) will accept right now.
+        """
+        return max(0, self._tx_backlog - self._pending)
+
+    def flush(self):
+        """
+        Wait until every packet given to send_pkts is in the modulator's queue.
+
+        From the feeder thread (a send_pkts callback) this returns right
+        away: the feeder can't wait for itself, and batches queued after
+        the one that called back go out after whatever the callback sends.
+        """
+        if self._feeder is not None and threading.currentThread() is not self._feeder:
+            self._batches.join()
+
+    def _feed(self):
+        while True:
+            payloads, callback = self._batches.get()
+            left = len(payloads)
+            try:
+                try:
+                    for payload in payloads:
+                        self._submit(self._new_id(), payload)
+                        self._pending_lock.acquire()
+                        self._pending -= 1
+                        self._pending_lock.release()
+                        left -= 1
+                except Exception, e:
+                    print "transmit_path: dropped %d packets: %s" % (left, e)
+            finally:
+                # give back the credits of the packets that didn't go out
+                self._pending_lock.acquire()
+                self._pending -= left
+                self._pending_lock.release()
+                self._batches.task_done()
+            if callback is not None:
+                try:
+                    callback(len(payloads))
+                except Exception, e:
+                    print "transmit_path: callback exception: ", e
         
     def add_options(normal, expert):
         """
         Adds transmitter-specific options to the Options Parser
         """
+        fec_choices = fec.CODES.keys()
+        fec_choices.sort()
         normal.add_option("", "--tx-amplitude", type="eng_float", default=.8, metavar="AMPL",
                           help="set transmitter digital amplitude: 0 <= AMPL < 1.0 [default=%default]")
         normal.add_option("-v", "--verbose", action="store_true", default=False)
+        expert.add_option("", "--tx-queue-depth", type="int", default=4,
+                          help="packets the modulator queue holds [default=%default]")
+        expert.add_option("", "--link-rates", type="string", default="",
+                          help="comma separated modulations frames may be sent and received "
+                          "with, besides -m [default=%default]")
+        expert.add_option("", "--fec", type="choice", choices=fec_choices, default="none",
+                          help="Reed-Solomon code around the payload, one of %s; a receiver "
+                          "with FEC on decodes any of them [default=%%default]" % (", ".join(fec_choices),))
+        expert.add_option("", "--ctl-cache", action="store_true", default=False,
+                          help="keep the samples of control frames and send them again "
+                          "without modulating [default=%default]")
+        expert.add_option("", "--ctl-cache-size", type="int", default=1024,
+                          help="control frames the waveform cache holds [default=%default]")
+        expert.add_option("", "--tx-notify", action="store_true", default=False,
+                          help="stream without gaps (as --timed-tx) and report when the device "
+                          "has played each frame [default=%default]")
+        expert.add_option("", "--timed-tx", action="store_true", default=False,
+                          help="stream without gaps and place timed packets at the sample "
+                          "of their air time on the device clock [default=%default]")
+        expert.add_option("", "--tx-lead", type="eng_float", default=.002, metavar="SECS",
+                          help="with --timed-tx, keep SECS of samples ahead of the device, "
+                          "besides --tx-latency [default=%default]")
+        expert.add_option("", "--tx-latency", type="eng_float", default=.001, metavar="SECS",
+                          help="with --timed-tx, time samples take from the host to the air "
+                          "[default=%default]")
+        expert.add_option("", "--tx-backlog", type="int", default=64,
+                          help="packets that can wait for the modulator in non-blocking sends [default=%default]")
         expert.add_option("", "--log", action="store_true", default=False,
                           help="Log all parts of flow graph to file (CAUTION: lots of data)")
 
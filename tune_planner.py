@@ -0,0 +1,134 @@
+# /////////////////////////////////////////////////////////////////////////////
+#                              Tuning Planner
+#
+# FuNLab
+# University of Washington
+#
+# Retuning the RF LO forces a --tune-delay of settling, but channels that are
+# close together can share one LO position and be reached by moving only the
+# DSP (NCO) offset, which takes effect right away. The tune_planner groups
+# the channel plan by LO position and tells the tuner whether a move is an
+# "rf" or a "dsp" retune.
+#
+# The planner only tracks where the LO is. Whatever actually tunes the device
+# reports each successful tune with tuned(), so the two can't get out of step.
+# /////////////////////////////////////////////////////////////////////////////
+
+class tune_planner(object):
+    """
+    Groups channels that fit inside lo_span around a shared LO.
+    """
+    def __init__(self, channels, lo_span, channel_bw):
+        """
+        @param channels: list of channel center frequencies (Hz)
+        @param lo_span: bandwidth (Hz) usable around one LO position, 0 retunes
+                        the LO for every channel
+        @param channel_bw: bandwidth (Hz) of each channel, kept clear of the LO
+                           so the LO leakage doesn't land in a channel
+        """
+        self.lo_span = lo_span
+        self.channel_bw = channel_bw
+        self.enabled = lo_span > 0
+        self.lo = None #where the LO is now
+        self.rf_tunes = 0
+        self.dsp_tunes = 0
+        self._lo_of = {}
+
+        if not self.enabled:
+            return
+        group = []
+        for freq in sorted(channels):
+            if len(group) > 0 and freq - group[0] + channel_bw > lo_span:
+                self._add_group(group)
+                group = []
+            group.append(freq)
+        if len(group) > 0:
+            self._add_group(group)
+
+    def _add_group(self, group):
+        lo = (group[0] + group[-1]) / 2.0
+        #keep the LO out of the channels, move it to the nearest gap edge
+        for freq in group:
+            if abs(freq - lo) < self.channel_bw / 2.0:
+                lo = freq + self.channel_bw / 2.0
+        reach = max(group[-1] - lo, lo - group[0]) + self.channel_bw / 2.0
+        if reach > self.lo_span / 2.0:
+            lo = None #no room to dodge the channels, sit the LO on each one
+        for freq in group:
+            if lo is None:
+                self._lo_of[freq] = freq
+            else:
+                self._lo_of[freq] = lo
+
+    def lo_for(self, freq):
+        """
+        Return the LO position used for a frequency.
+        """
+        return self._lo_of.get(freq, freq)
+
+    def kind(self, freq):
+        """
+        Return "rf" if tuning to freq moves the LO, "dsp" if only the DSP
+        offset changes.
+        """
+        if self.lo is not None and self.lo_for(freq) == self.lo:
+            return "dsp"
+        return "rf"
+
+    def tuned(self, freq):
+        """
+        Record a successful tune to freq.
+
+        @return: the kind of retune it was
+        """
+        kind = self.kind(freq)
+        if kind == "rf":
+            self.rf_tunes += 1
+        else:
+            self.dsp_tunes += 1
+        self.lo = self.lo_for(freq)
+        return kind
+
+    def invalidate(self):
+        """
+        Forget where the LO is, after something else has moved it. The next
+        tune places it again.
+        """
+        self.lo = None
+
+    def order(self, freqs):
+        """
+        Sort channels so a sweep visits each LO position once.
+        """
+        freqs = list(freqs)
+        if not self.enabled:
+            return freqs
+        freqs.sort(lambda a, b: cmp((self.lo_for(a), a), (self.lo_for(b), b)))
+        return freqs
+
+    def lo_positions(self, freqs):
+        """
+        Number of distinct LO positions needed to visit freqs.
+        """
+        los = {}
+        for freq in freqs:
+            los[self.lo_for(freq)] = True
+        return len(los)
+
+    def report(self):
+        """
+        Print how many retunes needed the LO to move.
+        """
+        print "rf retunes:  ", self.rf_tunes
+        print "dsp retunes: ", self.dsp_tunes
+
+    def add_options(normal, expert):
+        """
+        Adds tuning planner options to the Options Parser
+        """
+        expert.add_option("", "--lo-span", type="eng_float", default=0,
+                          help="bandwidth usable around one LO position, 0 retunes the LO for every channel [default=%default]")
+        expert.add_option("", "--dsp-tune-delay", type="eng_float", default=.001, metavar="SECS",
+                          help="time to delay (in seconds) after a DSP-only retune [default=%default]")
+    # Make a static method to call before instantiation
+    add_options = staticmethod(add_options)
@@ -44,10 +44,17 @@ import time
 import struct
 import sys
 import os
+import errno
+import fcntl
+import heapq
+import select
+import threading
+from collections import deque
 
 # from current dir
 from transmit_path import transmit_path
 from receive_path import receive_path
+import fragment
 #import fusb_options
 
 #print os.getpid()
@@ -135,6 +142,12 @@ class usrp_graph(gr.top_block):
         """
         return self.rxpath.carrier_sensed()
 
+    def frame_time(self, payload_len):
+        """
+        Return the seconds a payload takes on the air.
+        """
+        return self.txpath.frame_time(payload_len, self._samp_rate)
+
     def _setup_usrp_sink(self):
         """
         Creates a USRP sink, determines the settings for best bitrate,
@@ -249,15 +262,89 @@ class cs_mac(object):
 
     Of course, we're not restricted to getting packets via TUN/TAP, this
     is just an example.
+
+    Everything runs from one epoll loop: the TUN fd is non-blocking and
+    drained in batches into the send queue, carrier sense deferral is a
+    timer instead of a sleep, the queue goes to the PHY in bursts through
+    send_pkts(block=False), and received packets are queued by the PHY
+    thread and written to TUN by the loop. The PHY side wakes the loop
+    through a pipe.
+
+    With a fragmenter, frames from TUN are sent as fragments (which the
+    queue limits then count) and received fragments go through the
+    reassembler.
     """
-    def __init__(self, tun_fd, verbose=False):
+    def __init__(self, tun_fd, verbose=False, batch=64, max_queue=256,
+                 fragmenter=None, reassembler=None, burst_time=.01):
+        """
+        @param batch: most packets read from TUN or sent to the PHY at once
+        @param burst_time: most air time (seconds) sent after one carrier
+                           sense; a burst is at least one packet
+        @param max_queue: stop reading TUN while this many packets wait to
+                          be sent
+        @param fragmenter: fragment.fragmenter, None sends frames whole
+        @param reassembler: fragment.reassembler, needed with a fragmenter
+        """
         self.tun_fd = tun_fd       # file descriptor for TUN/TAP interface
         self.verbose = verbose
         self.tb = None             # top block (access to PHY)
+        self.batch = batch
+        self.max_queue = max_queue
+        self.burst_time = burst_time
+        self.fragmenter = fragmenter
+        self.reassembler = reassembler
+
+        self.min_delay = 0.001     # seconds
+        self.max_delay = 0.050
+        self._delay = self.min_delay
+
+        self._tx_queue = deque()   # from TUN, waiting for the PHY
+        self._rx_queue = deque()   # from the PHY, waiting for TUN
+        self._rx_lock = threading.Lock()
+        self._timers = []          # heap of (when, seq, fn)
+        self._timer_seq = 0
+        self._defer_timer = False
+        self._sending = False      # a burst is on its way to the modulator
+        self._eof = False
+
+        self._set_nonblocking(tun_fd)
+        self._wake_r, self._wake_w = os.pipe()
+        self._set_nonblocking(self._wake_r)
+        self._set_nonblocking(self._wake_w)
+        self._woken = False
+
+        self._epoll = select.epoll()
+        self._tun_events = select.EPOLLIN
+        self._epoll.register(tun_fd, self._tun_events)
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+
+        # counters
+        self.tun_reads = 0
+        self.tx_sent = 0
+        self.deferrals = 0
+        self.rx_written = 0
+        self.rx_dropped = 0
+
+    def _set_nonblocking(self, fd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
     def set_flow_graph(self, tb):
         self.tb = tb
 
+    def _wake(self):
+        """
+        Wake the loop; safe from any thread.
+        """
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            os.write(self._wake_w, "x")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
     def phy_rx_callback(self, ok, payload):
         """
         Invoked by thread associated with PHY to pass received packet up.
@@ -267,35 +354,192 @@ class cs_mac(object):
         """
         if self.verbose:
             print "Rx: ok = %r  len(payload) = %4d" % (ok, len(payload))
+        self._rx_lock.acquire()
+        if self.fragmenter is not None:
+            self.fragmenter.observe(ok, len(payload))
+        if ok and self.reassembler is not None:
+            payload = self.reassembler.add(payload)
+            ok = payload is not None
+        if ok:
+            self._rx_queue.append(payload)
+        self._rx_lock.release()
         if ok:
-            os.write(self.tun_fd, payload)
+            self._wake()
 
-    def main_loop(self):
+    def _tx_done(self, n):
         """
-        Main loop for MAC.
-        Only returns if we get an error reading from TUN.
-
-        FIXME: may want to check for EINTR and EAGAIN and reissue read
+        Called by the transmit path's feeder once a batch is in the modulator.
         """
-        min_delay = 0.001               # seconds
+        self._sending = False
+        self._wake()
+
+    # ------------------------------------------------------------- timers ---
+
+    def _call_later(self, delay, fn):
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._timer_seq, fn))
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, fn = heapq.heappop(self._timers)
+            fn()
+
+    def _timeout(self):
+        if not self._timers:
+            return -1
+        return max(0.0, self._timers[0][0] - time.time())
 
-        while 1:
-            payload = os.read(self.tun_fd, 10*1024)
+    # ----------------------------------------------------------------- tx ---
+
+    def _read_tun(self):
+        """
+        Read what the kernel has for us, up to a batch.
+        """
+        for i in range(self.batch):
+            if len(self._tx_queue) >= self.max_queue:
+                break
+            try:
+                payload = os.read(self.tun_fd, 10*1024)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
             if not payload:
-                self.tb.txpath.send_pkt(eof=True)
+                self._eof = True
+                self._epoll.unregister(self.tun_fd)
                 break
-
             if self.verbose:
                 print "Tx: len(payload) = %4d" % (len(payload),)
+            self.tun_reads += 1
+            if self.fragmenter is not None:
+                self._tx_queue.extend(self.fragmenter.fragment(payload))
+            else:
+                self._tx_queue.append(payload)
+
+    def _try_send(self):
+        """
+        Hand a burst of queued packets to the PHY if the channel is clear,
+        otherwise try again after an exponentially growing deferral. The
+        channel is sensed again before every burst, once the previous one
+        is in the modulator.
+        """
+        self._defer_timer = False
+        if not self._tx_queue or self._sending:
+            return
+        if self.tb.carrier_sensed():
+            sys.stderr.write('B')
+            self.deferrals += 1
+            self._defer_timer = True
+            self._call_later(self._delay, self._try_send)
+            if self._delay < self.max_delay:
+                self._delay = self._delay * 2       # exponential back-off
+            return
+        self._delay = self.min_delay
+        limit = min(len(self._tx_queue), self.batch, self.tb.txpath.tx_credits())
+        if limit == 0:
+            # the transmit path is full; _tx_done wakes us
+            return
+        # no more than one slot of air time on one carrier sense
+        n = 1
+        air = self.tb.frame_time(len(self._tx_queue[0]))
+        while n < limit:
+            air += self.tb.frame_time(len(self._tx_queue[n]))
+            if air > self.burst_time:
+                break
+            n += 1
+        batch = [self._tx_queue.popleft() for i in range(n)]
+        self._sending = True
+        self.tb.txpath.send_pkts(batch, block=False, callback=self._tx_done)
+        self.tx_sent += n
 
-            delay = min_delay
-            while self.tb.carrier_sensed():
-                sys.stderr.write('B')
-                time.sleep(delay)
-                if delay < 0.050:
-                    delay = delay * 2       # exponential back-off
+    # ----------------------------------------------------------------- rx ---
 
-            self.tb.txpath.send_pkt(payload)
+    def _write_tun(self):
+        """
+        Write the received packets to TUN, one per write. Whatever the
+        kernel won't take now waits for the fd to become writable.
+        """
+        self._rx_lock.acquire()
+        pending = self._rx_queue
+        self._rx_queue = deque()
+        self._rx_lock.release()
+        while pending:
+            try:
+                os.write(self.tun_fd, pending[0])
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                self.rx_dropped += 1
+            else:
+                self.rx_written += 1
+            pending.popleft()
+        if pending:
+            self._rx_lock.acquire()
+            pending.extend(self._rx_queue)
+            self._rx_queue = pending
+            self._rx_lock.release()
+
+    def _update_tun_events(self):
+        if self._eof:
+            return
+        events = 0
+        if len(self._tx_queue) < self.max_queue:
+            events |= select.EPOLLIN
+        if self._rx_queue:
+            events |= select.EPOLLOUT
+        if events != self._tun_events:
+            self._epoll.modify(self.tun_fd, events)
+            self._tun_events = events
+
+    # --------------------------------------------------------------- loop ---
+
+    def main_loop(self):
+        """
+        Main loop for MAC.
+        Only returns when TUN is closed.
+        """
+        while not self._eof or self._tx_queue:
+            try:
+                events = self._epoll.poll(self._timeout())
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_r:
+                    self._woken = False
+                    try:
+                        os.read(self._wake_r, 4096)
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                elif event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                    self._read_tun()
+            self._write_tun()
+            self._run_timers()
+            if not self._defer_timer:
+                self._try_send()
+            self._update_tun_events()
+
+        self.tb.txpath.send_pkt(eof=True)
+        self._epoll.close()
+        print
+        print "tun reads %d, sent %d, deferrals %d, rx written %d, rx dropped %d" % \
+              (self.tun_reads, self.tx_sent, self.deferrals, self.rx_written, self.rx_dropped)
+        f = self.fragmenter
+        r = self.reassembler
+        if f is not None:
+            print "fragmented %d frames (%d bytes) into %d fragments, %d too long, size now %d" % \
+                  (f.packets, f.bytes, f.fragments, f.too_long, f.frag_size)
+            ber = f.bit_error_rate()
+            if ber is not None:
+                print "estimated bit error rate %.2e" % (ber,)
+        if r is not None:
+            print "reassembled %d frames from %d fragments: %d duplicates, %d timed out, " \
+                  "%d evicted, %d bad, %d pending" % \
+                  (r.packets, r.fragments, r.duplicates, r.timed_out, r.evicted, r.bad,
+                   r.pending())
 
 
 # /////////////////////////////////////////////////////////////////////////////
@@ -316,10 +560,17 @@ def main():
                           help="set carrier detect threshold (dB) [default=%default]")
     expert_grp.add_option("","--tun-device-filename", default="/dev/net/tun",
                           help="path to tun device file [default=%default]")
+    expert_grp.add_option("","--tun-batch", type="int", default=64,
+                          help="most packets read from TUN or sent to the PHY at once [default=%default]")
+    expert_grp.add_option("","--tun-burst", type="eng_float", default=.01, metavar="SECS",
+                          help="most air time sent after one carrier sense [default=%default]")
+    expert_grp.add_option("","--tun-queue", type="int", default=256,
+                          help="stop reading TUN while this many packets wait to be sent [default=%default]")
 
     usrp_graph.add_options(parser, expert_grp)
     transmit_path.add_options(parser, expert_grp)
     receive_path.add_options(parser, expert_grp)
+    fragment.fragmenter.add_options(parser, expert_grp)
     blks2.ofdm_mod.add_options(parser, expert_grp)
     blks2.ofdm_demod.add_options(parser, expert_grp)
 
@@ -346,7 +597,14 @@ def main():
 
 
     # instantiate the MAC
-    mac = cs_mac(tun_fd, verbose=True)
+    frag = None
+    reasm = None
+    if options.frag_size > 0:
+        frag = fragment.fragmenter(options.frag_size, options.frag_adapt, options.frag_min,
+                                   sender=options.frag_sender)
+        reasm = fragment.reassembler(options.reasm_buffers, options.reasm_timeout)
+    mac = cs_mac(tun_fd, verbose=True, batch=options.tun_batch, max_queue=options.tun_queue,
+                 fragmenter=frag, reassembler=reasm, burst_time=options.tun_burst)
 
 
     # build the graph (PHY)